@@ -0,0 +1,197 @@
+"""
+Допуск запросов и сброс нагрузки.<br>
+Корзина токенов на пару (ключ клиента, класс маршрута): read - чтение,
+write - запись, media - загрузка картинок. Ключ - хэш api-key (одинаков
+во всех процессах и не зависит от кэша пользователей), без него - адрес
+клиента (за nginx - из X-Forwarded-For, см. FORWARDED_ALLOW_IPS).
+Корзин не больше RATE_MAX_KEYS: выдуманные api-key вытесняют давние.
+Пустая корзина - сразу 429 с Retry-After.<br>
+Общий предел одновременных запросов к /api/ (все они идут в базу):
+сверх него - сразу 503 с Retry-After, а не очередь до таймаутов пула.<br>
+Проверка - до разбора тела, отказ ничего не читает и не трогает базу.
+Отказы считаются в метрике http_requests_shed_total. Потоки SSE
+ограничиваются по частоте подключений, но не входят в предел одновременных.
+Корзины и предел - в памяти процесса, т.е. на каждый рабочий процесс.
+"""
+
+import hashlib
+import math
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import BACK.config as config
+import BACK.metrics as metrics
+from BACK.cache import TTLCache
+from BACK.util_func import get_err_JSONRes
+
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+# Долгие потоки (SSE): база - только при подключении, поэтому
+# в предел одновременных запросов не входят (свой - STREAM_MAX_SUBSCRIBERS).
+LONG_LIVED_PATHS = {"/api/tweets/stream"}
+
+
+class Rate(NamedTuple):
+    # Токенов в секунду и емкость корзины (сколько можно разом).
+    per_second: float
+    burst: int
+
+
+def route_class(method: str, path: str) -> Optional[str]:
+    """
+    Класс маршрута по методу и пути, None - не ограничивается.
+    """
+    if not path.startswith("/api/"):
+        return None
+    if path.rstrip("/") == "/api/medias" and method == "POST":
+        return "media"
+    if method in WRITE_METHODS:
+        return "write"
+    return "read"
+
+
+class TokenBuckets:
+    """
+    Корзины по ключам. Корзина, не тронутая дольше времени полного
+    наполнения, равна полной - поэтому хранятся в TTLCache с таким сроком.
+    """
+
+    def __init__(
+        self, rate: Rate, maxsize: int, timer: Callable[[], float] = time.monotonic
+    ):
+        self.rate = rate
+        self._timer = timer
+        self._buckets = TTLCache(maxsize, rate.burst / rate.per_second, timer)
+
+    def take(self, key) -> float:
+        """
+        Берет токен. 0 - взят, иначе - через сколько секунд появится.
+        """
+        now = self._timer()
+        bucket: Optional[List[float]] = self._buckets.get(key)
+        if bucket is None:
+            tokens = float(self.rate.burst)
+        else:
+            tokens, updated_at = bucket
+            tokens = min(
+                self.rate.burst, tokens + (now - updated_at) * self.rate.per_second
+            )
+        if tokens < 1:
+            self._buckets.set(key, [tokens, now])
+            return (1 - tokens) / self.rate.per_second
+        self._buckets.set(key, [tokens - 1, now])
+        return 0
+
+
+class AdmissionMiddleware:
+    """
+    ASGI-прослойка: корзины токенов и предел одновременных запросов.
+    """
+
+    def __init__(
+        self,
+        app,
+        rates: Dict[str, Rate],
+        max_keys: int,
+        max_concurrent: int,
+        retry_after: int,
+    ):
+        self.app = app
+        self.buckets = {
+            name: TokenBuckets(rate, max_keys) for name, rate in rates.items()
+        }
+        self.max_concurrent = max_concurrent
+        self.retry_after = retry_after
+        self.in_flight = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        kind = route_class(scope["method"], scope["path"])
+        if kind is None:
+            return await self.app(scope, receive, send)
+
+        buckets = self.buckets.get(kind)
+        if buckets is not None:
+            wait = buckets.take(self._client_key(scope))
+            if wait:
+                return await self._reject(
+                    scope,
+                    receive,
+                    send,
+                    429,
+                    "too many requests",
+                    f"Rate limit for '{kind}' requests exceeded.",
+                    max(1, math.ceil(wait)),
+                    kind,
+                )
+
+        if scope["path"].rstrip("/") in LONG_LIVED_PATHS:
+            return await self.app(scope, receive, send)
+        if self.max_concurrent and self.in_flight >= self.max_concurrent:
+            return await self._reject(
+                scope,
+                receive,
+                send,
+                503,
+                "overloaded",
+                "Server is busy, retry later.",
+                self.retry_after,
+                kind,
+            )
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+    @staticmethod
+    def _client_key(scope) -> str:
+        for name, value in scope["headers"]:
+            if name == b"api-key":
+                # Сам api-key в памяти не держим.
+                return "key:" + hashlib.blake2b(value, digest_size=16).hexdigest()
+        client = scope.get("client")
+        return "addr:" + (client[0] if client else "")
+
+    @staticmethod
+    async def _reject(
+        scope,
+        receive,
+        send,
+        status_code: int,
+        error_type: str,
+        message: str,
+        retry_after: int,
+        kind: str,
+    ):
+        metrics.registry.shed.inc((error_type, kind))
+        response = get_err_JSONRes(status_code, error_type, message)
+        response.headers["Retry-After"] = str(retry_after)
+        await response(scope, receive, send)
+
+
+def rates() -> Dict[str, Rate]:
+    """
+    Пределы из config. Класс с нулевой скоростью не ограничивается.
+    """
+    configured = {
+        "read": Rate(config.RATE_READ_PER_SEC, config.RATE_READ_BURST),
+        "write": Rate(config.RATE_WRITE_PER_SEC, config.RATE_WRITE_BURST),
+        "media": Rate(config.RATE_MEDIA_PER_SEC, config.RATE_MEDIA_BURST),
+    }
+    return {name: rate for name, rate in configured.items() if rate.per_second > 0}
+
+
+def setup(app):
+    """
+    Подключает допуск запросов, если ADMISSION_ENABLED.
+    """
+    if not config.ADMISSION_ENABLED:
+        return
+    app.add_middleware(
+        AdmissionMiddleware,
+        rates=rates(),
+        max_keys=config.RATE_MAX_KEYS,
+        max_concurrent=config.MAX_CONCURRENT_REQUESTS,
+        retry_after=config.SHED_RETRY_AFTER,
+    )
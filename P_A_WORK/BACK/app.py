@@ -1,63 +1,394 @@
-import os
-import random
-from typing import Annotated, Any, Generator, List, Optional, Union
+from contextlib import asynccontextmanager
+from typing import (
+    Annotated,
+    Any,
+    AsyncIterator,
+    Generator,
+    List,
+    Optional,
+    Set,
+    Union,
+)
 
-from fastapi import FastAPI, Header, UploadFile
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, Header, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy import and_
 from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.future import select
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import selectinload
 from sqlalchemy.sql.expression import update
+from starlette.background import BackgroundTask
 
+import BACK.admission as admission
+import BACK.broadcast as broadcast
+import BACK.config as config
+import BACK.derivatives as derivatives
+import BACK.etags as etags
+import BACK.fast_json as fast_json
+import BACK.follow_graph as follow_graph
+import BACK.logs as logs
+import BACK.media_store as media_store
+import BACK.metrics as metrics
+import BACK.query_budget as query_budget
 import BACK.models as models
+import BACK.popular as popular
+import BACK.projections as projections
+import BACK.replicas as replicas
 import BACK.schemas as schemas
+import BACK.search as search
+import BACK.stream as stream
+import BACK.timeline as timeline
 import BACK.util_func as util_func
-from BACK.models import logger
-
-IMG_PATH = "./IMG"
+from BACK.logs import logger
 
 
 # Т.н. фабрика приложения.
-def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAPI:
+def create_app(
+    session_maker: async_sessionmaker[AsyncSession],
+    lifespan: Generator[None, Any, None],
+    read_session_maker: Optional[async_sessionmaker[AsyncSession]] = None,
+) -> FastAPI:
+    """
+    read_session_maker - сессии реплики для GET-маршрутов (replicas.py).
+    """
+    router = replicas.SessionRouter(session_maker, read_session_maker)
+
+    pipeline = derivatives.DerivativePipeline(
+        session_maker,
+        workers=config.DERIVATIVE_WORKERS,
+        queue_size=config.DERIVATIVE_QUEUE_SIZE,
+        sweep_interval=config.DERIVATIVE_SWEEP_INTERVAL,
+    )
+
+    @asynccontextmanager
+    async def lifespan_with_derivatives(app: FastAPI):
+        async with lifespan(app):
+            await broadcast.hub.start(config.BROADCAST_BACKEND)
+            if follow_graph.enabled():
+                await follow_graph.start(session_maker)
+            if derivatives.enabled():
+                await pipeline.start()
+            try:
+                yield
+            finally:
+                await pipeline.stop()
+                await follow_graph.stop()
+                await broadcast.hub.stop()
+
+    app = FastAPI(lifespan=lifespan_with_derivatives)
+    app.state.derivatives = pipeline
+    # Запас на обвязку multipart сверх самого файла.
+    app.add_middleware(
+        media_store.MaxBodySizeMiddleware,
+        path="/api/medias",
+        max_bytes=config.MEDIA_MAX_BYTES + 64 * 1024,
+    )
+    query_budget.setup(app, *router.engines())
+    # Снаружи разбора тела и проверки бюджетов: отказ ничего не читает.
+    admission.setup(app)
+    # Снаружи остальных прослоек - учитываются и их ответы (413, 429, 503).
+    if config.METRICS_ENABLED:
+        metrics.setup(app, *router.engines())
+    # Снаружи всех: request_id есть и у записей остальных прослоек.
+    logs.setup(app, *router.engines())
+
+    async def get_session(
+        api_key: Annotated[str | None, Header()] = None,
+    ) -> AsyncIterator[AsyncSession]:
+        """
+        Своя сессия (и соединение из пула) на каждый запрос.<br>
+        Незакоммиченное при выходе откатывается, соединение возвращается в пул.
+        """
+        async with router.for_write(api_key) as session:
+            yield session
+
+    async def get_read_session(
+        api_key: Annotated[str | None, Header()] = None,
+    ) -> AsyncIterator[AsyncSession]:
+        """
+        То же для чтения: с реплики, если она есть и клиент недавно не писал.
+        """
+        async with router.for_read(api_key) as session:
+            yield session
+
+    SessionDep = Annotated[AsyncSession, Depends(get_session)]
+    ReadSessionDep = Annotated[AsyncSession, Depends(get_read_session)]
+
+    async def resolve_user_id(
+        session: AsyncSession, user_id: str, api_key: Optional[str]
+    ) -> tuple[Optional[int], Optional[Union[dict, JSONResponse]]]:
+        """
+        id пользователя из пути: число или 'me' (тогда по ключу).<br>
+        Либо None и описание ошибки (не число - ответ 400).
+        """
+        if user_id == "me":
+            me, err_dict = await models.User.get_by_api_key(session, api_key)
+            if me is None:
+                return None, err_dict
+            return me.id, None
+        try:
+            return int(user_id), None
+        except ValueError:
+            return None, util_func.get_err_JSONRes(
+                400, "bad request", f"Invalid user id: '{user_id}'."
+            )
+
+    def tweet_list_response(
+        tweets: List[projections.TweetRow],
+        next_cursor: Optional[str],
+        headers: Optional[dict] = None,
+    ) -> Union[dict, Response]:
+        """
+        Ответ TweetResultListOut: при FAST_JSON - сразу JSON из строк.
+        """
+        if config.FAST_JSON:
+            return fast_json.FastJSONResponse(
+                {
+                    "result": True,
+                    "tweets": [tweet.as_dict() for tweet in tweets],
+                    "next_cursor": next_cursor,
+                },
+                headers=headers,
+            )
+        return {"result": True, "tweets": tweets, "next_cursor": next_cursor}
 
-    app = FastAPI(lifespan=lifespan)
+    def check_batch(ids: List[int]) -> tuple[List[int], Optional[JSONResponse]]:
+        """
+        id пакета без повторов (порядок сохраняется), либо ответ 400.
+        """
+        ids = list(dict.fromkeys(ids))
+        if not ids or len(ids) > config.BATCH_MAX_ITEMS:
+            return ids, util_func.get_err_JSONRes(
+                400,
+                "bad request",
+                f"Expected from 1 to {config.BATCH_MAX_ITEMS} ids.",
+            )
+        return ids, None
 
-    models.set_session(session)
+    def batch_results(
+        ids: List[int],
+        done: Set[int],
+        found: Optional[Set[int]],
+        skipped_message: str,
+        missing_message: str,
+    ) -> List[dict]:
+        """
+        Итог по каждому id пакета: выполнено; пропущено (уже было) -
+        для id из found; не найдено - для остальных.
+        """
+        results = []
+        for item_id in ids:
+            if item_id in done:
+                results.append({"id": item_id, "result": True})
+            elif found is not None and item_id in found:
+                results.append(
+                    {
+                        "id": item_id,
+                        "result": False,
+                        "error_type": "already exists",
+                        "error_message": skipped_message.format(item_id),
+                    }
+                )
+            else:
+                results.append(
+                    {
+                        "id": item_id,
+                        "result": False,
+                        "error_type": "not found",
+                        "error_message": missing_message.format(item_id),
+                    }
+                )
+        return results
 
     #   API USERS
+    #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+    @app.get(
+        "/api/users/",
+        response_model=Union[schemas.UserBatchResultOut, schemas.ErrResultOut],
+    )
+    @query_budget.budget(1)
+    async def users_by_ids(
+        session: ReadSessionDep,
+        ids: Annotated[str, Query(description="id через запятую: 1,2,3")],
+    ) -> dict:
+        """
+        <h1>
+        Несколько пользователей сразу.
+        </h1>
+        id, имена и счетчики, в порядке ids, одним запросом.
+        Несуществующие id пропускаются.
+        """
+        try:
+            user_ids = [int(part) for part in ids.split(",") if part.strip()]
+        except ValueError:
+            return util_func.get_err_JSONRes(
+                400, "bad request", "ids must be comma separated integers."
+            )
+        user_ids, err_response = check_batch(user_ids)
+        if err_response is not None:
+            return err_response
+        users = await projections.load_users_by_ids(session, user_ids)
+        return {"result": True, "users": users}
+
     #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
     @app.get(
         "/api/users/{user_id}/",
         response_model=Union[schemas.UserResultOut, schemas.ErrResultOut],
     )
+    @query_budget.budget(5)
     async def user_by_id(
+        session: ReadSessionDep,
+        response: Response,
         user_id: Optional[str] = 0,
         api_key: Annotated[str | None, Header()] = None,
-    ) -> Union[models.User, dict]:
+        if_none_match: Annotated[str | None, Header()] = None,
+    ) -> dict:
         """
         <h1>
         Информация о пользователе по id или 'me' с ключом.
         </h1>
+        Последователи и подписки - только первые из них,
+        полные списки - /followers/ и /following/.<br>
+        Отдает ETag, с If-None-Match без изменений - 304.
         """
-        if user_id == "me":
-            user, err_dict = await models.User.get_by_api_key(api_key)
-            if user is None:
-                return err_dict
-        else:
-            user_id = int(user_id)
-            res = await session.execute(
-                select(models.User).where(models.User.id == user_id)
+        user_id, err_dict = await resolve_user_id(session, user_id, api_key)
+        if user_id is None:
+            return err_dict
+
+        headers = {}
+        etag = await etags.profile_etag(session, user_id)
+        if etag is not None:
+            headers = {"ETag": etag, "Cache-Control": etags.CACHE_CONTROL}
+            if etags.matches(if_none_match, etag):
+                return Response(status_code=304, headers=headers)
+            response.headers.update(headers)
+
+        user = await projections.load_user_profile(
+            session, user_id, config.PROFILE_FOLLOWS_PREVIEW
+        )
+        if user is None:
+            return util_func.get_err_JSONRes(
+                404, "not found", f"User with id: {user_id} doesn't exist."
             )
-            user = res.scalar()
-            if user is None:
-                return util_func.get_err_JSONRes(
-                    404, "not found", f"User with id: {user_id} doesn't exist."
-                )
+        if config.FAST_JSON:
+            return fast_json.FastJSONResponse(
+                {"result": True, "user": user.as_dict()}, headers=headers
+            )
+        return {"result": True, "user": user}
 
-        await user.get_up_follows()
-        result = {"result": True, "user": user.as_dict()}
-        return result
+    async def follows_page(
+        session: AsyncSession,
+        user_id: str,
+        api_key: Optional[str],
+        followers: bool,
+        limit: int,
+        cursor: Optional[str],
+    ) -> dict:
+        user_id, err_dict = await resolve_user_id(session, user_id, api_key)
+        if user_id is None:
+            return err_dict
+        try:
+            after_id = util_func.decode_cursor(cursor, "u")
+        except ValueError as err:
+            return util_func.get_err_JSONRes(400, "bad request", str(err))
+        if await session.get(models.User, user_id) is None:
+            return util_func.get_err_JSONRes(
+                404, "not found", f"User with id: {user_id} doesn't exist."
+            )
+        users = await projections.load_follows_page(
+            session, user_id, followers, limit, after_id
+        )
+        next_cursor = None
+        if len(users) == limit:
+            next_cursor = util_func.encode_cursor(users[-1].id, "u")
+        return {"result": True, "users": users, "next_cursor": next_cursor}
+
+    @app.get(
+        "/api/users/{user_id}/followers/",
+        response_model=Union[schemas.UserListResultOut, schemas.ErrResultOut],
+    )
+    @query_budget.budget(3)
+    async def user_followers(
+        session: ReadSessionDep,
+        user_id: str,
+        api_key: Annotated[str | None, Header()] = None,
+        limit: Annotated[
+            int, Query(ge=1, le=config.FOLLOWS_MAX_LIMIT)
+        ] = config.FOLLOWS_DEFAULT_LIMIT,
+        cursor: Optional[str] = None,
+    ) -> dict:
+        """
+        <h1>
+        Последователи пользователя, постранично.
+        </h1>
+        """
+        return await follows_page(session, user_id, api_key, True, limit, cursor)
+
+    @app.get(
+        "/api/users/{user_id}/following/",
+        response_model=Union[schemas.UserListResultOut, schemas.ErrResultOut],
+    )
+    @query_budget.budget(3)
+    async def user_following(
+        session: ReadSessionDep,
+        user_id: str,
+        api_key: Annotated[str | None, Header()] = None,
+        limit: Annotated[
+            int, Query(ge=1, le=config.FOLLOWS_MAX_LIMIT)
+        ] = config.FOLLOWS_DEFAULT_LIMIT,
+        cursor: Optional[str] = None,
+    ) -> dict:
+        """
+        <h1>
+        За кем следит пользователь, постранично.
+        </h1>
+        """
+        return await follows_page(session, user_id, api_key, False, limit, cursor)
+
+    @app.get(
+        "/api/users/{user_id}/suggestions/",
+        response_model=Union[schemas.SuggestionsResultOut, schemas.ErrResultOut],
+    )
+    @query_budget.budget(5)
+    async def user_suggestions(
+        session: ReadSessionDep,
+        user_id: str,
+        api_key: Annotated[str | None, Header()] = None,
+        limit: Annotated[
+            int, Query(ge=1, le=config.SUGGESTIONS_MAX_LIMIT)
+        ] = config.SUGGESTIONS_DEFAULT_LIMIT,
+    ) -> dict:
+        """
+        <h1>
+        Кого читать.
+        </h1>
+        За кем следят те, за кем следит пользователь (и он сам еще нет),
+        больше общих знакомых (mutual) - выше.
+        """
+        user_id, err_dict = await resolve_user_id(session, user_id, api_key)
+        if user_id is None:
+            return err_dict
+        if await session.get(models.User, user_id) is None:
+            return util_func.get_err_JSONRes(
+                404, "not found", f"User with id: {user_id} doesn't exist."
+            )
+        found = await follow_graph.suggest(session, user_id, limit)
+        mutual = dict(found)
+        users = await projections.load_users_by_ids(session, list(mutual))
+        return {
+            "result": True,
+            "users": [
+                {
+                    "id": user.id,
+                    "name": user.name,
+                    "followers_count": user.followers_count,
+                    "following_count": user.following_count,
+                    "mutual": mutual[user.id],
+                }
+                for user in users
+            ],
+        }
 
     #  /API/USERS  /FOLLOW
     #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
@@ -65,32 +396,31 @@ def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAP
         "/api/users/{user_id}/follow/",
         response_model=Union[schemas.ResultOut, schemas.ErrResultOut],
     )
+    @query_budget.budget(7)
     async def start_follow_by_id(
-        api_key: Annotated[str | None, Header()] = None, user_id: Optional[int] = None
+        session: SessionDep,
+        api_key: Annotated[str | None, Header()] = None,
+        user_id: Optional[int] = None,
     ) -> dict:
         """
         <h1>
         Стать последователем.
         </h1>
         """
-        persecutor, err_dict = await models.User.get_by_api_key(api_key)
+        persecutor, err_dict = await models.User.get_by_api_key(session, api_key)
         if persecutor is None:
             return err_dict
 
-        res = await session.execute(
-            select(models.User).where(models.User.id == user_id)
-        )
-        victim = res.scalar()
+        victim = await session.get(models.User, user_id)
         if victim is None:
             return util_func.get_err_dict(
                 "not found", f"User with id: {user_id} doesn't exist."
             )
 
-        new_useruser = models.UserUser()
-        new_useruser.user = persecutor
-        new_useruser.follow_to_user = victim
         try:
-            session.add(new_useruser)
+            await models.UserUser.follow(session, persecutor.id, victim.id)
+            if timeline.enabled():
+                await timeline.backfill_follow(session, persecutor.id, victim.id)
             await session.commit()
         except Exception as err:
             await session.rollback()
@@ -99,6 +429,9 @@ def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAP
                 "error_type": "read below",
                 "error_message": str(err),
             }
+        broadcast.hub.publish("rings.invalidate", persecutor.id)
+        broadcast.hub.publish("stream.follow", persecutor.id, [victim.id], True)
+        broadcast.hub.publish("follow_graph.follow", persecutor.id, [victim.id], True)
         return {"result": True}
 
     #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
@@ -106,27 +439,23 @@ def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAP
         "/api/users/{user_id}/follow/",
         response_model=Union[schemas.ResultOut, schemas.ErrResultOut],
     )
+    @query_budget.budget(5)
     async def end_follow_by_id(
-        api_key: Annotated[str | None, Header()] = None, user_id: int = 0
+        session: SessionDep,
+        api_key: Annotated[str | None, Header()] = None,
+        user_id: int = 0,
     ) -> dict:
         """
         <h1>
         Прекратить преследование.
         </h1>
         """
+        persecutor, err_dict = await models.User.get_by_api_key(session, api_key)
+        if persecutor is None:
+            return err_dict
+        follower_id = persecutor.id
         try:
-            res = await session.execute(
-                select(models.UserUser)
-                .join(models.User, models.User.id == models.UserUser.id)
-                .where(
-                    and_(
-                        models.User.api_key == api_key,
-                        models.UserUser.follow_to_id == user_id,
-                    )
-                )
-            )
-            record_uu = res.scalar()
-            if record_uu is None:
+            if not await models.UserUser.unfollow(session, follower_id, user_id):
                 return JSONResponse(
                     status_code=404,
                     content=util_func.get_err_dict(
@@ -134,7 +463,8 @@ def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAP
                         f"Following to '{user_id}' for api-key: '{api_key}' doesn't exist.",
                     ),
                 )
-            await session.delete(record_uu)
+            if timeline.enabled():
+                await timeline.retract_follow(session, follower_id, user_id)
             await session.commit()
         except Exception as err:
             await session.rollback()
@@ -143,28 +473,119 @@ def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAP
                 "error_type": "read below",
                 "error_message": str(err),
             }
+        broadcast.hub.publish("rings.invalidate", follower_id)
+        broadcast.hub.publish("stream.follow", follower_id, [user_id], False)
+        broadcast.hub.publish("follow_graph.follow", follower_id, [user_id], False)
         return {"result": True}
 
+    #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+    @app.post(
+        "/api/users/follow/",
+        response_model=Union[schemas.BatchResultOut, schemas.ErrResultOut],
+    )
+    @query_budget.budget(6)
+    async def start_follow_many(
+        session: SessionDep,
+        follows: schemas.UserIdsIn,
+        api_key: Annotated[str | None, Header()] = None,
+    ) -> dict:
+        """
+        <h1>
+        Стать последователем сразу нескольких.
+        </h1>
+        Одна транзакция, итог по каждому id.
+        """
+        persecutor, err_dict = await models.User.get_by_api_key(session, api_key)
+        if persecutor is None:
+            return err_dict
+        user_ids, err_response = check_batch(follows.user_ids)
+        if err_response is not None:
+            return err_response
+        try:
+            found, added = await models.UserUser.follow_many(
+                session, persecutor.id, user_ids
+            )
+            if added and timeline.enabled():
+                await timeline.backfill_follows(session, persecutor.id, list(added))
+            await session.commit()
+        except Exception as err:
+            await session.rollback()
+            return util_func.get_err_dict("read below", str(err))
+        broadcast.hub.publish("rings.invalidate", persecutor.id)
+        broadcast.hub.publish("stream.follow", persecutor.id, list(added), True)
+        broadcast.hub.publish("follow_graph.follow", persecutor.id, list(added), True)
+        results = batch_results(
+            user_ids,
+            added,
+            found,
+            "Already following user with id: {}.",
+            "User with id: {} doesn't exist.",
+        )
+        return {"result": True, "results": results}
+
+    #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+    @app.delete(
+        "/api/users/follow/",
+        response_model=Union[schemas.BatchResultOut, schemas.ErrResultOut],
+    )
+    @query_budget.budget(5)
+    async def end_follow_many(
+        session: SessionDep,
+        follows: schemas.UserIdsIn,
+        api_key: Annotated[str | None, Header()] = None,
+    ) -> dict:
+        """
+        <h1>
+        Перестать следить сразу за несколькими.
+        </h1>
+        Одна транзакция, итог по каждому id.
+        """
+        follower, err_dict = await models.User.get_by_api_key(session, api_key)
+        if follower is None:
+            return err_dict
+        user_ids, err_response = check_batch(follows.user_ids)
+        if err_response is not None:
+            return err_response
+        try:
+            removed = await models.UserUser.unfollow_many(
+                session, follower.id, user_ids
+            )
+            if removed and timeline.enabled():
+                await timeline.retract_follows(session, follower.id, list(removed))
+            await session.commit()
+        except Exception as err:
+            await session.rollback()
+            return util_func.get_err_dict("read below", str(err))
+        broadcast.hub.publish("rings.invalidate", follower.id)
+        broadcast.hub.publish("stream.follow", follower.id, list(removed), False)
+        broadcast.hub.publish("follow_graph.follow", follower.id, list(removed), False)
+        results = batch_results(
+            user_ids, removed, None, "", "Not following user with id: {}."
+        )
+        return {"result": True, "results": results}
+
     #       /API/TWEETS
     #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
     @app.post(
         "/api/tweets/",
         response_model=Union[schemas.TweetResultOut, schemas.ErrResultOut],
     )
+    @query_budget.budget(7)
     async def add_tweet(
-        api_key: Annotated[str | None, Header()] = None, tweet: schemas.TweetIn = None
+        session: SessionDep,
+        api_key: Annotated[str | None, Header()] = None,
+        tweet: schemas.TweetIn = None,
     ) -> dict:
         """
         <h1>
         Добавить твит.
         </h1>
         """
-        user, err_dict = await models.User.get_by_api_key(api_key)
+        user, err_dict = await models.User.get_by_api_key(session, api_key)
         if user is None:
             return err_dict
         try:
-            tweet_record = models.Tweet(content=tweet.tweet_data)
-            tweet_record.author = user
+            tweet_record = models.Tweet(content=tweet.tweet_data, author_id=user.id)
 
             session.add(tweet_record)
             await session.flush()
@@ -175,16 +596,22 @@ def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAP
                     .where(models.Picture.id.in_(tweet.tweet_media_ids))
                     .values(tweet_id=tweet_id)
                 )
+            timeline_ids = []
+            if timeline.enabled():
+                timeline_ids = await timeline.fan_out_tweet(session, tweet_id, user.id)
+            await models.User.touch(session, [user.id])
             await session.commit()
 
         except Exception as err:
             await session.rollback()
-            await logger.info(f"---===EXCEPTION ON ADD TWEET===---")
+            logger.exception("---===EXCEPTION ON ADD TWEET===---")
             return {
                 "result": False,
                 "error_type": "read below",
                 "error_message": str(err),
             }
+        broadcast.hub.publish("rings.push", timeline_ids, tweet_id)
+        broadcast.hub.publish("stream.tweet", user.id, tweet_id)
         return {"result": True, "tweet_id": tweet_id}
 
     #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
@@ -192,21 +619,29 @@ def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAP
         "/api/tweets/{tweet_id}",
         response_model=Union[schemas.ResultOut, schemas.ErrResultOut],
     )
+    @query_budget.budget(12)
     async def delete_tweet(
-        api_key: Annotated[str | None, Header()] = None, tweet_id: int = 0
+        session: SessionDep,
+        api_key: Annotated[str | None, Header()] = None,
+        tweet_id: int = 0,
     ) -> dict:
         """
         <h1>
         Удалить твит.
         </h1>
         """
-        user, err_dict = await models.User.get_by_api_key(api_key)
+        user, err_dict = await models.User.get_by_api_key(session, api_key)
         if user is None:
             return err_dict
         author_id = user.id
         try:
             res = await session.execute(
-                select(models.Tweet).where(
+                select(models.Tweet)
+                .options(
+                    selectinload(models.Tweet.pictures),
+                    selectinload(models.Tweet.like_as_user_tweet_ass),
+                )
+                .where(
                     and_(
                         models.Tweet.id == tweet_id, models.Tweet.author_id == author_id
                     )
@@ -222,16 +657,26 @@ def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAP
                     ),
                 )
 
+            timeline_ids = []
+            if timeline.enabled():
+                timeline_ids = await timeline.retract_tweet(session, tweet_id)
+            await models.Media.release(
+                session, [picture.media_id for picture in tweet.pictures]
+            )
+            await popular.discard_scores(session, [tweet_id])
             await session.delete(tweet)
+            await models.User.touch(session, [author_id])
             await session.commit()
         except Exception as err:
             await session.rollback()
-            await logger.info(f"---===EXCEPTION ON ADD TWEET===---")
+            logger.exception("---===EXCEPTION ON DELETE TWEET===---")
             return {
                 "result": False,
                 "error_type": "read below",
                 "error_message": str(err),
             }
+        broadcast.hub.publish("rings.retract", timeline_ids, tweet_id)
+        broadcast.hub.publish("popular.discard", tweet_id)
         return {"result": True, "tweet_id": tweet_id}
 
     #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
@@ -239,44 +684,202 @@ def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAP
         "/api/tweets/",
         response_model=Union[schemas.TweetResultListOut, schemas.ErrResultOut],
     )
+    @query_budget.budget(7)
     async def get_all_tweets_by_api_key(
+        session: ReadSessionDep,
+        response: Response,
         api_key: Annotated[str | None, Header()] = None,
+        if_none_match: Annotated[str | None, Header()] = None,
+        limit: Annotated[
+            int, Query(ge=1, le=config.FEED_MAX_LIMIT)
+        ] = config.FEED_DEFAULT_LIMIT,
+        cursor: Optional[str] = None,
     ) -> dict:
         """
         <h1>
-        Получить все твиты пользователя.<br>
-        И все твиты пользователей за твитами которых он поглядывает.
-        </p>
+        Получить твиты пользователя.<br>
+        И твиты пользователей за твитами которых он поглядывает.
+        </h1>
+        Постранично, от новых к старым. Для следующей страницы
+        передать cursor = next_cursor из предыдущего ответа.<br>
+        Отдает ETag, с If-None-Match без изменений - 304
+        (проверка - один запрос, до чтения самой ленты).
         """
-        user, err_dict = await models.User.get_by_api_key(api_key)
+        user, err_dict = await models.User.get_by_api_key(session, api_key)
         if user is None:
             return err_dict
         try:
-            own_id = user.id
-            res = await session.execute(
-                select(models.Tweet).filter(models.Tweet.author_id == own_id)
-            )
-            own_tweets = list(res.scalars())
-
-            res = await session.execute(
-                select(models.Tweet)
-                .join(models.User, models.User.id == models.Tweet.author_id)
-                .join(models.UserUser, models.UserUser.follow_to_id == models.User.id)
-                .filter(models.UserUser.id == own_id)
-            )
-            tweets: List[models.Tweet] = list(res.scalars())
-            tweets.extend(own_tweets)
-            for t in tweets:
-                t.get_attach_from_pic()
+            before_id = util_func.decode_cursor(cursor)
+        except ValueError as err:
+            return util_func.get_err_JSONRes(400, "bad request", str(err))
+        headers = {}
+        etag = await etags.feed_etag(session, user.id, limit, before_id)
+        if etag is not None:
+            headers = {"ETag": etag, "Cache-Control": etags.CACHE_CONTROL}
+            if etags.matches(if_none_match, etag):
+                return Response(status_code=304, headers=headers)
+            response.headers.update(headers)
+        try:
+            if timeline.enabled():
+                tweet_ids = await timeline.load_page_ids(
+                    session, user.id, limit, before_id
+                )
+                tweets = await projections.load_tweets_by_ids(session, tweet_ids)
+            else:
+                tweets = await projections.load_feed_page(
+                    session, user.id, limit, before_id
+                )
 
         except Exception as err:
-            await logger.info(f"---===EXCEPTION ON TWEETS LIST===---")
+            logger.exception("---===EXCEPTION ON TWEETS LIST===---")
             return {
                 "result": False,
                 "error_type": "read below",
                 "error_message": str(err),
             }
-        return {"result": True, "tweets": tweets}
+        next_cursor = None
+        if len(tweets) == limit:
+            next_cursor = util_func.encode_cursor(tweets[-1].id)
+        return tweet_list_response(tweets, next_cursor, headers)
+
+    #       /API/TWEETS/    SEARCH
+    #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+    @app.get(
+        "/api/tweets/search",
+        response_model=Union[schemas.TweetResultListOut, schemas.ErrResultOut],
+    )
+    @query_budget.budget(4)
+    async def search_tweets(
+        session: ReadSessionDep,
+        q: Annotated[str, Query(min_length=1, max_length=config.SEARCH_MAX_QUERY)],
+        limit: Annotated[
+            int, Query(ge=1, le=config.FEED_MAX_LIMIT)
+        ] = config.FEED_DEFAULT_LIMIT,
+        cursor: Optional[str] = None,
+    ) -> dict:
+        """
+        <h1>
+        Поиск твитов по словам.
+        </h1>
+        Твиты, где есть все слова q, самые подходящие первыми.
+        Для следующей страницы передать cursor = next_cursor.
+        """
+        words = search.terms(q)
+        if not words:
+            return util_func.get_err_JSONRes(
+                400, "bad request", "Query has no words to search for."
+            )
+        try:
+            after = util_func.decode_score_cursor(cursor, "s")
+        except ValueError as err:
+            return util_func.get_err_JSONRes(400, "bad request", str(err))
+        found = await search.search_ids(session, words, limit, after)
+        tweets = await projections.load_tweets_by_ids(
+            session, [tweet_id for tweet_id, _ in found]
+        )
+        next_cursor = None
+        if len(found) == limit:
+            next_cursor = util_func.encode_score_cursor(found[-1][1], found[-1][0], "s")
+        return tweet_list_response(tweets, next_cursor)
+
+    #       /API/TWEETS/    POPULAR
+    #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+    @app.get(
+        "/api/tweets/popular",
+        response_model=Union[schemas.TweetResultListOut, schemas.ErrResultOut],
+    )
+    @query_budget.budget(4)
+    async def popular_tweets(
+        session: ReadSessionDep,
+        limit: Annotated[
+            int, Query(ge=1, le=config.FEED_MAX_LIMIT)
+        ] = config.FEED_DEFAULT_LIMIT,
+        cursor: Optional[str] = None,
+    ) -> dict:
+        """
+        <h1>
+        Популярные твиты.
+        </h1>
+        Больше недавних лайков - выше. Для следующей страницы
+        передать cursor = next_cursor.
+        """
+        if not popular.enabled():
+            return util_func.get_err_JSONRes(
+                404, "not found", "Popular tweets are disabled."
+            )
+        try:
+            after = util_func.decode_score_cursor(cursor, "p")
+        except ValueError as err:
+            return util_func.get_err_JSONRes(400, "bad request", str(err))
+        found = await popular.load_page(session, limit, after)
+        tweets = await projections.load_tweets_by_ids(
+            session, [tweet_id for tweet_id, _ in found]
+        )
+        next_cursor = None
+        if len(found) == limit:
+            next_cursor = util_func.encode_score_cursor(found[-1][1], found[-1][0], "p")
+        return tweet_list_response(tweets, next_cursor)
+
+    #       /API/TWEETS/    STREAM
+    #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+    @app.get("/api/tweets/stream", response_model=None)
+    @query_budget.budget(3)
+    async def stream_tweets(
+        api_key: Annotated[str | None, Header()] = None,
+        last_event_id: Annotated[str | None, Header()] = None,
+    ) -> Union[dict, Response]:
+        """
+        <h1>
+        Новые твиты ленты по мере публикации (Server-Sent Events).
+        </h1>
+        Событие tweet: id - id твита, data - {"tweet_id", "author_id"}.<br>
+        С Last-Event-ID сначала приходят пропущенные твиты, а если их
+        слишком много - событие reset (перечитать ленту). Твиты
+        незадолго до Last-Event-ID могут прийти повторно: порядок id
+        не гарантирован, клиент отбрасывает уже виденные.
+        """
+        try:
+            last_id = stream.parse_last_event_id(last_event_id)
+        except ValueError as err:
+            return util_func.get_err_JSONRes(400, "bad request", str(err))
+        # Основная база, не реплика: на ней уже есть все твиты,
+        # разосланные до подписки. Сессия закрывается до начала потока.
+        async with router.primary() as session:
+            user, err_dict = await models.User.get_by_api_key(session, api_key)
+            if user is None:
+                return err_dict
+            authors = await stream.feed_authors(session, user.id)
+            # Подписка - до чтения пропущенного: иначе твиты между
+            # чтением и подпиской потерялись бы.
+            sub = stream.streams.subscribe(user.id, authors)
+            if sub is None:
+                response = util_func.get_err_JSONRes(
+                    503, "overloaded", "Too many stream subscribers, retry later."
+                )
+                response.headers["Retry-After"] = str(config.SHED_RETRY_AFTER)
+                return response
+            backlog = []
+            try:
+                if last_id is not None:
+                    backlog = await stream.missed(
+                        session,
+                        authors,
+                        last_id,
+                        config.STREAM_RESUME_LIMIT,
+                        config.STREAM_RESUME_WINDOW,
+                    )
+            except Exception:
+                stream.streams.unsubscribe(sub)
+                raise
+        return StreamingResponse(
+            stream.events(
+                sub, backlog, config.STREAM_HEARTBEAT, config.STREAM_MAX_DURATION
+            ),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            # И при обрыве до первого события.
+            background=BackgroundTask(stream.streams.unsubscribe, sub),
+        )
 
     #       /API/TWEETS/    LIKES
     #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
@@ -284,41 +887,42 @@ def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAP
         "/api/tweets/{tweet_id}/likes",
         response_model=Union[schemas.ResultOut, schemas.ErrResultOut],
     )
+    @query_budget.budget(6)
     async def add_like_to_tweet(
-        api_key: Annotated[str | None, Header()] = None, tweet_id: int = 0
+        session: SessionDep,
+        api_key: Annotated[str | None, Header()] = None,
+        tweet_id: int = 0,
     ) -> dict:
         """
         <h1>
         Выразить своё согласие с написанным.
         </h1>
         """
-        user, err_dict = await models.User.get_by_api_key(api_key)
+        user, err_dict = await models.User.get_by_api_key(session, api_key)
         if user is None:
             return err_dict
 
-        res = await session.execute(
-            select(models.Tweet)
-            .join(models.Like, models.Like.tweet_id == models.Tweet.id)
-            .where(models.Tweet.id == tweet_id)
-        )
-        tweet: models.Tweet = res.scalar()
+        tweet = await session.get(models.Tweet, tweet_id)
         if tweet is None:
-            tweet = await session.get(models.Tweet, tweet_id)
-            if tweet is None:
-                return util_func.get_err_dict(
-                    "not found", f"Tweet with id: {tweet_id} doesn't exist."
-                )
+            return util_func.get_err_dict(
+                "not found", f"Tweet with id: {tweet_id} doesn't exist."
+            )
         try:
-            tweet.likes.append(user)
+            await models.Like.add(session, user.id, tweet.id)
+            scores = []
+            if popular.enabled():
+                scores = await popular.record_likes(session, [tweet.id])
             await session.commit()
         except Exception as err:
             await session.rollback()
-            await logger.info(f"---===EXCEPTION ON LIKE ADD===---")
+            logger.exception("---===EXCEPTION ON LIKE ADD===---")
             return {
                 "result": False,
                 "error_type": "read below",
                 "error_message": str(err),
             }
+        if scores:
+            broadcast.hub.publish("popular.offer", scores)
         return {"result": True}
 
     #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
@@ -326,48 +930,150 @@ def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAP
         "/api/tweets/{tweet_id}/likes",
         response_model=Union[schemas.ResultOut, schemas.ErrResultOut],
     )
+    @query_budget.budget(5)
     async def delete_like_from_tweet(
-        api_key: Annotated[str | None, Header()] = None, tweet_id: int = 0
+        session: SessionDep,
+        api_key: Annotated[str | None, Header()] = None,
+        tweet_id: int = 0,
     ) -> dict:
         """
         <h1>
         Опомниться и отозвать своё согласие с написанным.
         </h1>
         """
-        user, err_dict = await models.User.get_by_api_key(api_key)
+        user, err_dict = await models.User.get_by_api_key(session, api_key)
         if user is None:
             return err_dict
-        user_id = user.id
-        res = await session.execute(
-            select(models.Like).where(
-                and_(models.Tweet.id == tweet_id, models.Like.user_id == user_id)
-            )
-        )
-        like_record: models.Tweet = res.scalar()
-        if like_record is None:
-            return util_func.get_err_dict(
-                "not found",
-                f"Like record with api: {api_key} and ip: {tweet_id} doesn't exist.",
-            )
         try:
-            await session.delete(like_record)
+            liked_at = await models.Like.remove(session, user.id, tweet_id)
+            if liked_at is None:
+                return util_func.get_err_dict(
+                    "not found",
+                    f"Like record with api: {api_key} and ip: {tweet_id} doesn't exist.",
+                )
+            scores = []
+            if popular.enabled():
+                scores = await popular.retract_likes(session, {tweet_id: liked_at})
             await session.commit()
         except Exception as err:
-            await logger.info(f"---===EXCEPTION ON LIKE DELETE===---")
+            logger.exception("---===EXCEPTION ON LIKE DELETE===---")
             await session.rollback()
             return util_func.get_err_dict("read below", str(err))
+        if scores:
+            broadcast.hub.publish("popular.offer", scores)
         return {"result": True}
 
+    #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+    @app.post(
+        "/api/tweets/likes/",
+        response_model=Union[schemas.BatchResultOut, schemas.ErrResultOut],
+    )
+    @query_budget.budget(6)
+    async def add_likes(
+        session: SessionDep,
+        likes: schemas.TweetIdsIn,
+        api_key: Annotated[str | None, Header()] = None,
+    ) -> dict:
+        """
+        <h1>
+        Согласиться сразу с несколькими твитами.
+        </h1>
+        Одна транзакция, итог по каждому id.
+        """
+        user, err_dict = await models.User.get_by_api_key(session, api_key)
+        if user is None:
+            return err_dict
+        tweet_ids, err_response = check_batch(likes.tweet_ids)
+        if err_response is not None:
+            return err_response
+        try:
+            found, added = await models.Like.add_many(session, user.id, tweet_ids)
+            scores = []
+            if popular.enabled():
+                scores = await popular.record_likes(session, sorted(added))
+            await session.commit()
+        except Exception as err:
+            await session.rollback()
+            logger.exception("---===EXCEPTION ON LIKES ADD===---")
+            return util_func.get_err_dict("read below", str(err))
+        if scores:
+            broadcast.hub.publish("popular.offer", scores)
+        results = batch_results(
+            tweet_ids,
+            added,
+            found,
+            "Tweet with id: {} is already liked.",
+            "Tweet with id: {} doesn't exist.",
+        )
+        return {"result": True, "results": results}
+
+    #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+    @app.delete(
+        "/api/tweets/likes/",
+        response_model=Union[schemas.BatchResultOut, schemas.ErrResultOut],
+    )
+    @query_budget.budget(5)
+    async def delete_likes(
+        session: SessionDep,
+        likes: schemas.TweetIdsIn,
+        api_key: Annotated[str | None, Header()] = None,
+    ) -> dict:
+        """
+        <h1>
+        Отозвать согласие сразу с несколькими твитами.
+        </h1>
+        Одна транзакция, итог по каждому id.
+        """
+        user, err_dict = await models.User.get_by_api_key(session, api_key)
+        if user is None:
+            return err_dict
+        tweet_ids, err_response = check_batch(likes.tweet_ids)
+        if err_response is not None:
+            return err_response
+        try:
+            removed = await models.Like.remove_many(session, user.id, tweet_ids)
+            scores = []
+            if popular.enabled() and removed:
+                scores = await popular.retract_likes(session, removed)
+            await session.commit()
+        except Exception as err:
+            await session.rollback()
+            logger.exception("---===EXCEPTION ON LIKES DELETE===---")
+            return util_func.get_err_dict("read below", str(err))
+        if scores:
+            broadcast.hub.publish("popular.offer", scores)
+        results = batch_results(
+            tweet_ids, removed, None, "", "Like of tweet with id: {} doesn't exist."
+        )
+        return {"result": True, "results": results}
+
     #       /API/MEDIAS
     #   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
 
     @app.post(
         "/api/medias/",
         response_model=Union[schemas.MediaResultOut, schemas.ErrResultOut],
+        # Тело читает media_store.receive_upload, не FastAPI - описание формы.
+        openapi_extra={
+            "requestBody": {
+                "content": {
+                    "multipart/form-data": {
+                        "schema": {
+                            "type": "object",
+                            "properties": {
+                                "file": {"type": "string", "format": "binary"}
+                            },
+                        }
+                    }
+                }
+            }
+        },
     )
+    @query_budget.budget(3)
     async def get_image_from_form(
+        session: SessionDep,
+        request: Request,
         api_key: Annotated[str, Header()] = None,
-        file: UploadFile | None = None,
     ) -> dict:
         """
         <h2>
@@ -377,37 +1083,45 @@ def create_app(session: Session, lifespan: Generator[None, Any, None]) -> FastAP
         фронт предоставит id которые надо связать с этим запросом.
 
         """
-        file_dir = os.path.join(IMG_PATH, api_key)
-        try:
-            os.makedirs(file_dir)
-        except FileExistsError:
-            # directory already exists
-            pass
-
+        user, err_dict = await models.User.get_by_api_key(session, api_key)
+        if user is None:
+            return err_dict
+        stored = None
         try:
-            if file is None:
-                await logger.info("---=== FILE IS NONE ===---")
+            stored, file_name = await media_store.receive_upload(request)
+            if stored is None:
+                logger.warning("---=== FILE IS NONE ===---")
                 return util_func.get_err_dict("???", "File is None")
-            file_name = file.filename
-            await logger.info(f"---=== new_pic_id: { file_name } ===---")
+            logger.info(f"---=== new_pic_id: { file_name } ===---")
 
-            prefix = str(random.randint(1, 99999))
-            file_path = os.path.join(file_dir, "".join([prefix, "_", file_name]))
+            media = await media_store.add_reference(session, stored)
+            # Путь - из записи: то же содержимое могло лечь и под другим
+            # расширением.
+            await media_store.place(stored, media.file_path)
 
             res = await session.execute(
                 insert(models.Picture)
-                .values(file_path=file_path, tweet_id=0)
-                .returning(models.Picture)
+                .values(file_path=media.file_path, media_id=media.id, tweet_id=0)
+                .returning(models.Picture.id)
             )
-            new_picture = res.scalar()
-            media_id = new_picture.id
-
-            await util_func.save_file(file, file_path)
+            media_id = res.scalar()
+            await session.commit()
+            if media.feed_path is None:
+                # Уменьшенные копии - в фоне, ответ их не ждет (и места
+                # в очереди тоже - не поместившееся подберет обход).
+                pipeline.submit(
+                    derivatives.Job(media.id, media.file_path, media.content_hash)
+                )
 
+        except media_store.TooLarge as err:
+            return util_func.get_err_JSONRes(413, "payload too large", str(err))
         except Exception as err:
             await session.rollback()
-            await logger.info("---===EXCEPTION MEDIA RECIEVE===---")
+            logger.exception("---===EXCEPTION MEDIA RECIEVE===---")
             return util_func.get_err_dict("read below", str(err))
+        finally:
+            if stored is not None:
+                await media_store.discard(stored)
         return {"result": True, "media_id": media_id}
 
     return app
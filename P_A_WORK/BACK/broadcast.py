@@ -0,0 +1,221 @@
+"""
+Согласование кэшей в памяти между рабочими процессами.<br>
+Кэш регистрирует операции (register), изменяющий его код вызывает
+publish: операция применяется у себя и рассылается остальным процессам.
+Получатель применяет ее к своему кэшу. Доставка - без гарантий:
+потерянное сообщение означает устаревшую запись до ее TTL / вытеснения,
+поэтому рассылаются только сбросы и дописывания, не сами данные.<br>
+BROADCAST_BACKEND: "local" - один процесс, ничего не рассылается;
+"unix" - датаграммы через Unix-сокеты в RUN_DIR (процессы одной машины,
+--workers); "postgres" - LISTEN/NOTIFY (процессы на разных машинах).
+"""
+
+import asyncio
+import json
+import os
+import socket
+import uuid
+from typing import Callable, Dict, Optional
+
+from sqlalchemy.engine import make_url
+
+import BACK.config as config
+import BACK.metrics as metrics
+
+# Больше - вместо операции рассылается ее грубая замена (coarse).
+UNIX_MAX_DATAGRAM = 64 * 1024
+# Предел payload у NOTIFY - 8000 байт.
+POSTGRES_MAX_PAYLOAD = 7900
+
+
+class UnixSocketTransport:
+    """
+    Каждый процесс слушает свой датаграммный сокет RUN_DIR/<pid>.sock,
+    отправка - во все остальные сокеты каталога.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        on_message: Callable[[bytes], None],
+        name: Optional[str] = None,
+    ):
+        self.directory = directory
+        self.path = os.path.join(directory, f"{name or os.getpid()}.sock")
+        self.on_message = on_message
+        self._sock: Optional[socket.socket] = None
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self._sock.fileno(), self._read)
+
+    def _read(self):
+        while True:
+            try:
+                payload = self._sock.recv(UNIX_MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.on_message(payload)
+
+    def send(self, payload: bytes) -> bool:
+        """
+        False - сообщение слишком велико и не отправлено.
+        """
+        if len(payload) > UNIX_MAX_DATAGRAM:
+            return False
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".sock") or entry.path == self.path:
+                continue
+            try:
+                self._sock.sendto(payload, entry.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Сокет завершившегося процесса.
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+            except OSError:
+                # Очередь получателя полна (EAGAIN) и прочее - сообщение теряется.
+                metrics.registry.broadcast.inc(("dropped",))
+        return True
+
+    async def stop(self):
+        if self._sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class PostgresTransport:
+    """
+    LISTEN/NOTIFY на отдельном соединении asyncpg (не из пула приложения).
+    Свои же сообщения тоже приходят - их отбрасывает Hub по origin.
+    """
+
+    def __init__(self, url: str, channel: str, on_message: Callable[[bytes], None]):
+        self.dsn = (
+            make_url(url)
+            .set(drivername="postgresql")
+            .render_as_string(hide_password=False)
+        )
+        self.channel = channel
+        self.on_message = on_message
+        self._conn = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._sender: Optional[asyncio.Task] = None
+
+    async def start(self):
+        import asyncpg
+
+        self._conn = await asyncpg.connect(self.dsn)
+        await self._conn.add_listener(self.channel, self._notified)
+        self._queue = asyncio.Queue()
+        self._sender = asyncio.create_task(self._send_loop())
+
+    def _notified(self, connection, pid, channel, payload: str):
+        self.on_message(payload.encode())
+
+    def send(self, payload: bytes) -> bool:
+        if len(payload) > POSTGRES_MAX_PAYLOAD:
+            return False
+        self._queue.put_nowait(payload.decode())
+        return True
+
+    async def _send_loop(self):
+        while True:
+            payload = await self._queue.get()
+            try:
+                await self._conn.execute(
+                    "SELECT pg_notify($1, $2)", self.channel, payload
+                )
+            except Exception:
+                metrics.registry.broadcast.inc(("dropped",))
+
+    async def stop(self):
+        if self._sender is not None:
+            self._sender.cancel()
+            await asyncio.gather(self._sender, return_exceptions=True)
+            self._sender = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+class Hub:
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self._handlers: Dict[str, Callable] = {}
+        self._coarse: Dict[str, str] = {}
+        self._transport = None
+
+    def register(self, op: str, handler: Callable, coarse: Optional[str] = None):
+        """
+        coarse - операция без аргументов, которую разослать вместо op,
+        если сообщение не помещается (например, сброс всего кэша).
+        """
+        self._handlers[op] = handler
+        if coarse is not None:
+            self._coarse[op] = coarse
+
+    def publish(self, op: str, *args):
+        """
+        Применить у себя и разослать остальным. Можно звать из синхронного кода.
+        """
+        self._handlers[op](*args)
+        if self._transport is None:
+            return
+        if not self._transport.send(self._encode(op, args)):
+            coarse = self._coarse.get(op)
+            if coarse is None:
+                metrics.registry.broadcast.inc(("dropped",))
+                return
+            self._transport.send(self._encode(coarse, ()))
+        metrics.registry.broadcast.inc(("sent",))
+
+    def _encode(self, op: str, args: tuple) -> bytes:
+        return json.dumps({"origin": self.origin, "op": op, "args": args}).encode()
+
+    def deliver(self, payload: bytes):
+        message = json.loads(payload)
+        if message["origin"] == self.origin:
+            return
+        handler = self._handlers.get(message["op"])
+        if handler is not None:
+            handler(*message["args"])
+            metrics.registry.broadcast.inc(("received",))
+
+    async def start(self, backend: str, name: Optional[str] = None):
+        """
+        name - имя сокета процесса для "unix", по умолчанию pid.
+        """
+        # Уникален для процесса, даже если модуль импортирован до fork.
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        if backend == "unix":
+            self._transport = UnixSocketTransport(config.RUN_DIR, self.deliver, name)
+        elif backend == "postgres":
+            self._transport = PostgresTransport(
+                config.DATABASE_URL, config.BROADCAST_CHANNEL, self.deliver
+            )
+        elif backend == "local":
+            return
+        else:
+            raise ValueError(f"Unknown broadcast backend: '{backend}'.")
+        await self._transport.start()
+
+    async def stop(self):
+        if self._transport is not None:
+            await self._transport.stop()
+            self._transport = None
+
+
+hub = Hub()
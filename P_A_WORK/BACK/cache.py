@@ -0,0 +1,86 @@
+"""
+Кэши в памяти процесса.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, NamedTuple, Optional, Set
+
+
+class TTLCache:
+    """
+    Ограниченный LRU-кэш с временем жизни записей.<br>
+    Записи можно пометить тегом (tag) и сбросить все записи тега разом.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._timer = timer
+        self._data: "OrderedDict[Hashable, tuple[float, Any, Hashable]]" = OrderedDict()
+        self._tags: Dict[Hashable, Set[Hashable]] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires_at, value, _ = item
+        if expires_at <= self._timer():
+            self._pop(key)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, tag: Hashable = None):
+        self._pop(key)
+        self._data[key] = (self._timer() + self.ttl, value, tag)
+        if tag is not None:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self._pop(next(iter(self._data)))
+
+    def invalidate(self, key: Hashable):
+        self._pop(key)
+
+    def invalidate_tag(self, tag: Hashable):
+        for key in self._tags.pop(tag, ()):
+            self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+        self._tags.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+    def _pop(self, key: Hashable):
+        item = self._data.pop(key, None)
+        if item is None or item[2] is None:
+            return
+        keys = self._tags.get(item[2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._tags[item[2]]
+
+
+class AuthUser(NamedTuple):
+    """
+    Всё, что обработчикам нужно знать о пользователе после проверки ключа.
+    """
+
+    id: int
+    name: str
@@ -0,0 +1,193 @@
+"""
+Служебные команды, запуск из папки проекта:<br>
+python -m BACK.commands migrate [--target N]<br>
+python -m BACK.commands seed<br>
+python -m BACK.commands rebuild-timelines [--user-id ID]<br>
+python -m BACK.commands rebuild-popular<br>
+python -m BACK.commands recount<br>
+python -m BACK.commands reap<br>
+rebuild-timelines и rebuild-popular сбрасывают кэши работающего
+приложения через broadcast; с BROADCAST_BACKEND "local" сброс до него
+не доходит - приложение нужно перезапустить.
+"""
+
+import argparse
+import asyncio
+import sys
+from typing import List, Optional
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+import BACK.broadcast as broadcast
+import BACK.config as config
+import BACK.logs as logs
+import BACK.migrations as migrations
+import BACK.models as models
+import BACK.popular as popular
+import BACK.reaper as reaper
+import BACK.timeline as timeline
+
+
+async def migrate(engine: AsyncEngine, target: Optional[int] = None) -> List[int]:
+    """
+    Миграции схемы до последней версии (или до target).
+    """
+    applied = await migrations.upgrade(engine, target)
+    print(
+        f"applied: {applied}, schema version: {await migrations.current_version(engine)}"
+    )
+    return applied
+
+
+# Служебный пользователь 0 и твит 0 (к твиту 0 привязаны еще не
+# опубликованные картинки) и пара тестовых пользователей для фронта.
+SEED = (
+    (models.User, {"id": 0, "api_key": "None", "name": "None"}, ["id"]),
+    (models.User, {"id": 1, "api_key": "test", "name": "Test User"}, ["id"]),
+    (models.User, {"id": 2, "api_key": "test2", "name": "Test User2"}, ["id"]),
+    (models.UserUser, {"id": 1, "follow_to_id": 2}, ["id", "follow_to_id"]),
+    (models.Tweet, {"id": 0, "content": "None", "author_id": 0}, ["id"]),
+)
+
+
+async def seed(session_maker: async_sessionmaker[AsyncSession]) -> int:
+    """
+    Начальные записи, если их еще нет. Возвращает число добавленных.
+    """
+    added = 0
+    async with session_maker() as session:
+        for model, values, index_elements in SEED:
+            res = await session.execute(
+                insert(model)
+                .values(**values)
+                .on_conflict_do_nothing(index_elements=index_elements)
+            )
+            added += res.rowcount
+        if added:
+            await models.recount_counters(session)
+        await session.commit()
+    return added
+
+
+async def rebuild_timelines(
+    session_maker: async_sessionmaker[AsyncSession], user_id: Optional[int] = None
+):
+    """
+    Пересборка материализованных лент (timeline_entries).
+    """
+    async with session_maker() as session:
+        await timeline.rebuild(session, user_id)
+        await session.commit()
+    # Из отдельного процесса (main) - и в кольцах процессов приложения.
+    if user_id is None:
+        broadcast.hub.publish("rings.clear")
+    else:
+        broadcast.hub.publish("rings.invalidate", user_id)
+
+
+async def rebuild_popular(session_maker: async_sessionmaker[AsyncSession]) -> int:
+    """
+    Внеочередной пересчет оценок популярности (tweet_scores).
+    """
+    async with session_maker() as session:
+        count = await popular.rebuild(session)
+        await session.commit()
+    broadcast.hub.publish("popular.invalidate")
+    return count
+
+
+def warn_local_broadcast(command: str) -> bool:
+    """
+    Предупреждение, если сброс кэшей после command не дойдет до процессов
+    приложения (BROADCAST_BACKEND "local"). True - предупреждено.
+    """
+    if config.BROADCAST_BACKEND != "local":
+        return False
+    print(
+        f"{command}: BROADCAST_BACKEND is 'local', running app processes keep "
+        "their cached data - restart the app (or use 'unix' / 'postgres').",
+        file=sys.stderr,
+    )
+    return True
+
+
+async def recount(session_maker: async_sessionmaker[AsyncSession]):
+    """
+    Пересчет followers_count / following_count / likes_count.
+    """
+    async with session_maker() as session:
+        await models.recount_counters(session)
+        await session.commit()
+
+
+async def reap(session_maker: async_sessionmaker[AsyncSession]) -> reaper.ReapResult:
+    """
+    Внеочередной проход уборки картинок.
+    """
+    result = await reaper.reap(session_maker)
+    print(result._asdict())
+    return result
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m BACK.commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = commands.add_parser("migrate", help="обновить схему базы")
+    migrate_parser.add_argument("--target", type=int, default=None)
+
+    commands.add_parser("seed", help="добавить начальных пользователей")
+
+    rebuild = commands.add_parser(
+        "rebuild-timelines", help="пересобрать timeline_entries"
+    )
+    rebuild.add_argument("--user-id", type=int, default=None)
+
+    commands.add_parser("rebuild-popular", help="пересчитать оценки популярных твитов")
+
+    commands.add_parser("recount", help="пересчитать счетчики подписок и лайков")
+
+    commands.add_parser("reap", help="убрать брошенные картинки и файлы")
+
+    args = parser.parse_args(argv)
+
+    from BACK.database import async_session, engine
+
+    logs.configure()
+
+    async def run():
+        try:
+            if args.command == "migrate":
+                await migrate(engine, args.target)
+            elif args.command == "seed":
+                await seed(async_session)
+            elif args.command == "rebuild-timelines":
+                await broadcast.hub.start(config.BROADCAST_BACKEND)
+                try:
+                    await rebuild_timelines(async_session, args.user_id)
+                finally:
+                    await broadcast.hub.stop()
+                warn_local_broadcast(args.command)
+            elif args.command == "rebuild-popular":
+                await broadcast.hub.start(config.BROADCAST_BACKEND)
+                try:
+                    await rebuild_popular(async_session)
+                finally:
+                    await broadcast.hub.stop()
+                warn_local_broadcast(args.command)
+            elif args.command == "recount":
+                await recount(async_session)
+            elif args.command == "reap":
+                await reap(async_session)
+        finally:
+            await engine.dispose()
+
+    try:
+        asyncio.run(run())
+    finally:
+        logs.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+Уменьшенные копии картинок для ленты.<br>
+После загрузки (/api/medias/) файл ставится в ограниченную очередь,
+декодирование и пережатие идут в пуле процессов - не в event loop.
+Пути готовых копий записываются в media (feed_path, thumb_path),
+лента отдает feed_path, пока его нет - оригинал.<br>
+Загрузка очередь не ждет: не поместившееся (и не сделанное до
+перезапуска) раз в DERIVATIVE_SWEEP_INTERVAL подбирает обход media
+без копий (sweep).
+"""
+
+import asyncio
+import importlib.util
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+import BACK.config as config
+from BACK.logs import logger
+from BACK.models import Media, Picture, Tweet, User
+from BACK.process_lock import ProcessLock
+
+# Сколько не сделанных копий помнить, чтобы обход не ставил их снова.
+_MAX_FAILED_IDS = 10000
+
+# Вариант -> наибольшая сторона в пикселях.
+VARIANTS = {
+    "feed": config.DERIVATIVE_FEED_MAX_SIDE,
+    "thumb": config.DERIVATIVE_THUMB_MAX_SIDE,
+}
+
+
+def enabled() -> bool:
+    """
+    Копии делаются, если включены и установлен Pillow.
+    """
+    return config.DERIVATIVES_ENABLED and importlib.util.find_spec("PIL") is not None
+
+
+class Job(NamedTuple):
+    media_id: int
+    file_path: str
+    content_hash: str
+
+
+def variant_path(media_root: str, content_hash: str, variant: str) -> str:
+    return os.path.join(
+        media_root,
+        content_hash[:2],
+        content_hash[2:4],
+        f"{content_hash}_{variant}.webp",
+    )
+
+
+def make_variants(
+    src_path: str,
+    content_hash: str,
+    media_root: str,
+    variants: Dict[str, int],
+    quality: int,
+) -> Dict[str, str]:
+    """
+    Выполняется в процессе пула: декодирует оригинал и пишет по webp
+    на каждый вариант. Картинка меньше варианта не увеличивается.
+    """
+    from PIL import Image, ImageOps
+
+    result = {}
+    with Image.open(src_path) as original:
+        # JPEG умеет декодироваться сразу в уменьшенном виде.
+        biggest = max(variants.values())
+        original.draft("RGB", (biggest, biggest))
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ("RGB", "RGBA"):
+            transparent = "A" in image.getbands() or "transparency" in image.info
+            image = image.convert("RGBA" if transparent else "RGB")
+        for variant, max_side in sorted(
+            variants.items(), key=lambda item: item[1], reverse=True
+        ):
+            image.thumbnail((max_side, max_side))
+            path = variant_path(media_root, content_hash, variant)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            image.save(tmp_path, "WEBP", quality=quality, method=4)
+            os.replace(tmp_path, path)
+            result[variant] = path
+    return result
+
+
+class DerivativePipeline:
+    """
+    Очередь заданий + пул процессов.<br>
+    Одновременно в пуле не больше workers заданий, в очереди -
+    не больше queue_size. Если очередь полна, submit сразу отказывает:
+    пока картинку не подберет обход, лента отдает оригинал.
+    """
+
+    def __init__(
+        self,
+        session_maker: async_sessionmaker[AsyncSession],
+        workers: int,
+        queue_size: int,
+        sweep_interval: float = 0,
+    ):
+        self.session_maker = session_maker
+        self.workers = workers
+        self.queue_size = queue_size
+        self.sweep_interval = sweep_interval
+        self.done = 0
+        self.failed = 0
+        self.rejected = 0
+        self._queue: Optional[asyncio.Queue[Job]] = None
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks: List[asyncio.Task] = []
+        # media_id в очереди или в работе - второй раз не ставится.
+        self._pending: Set[int] = set()
+        self._failed_ids: Set[int] = set()
+        self._sweep_lock = ProcessLock("derivatives")
+
+    async def start(self):
+        """
+        Запуск обработчиков очереди. Сам пул процессов создается
+        при первом задании.
+        """
+        # Очередь привязывается к event loop, поэтому создается здесь.
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if self.sweep_interval > 0:
+            self._tasks.append(asyncio.create_task(self._sweep_periodically()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._pending.clear()
+        self._sweep_lock.release()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def submit(self, job: Job) -> bool:
+        """
+        Поставить задание, не дожидаясь места. False - не поставлено:
+        очередь полна, копии отключены или это media уже в очереди.
+        """
+        if not self._tasks or job.media_id in self._pending:
+            return False
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logger.warning(f"---=== DERIVATIVES QUEUE FULL: {job.media_id} ===---")
+            return False
+        self._pending.add(job.media_id)
+        return True
+
+    async def sweep(self) -> int:
+        """
+        Ставит в очередь media без копий (сколько в ней свободно).
+        Возвращает, сколько поставлено.
+        """
+        if not self._tasks:
+            return 0
+        free = self.queue_size - self._queue.qsize()
+        if free <= 0:
+            return 0
+        skip = self._pending | self._failed_ids
+        async with self.session_maker() as session:
+            res = await session.execute(
+                select(Media.id, Media.file_path, Media.content_hash)
+                .where(Media.feed_path.is_(None), Media.ref_count > 0)
+                .order_by(Media.id)
+                .limit(free + len(skip))
+            )
+            rows = [row for row in res if row.id not in skip][:free]
+        return sum(self.submit(Job(*row)) for row in rows)
+
+    async def _sweep_periodically(self):
+        # Из нескольких рабочих процессов обходит один.
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            if not self._sweep_lock.try_acquire():
+                continue
+            try:
+                queued = await self.sweep()
+            except Exception:
+                logger.exception("---=== DERIVATIVES SWEEP FAILED ===---")
+                continue
+            if queued:
+                logger.info(f"---=== DERIVATIVES SWEEP: {queued} queued ===---")
+
+    async def join(self):
+        """
+        Дождаться обработки всего, что уже в очереди.
+        """
+        if self._queue is not None:
+            await self._queue.join()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            try:
+                paths = await loop.run_in_executor(
+                    self._get_executor(),
+                    make_variants,
+                    job.file_path,
+                    job.content_hash,
+                    config.MEDIA_ROOT,
+                    VARIANTS,
+                    config.DERIVATIVE_QUALITY,
+                )
+                async with self.session_maker() as session:
+                    await session.execute(
+                        update(Media)
+                        .where(Media.id == job.media_id)
+                        .values(feed_path=paths["feed"], thumb_path=paths["thumb"])
+                    )
+                    # Путь картинки в ленте поменялся - сбросить ETag лент.
+                    await User.touch(
+                        session,
+                        select(Tweet.author_id)
+                        .join(Picture, Picture.tweet_id == Tweet.id)
+                        .where(Picture.media_id == job.media_id),
+                    )
+                    await session.commit()
+                self.done += 1
+            except Exception:
+                self.failed += 1
+                if len(self._failed_ids) >= _MAX_FAILED_IDS:
+                    self._failed_ids.clear()
+                self._failed_ids.add(job.media_id)
+                logger.exception(f"---=== DERIVATIVES FAILED: {job.media_id} ===---")
+            finally:
+                self._pending.discard(job.media_id)
+                self._queue.task_done()
@@ -0,0 +1,80 @@
+"""
+ETag и условные GET (If-None-Match -> 304) для ленты и профиля.<br>
+ETag строится из users.version, а не из ответа: версии считает база
+(User.touch, UserUser._shift_counters), поэтому ETag одинаков во всех
+процессах приложения. Проверка - один запрос, до запросов самой ленты.<br>
+Лента пользователя меняется только от событий его самого (подписки)
+и тех, за кем он следит (твиты, лайки их твитов). Пока набор подписок
+прежний, сумма версий авторов лишь растет; набор меняется только вместе
+с версией самого пользователя. Пара (своя версия, сумма версий авторов)
+поэтому меняется при любом изменении ленты.
+"""
+
+import hashlib
+from typing import Optional
+
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+
+from BACK.models import User, UserUser
+
+# Меняется вместе с форматом ответа - чтобы старые ETag не подошли.
+FORMAT_VERSION = "1"
+
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(kind: str, *parts) -> str:
+    raw = ":".join(str(part) for part in (FORMAT_VERSION, kind) + parts)
+    return 'W/"' + hashlib.sha1(raw.encode()).hexdigest()[:20] + '"'
+
+
+def matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Подходит ли ETag под заголовок If-None-Match (список или *).
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Слабое сравнение: W/ не учитывается.
+    bare = etag.removeprefix("W/")
+    return any(
+        candidate.strip().removeprefix("W/") == bare
+        for candidate in if_none_match.split(",")
+    )
+
+
+async def feed_etag(session: AsyncSession, user_id: int, *params) -> Optional[str]:
+    """
+    ETag ленты пользователя для параметров запроса params (limit, cursor).<br>
+    None - пользователя нет.
+    """
+    author = aliased(User)
+    followed_versions = (
+        select(func.coalesce(func.sum(author.version), 0))
+        .join(UserUser, UserUser.follow_to_id == author.id)
+        .where(UserUser.id == user_id)
+        .scalar_subquery()
+    )
+    res = await session.execute(
+        select(User.version, followed_versions).where(User.id == user_id)
+    )
+    row = res.first()
+    if row is None:
+        return None
+    return make_etag("feed", user_id, row[0], row[1], *params)
+
+
+async def profile_etag(session: AsyncSession, user_id: int) -> Optional[str]:
+    """
+    ETag профиля: имя, счетчики и списки подписок меняются
+    только вместе с version пользователя.
+    """
+    res = await session.execute(select(User.version).where(User.id == user_id))
+    version = res.scalar()
+    if version is None:
+        return None
+    return make_etag("user", user_id, version)
@@ -0,0 +1,38 @@
+"""
+Быстрый JSON для горячих ответов (лента, профиль).<br>
+Обработчик, вернувший Response, FastAPI отдает как есть - без проверки
+через response_model (перебор членов Union, from_attributes по объектам)
+и без jsonable_encoder. Строки projections превращаются в словари
+за один проход (as_dict) и кодируются orjson, если он установлен.<br>
+response_model у маршрутов остается - схема OpenAPI прежняя.
+"""
+
+import importlib.util
+import json
+from typing import Any
+
+from fastapi import Response
+
+if importlib.util.find_spec("orjson") is not None:
+    import orjson
+
+    def dumps(content: Any) -> bytes:
+        return orjson.dumps(content)
+
+else:
+
+    def dumps(content: Any) -> bytes:
+        return json.dumps(
+            content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    """
+    content - только словари, списки и простые значения.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
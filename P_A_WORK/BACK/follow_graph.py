@@ -0,0 +1,366 @@
+"""
+Кого читать (GET /api/users/{id}/suggestions/).<br>
+Кандидаты - друзья друзей: те, за кем следят люди, за которыми следит
+пользователь; чем больше таких общих знакомых, тем выше кандидат.<br>
+Граф подписок - в памяти процесса, в два массива (CSR): targets - id
+тех, за кем следят, подряд по пользователям и по возрастанию внутри,
+offsets[r]:offsets[r + 1] - строка r; номер строки пользователя - rows
+(только у тех, кто на кого-то подписан: память растет с числом подписок,
+а не с наибольшим id). 4 байта на подписку, строка - срез массива, счет
+кандидатов - в C (Counter).<br>
+Граф загружается при запуске, подписки и отписки дописываются поверх
+массивов (добавленные / удаленные по пользователям) и рассылаются
+остальным процессам; после FOLLOW_GRAPH_MAX_DELTA изменений массивы
+пересобираются. Подписок больше FOLLOW_GRAPH_MAX_EDGES - индекса нет,
+кандидаты считаются запросом к базе (так же, пока индекс не загружен).<br>
+Сброшенный индекс (follow_graph.invalidate) перезагружается в фоне,
+не в запросе: до конца загрузки кандидаты считаются запросом к базе.
+"""
+
+import asyncio
+import bisect
+import contextvars
+import heapq
+import random
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+
+import BACK.broadcast as broadcast
+import BACK.config as config
+import BACK.metrics as metrics
+from BACK.logs import logger
+from BACK.models import UserUser
+
+
+def enabled() -> bool:
+    return config.FOLLOW_GRAPH_ENABLED
+
+
+#   ИНДЕКС В ПАМЯТИ
+#   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+class FollowGraph:
+    """
+    Подписки пользователя = (строка массивов - removed) | added.
+    """
+
+    def __init__(self, max_edges: int, max_delta: int):
+        self.max_edges = max_edges
+        self.max_delta = max_delta
+        self.loaded = False
+        # Подписок в базе больше max_edges - не загружать.
+        self.too_large = False
+        self.loading = False
+        # Изменения, пришедшие во время загрузки, - применить после нее.
+        self._pending: List[Tuple[int, List[int], bool]] = []
+        self._clear()
+
+    def _clear(self):
+        self._rows: Dict[int, int] = {}
+        self._offsets = array("q", [0])
+        self._targets = array("i")
+        self._added: Dict[int, Set[int]] = {}
+        self._removed: Dict[int, Set[int]] = {}
+        self._delta = 0
+        metrics.registry.follow_graph_edges.set(0)
+
+    def __len__(self) -> int:
+        return (
+            len(self._targets)
+            + sum(map(len, self._added.values()))
+            - sum(map(len, self._removed.values()))
+        )
+
+    def begin_load(self):
+        self.loading = True
+        self._pending = []
+
+    def install(self, rows: Dict[int, int], offsets: array, targets: array):
+        """
+        Конец загрузки: массивы из базы плюс пришедшее за время чтения.
+        """
+        self._clear()
+        self._rows = rows
+        self._offsets = offsets
+        self._targets = targets
+        self.loaded = True
+        self.too_large = False
+        self.loading = False
+        pending, self._pending = self._pending, []
+        for user_id, follow_to_ids, following in pending:
+            self.follow(user_id, follow_to_ids, following)
+        metrics.registry.follow_graph_edges.set(len(self))
+
+    def abort_load(self, too_large: bool = False):
+        self.loading = False
+        self._pending = []
+        self.too_large = too_large
+
+    def invalidate(self):
+        self.loaded = False
+        self.too_large = False
+        self._clear()
+
+    def _row(self, user_id: int) -> Sequence[int]:
+        row = self._rows.get(user_id)
+        if row is None:
+            return ()
+        return self._targets[self._offsets[row] : self._offsets[row + 1]]
+
+    def _in_row(self, user_id: int, follow_to_id: int) -> bool:
+        row = self._rows.get(user_id)
+        if row is None:
+            return False
+        lo, hi = self._offsets[row], self._offsets[row + 1]
+        pos = bisect.bisect_left(self._targets, follow_to_id, lo, hi)
+        return pos < hi and self._targets[pos] == follow_to_id
+
+    def following(self, user_id: int) -> Sequence[int]:
+        row = self._row(user_id)
+        added = self._added.get(user_id)
+        removed = self._removed.get(user_id)
+        if added is None and removed is None:
+            return row
+        result = set(row)
+        if removed:
+            result -= removed
+        if added:
+            result |= added
+        return sorted(result)
+
+    def follow(self, user_id: int, follow_to_ids: Iterable[int], following: bool):
+        """
+        Подписки user_id изменились (после commit). Применяется повторно
+        без вреда - можно дописывать и уже прочитанное из базы.
+        """
+        if self.loading:
+            self._pending.append((user_id, list(follow_to_ids), following))
+        if not self.loaded:
+            return
+        for follow_to_id in follow_to_ids:
+            in_row = self._in_row(user_id, follow_to_id)
+            if following == in_row:
+                self._discard(
+                    self._removed if in_row else self._added, user_id, follow_to_id
+                )
+            else:
+                target = self._added if following else self._removed
+                target.setdefault(user_id, set()).add(follow_to_id)
+            self._delta += 1
+        if self._delta > self.max_delta:
+            self.compact()
+        metrics.registry.follow_graph_edges.set(len(self))
+
+    @staticmethod
+    def _discard(sets: Dict[int, Set[int]], user_id: int, follow_to_id: int):
+        ids = sets.get(user_id)
+        if ids is None:
+            return
+        ids.discard(follow_to_id)
+        if not ids:
+            del sets[user_id]
+
+    def compact(self):
+        """
+        Переносит дописанное в массивы. Строки без изменений
+        копируются срезами, опустевшие - удаляются.
+        """
+        changed = set(self._added) | set(self._removed)
+        rows: Dict[int, int] = {}
+        offsets = array("q", [0])
+        targets = array("i")
+        for user_id in sorted(changed.union(self._rows)):
+            if user_id in changed:
+                row = self.following(user_id)
+            else:
+                row = self._row(user_id)
+            if not row:
+                continue
+            rows[user_id] = len(offsets) - 1
+            targets.extend(row)
+            offsets.append(len(targets))
+        if len(targets) > self.max_edges:
+            logger.warning(
+                "---=== FOLLOW GRAPH IS TOO LARGE, INDEX DROPPED ===---",
+                extra={"edges": len(targets)},
+            )
+            self.invalidate()
+            self.too_large = True
+            return
+        self._clear()
+        self._rows = rows
+        self._offsets = offsets
+        self._targets = targets
+
+    def suggest(
+        self, user_id: int, limit: int, max_fanout: int, max_scan: int
+    ) -> List[Tuple[int, int]]:
+        """
+        (id, общих знакомых) лучших limit кандидатов, при равенстве -
+        меньший id. Читается не больше max_fanout подписок пользователя
+        (случайных, если их больше) и не больше max_scan их подписок.
+        """
+        followees = self.following(user_id)
+        exclude = set(followees)
+        exclude.add(user_id)
+        if len(followees) > max_fanout:
+            followees = random.sample(list(followees), max_fanout)
+        counts: Counter = Counter()
+        scanned = 0
+        for followee_id in followees:
+            row = self.following(followee_id)
+            counts.update(row)
+            scanned += len(row)
+            if scanned >= max_scan:
+                break
+        for excluded_id in exclude:
+            counts.pop(excluded_id, None)
+        return heapq.nlargest(
+            limit, counts.items(), key=lambda item: (item[1], -item[0])
+        )
+
+
+graph = FollowGraph(config.FOLLOW_GRAPH_MAX_EDGES, config.FOLLOW_GRAPH_MAX_DELTA)
+
+broadcast.hub.register(
+    "follow_graph.follow", graph.follow, coarse="follow_graph.invalidate"
+)
+broadcast.hub.register("follow_graph.invalidate", graph.invalidate)
+
+
+async def load(session: AsyncSession) -> bool:
+    """
+    Читает users_users в массивы (потоком, по первичному ключу).
+    False - индекс не загружен: слишком велик или уже грузится.
+    """
+    if graph.loaded:
+        return True
+    if graph.too_large or graph.loading:
+        return False
+    graph.begin_load()
+    row_of: Dict[int, int] = {}
+    offsets = array("q")
+    targets = array("i")
+    try:
+        rows = await session.stream(
+            select(UserUser.id, UserUser.follow_to_id)
+            .order_by(UserUser.id, UserUser.follow_to_id)
+            .execution_options(yield_per=10000)
+        )
+        async for user_id, follow_to_id in rows:
+            if len(targets) >= graph.max_edges:
+                await rows.close()
+                graph.abort_load(too_large=True)
+                logger.warning(
+                    "---=== FOLLOW GRAPH IS TOO LARGE, NOT LOADED ===---",
+                    extra={"max_edges": graph.max_edges},
+                )
+                return False
+            if user_id not in row_of:
+                # Строки пользователя идут подряд (порядок по UserUser.id).
+                row_of[user_id] = len(offsets)
+                offsets.append(len(targets))
+            targets.append(follow_to_id)
+    except BaseException:
+        graph.abort_load()
+        raise
+    offsets.append(len(targets))
+    graph.install(row_of, offsets, targets)
+    logger.info(f"---=== FOLLOW GRAPH LOADED: {len(targets)} follows ===---")
+    return True
+
+
+#   ФОНОВАЯ ЗАГРУЗКА
+#   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+# Сессии основной базы для перезагрузки, None - приложение не запущено.
+_session_maker: Optional[async_sessionmaker[AsyncSession]] = None
+_reload_task: Optional[asyncio.Task] = None
+
+
+async def start(session_maker: async_sessionmaker[AsyncSession]):
+    """
+    Загрузка при запуске приложения (индекс - по его базе).
+    """
+    global _session_maker
+    _session_maker = session_maker
+    graph.invalidate()
+    async with session_maker() as session:
+        await load(session)
+
+
+async def stop():
+    global _session_maker, _reload_task
+    _session_maker = None
+    task, _reload_task = _reload_task, None
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def reload_in_background():
+    """
+    Запускает загрузку сброшенного индекса, если она еще не идет.
+    """
+    global _reload_task
+    if _session_maker is None or graph.loaded or graph.loading or graph.too_large:
+        return
+    if _reload_task is not None and not _reload_task.done():
+        return
+    # Без контекста запроса: загрузка не входит в его бюджет и журнал.
+    _reload_task = asyncio.create_task(
+        _reload(_session_maker), context=contextvars.Context()
+    )
+
+
+async def _reload(session_maker: async_sessionmaker[AsyncSession]):
+    try:
+        async with session_maker() as session:
+            await load(session)
+    except Exception:
+        logger.exception("---=== FOLLOW GRAPH RELOAD FAILED ===---")
+
+
+async def _suggest_from_db(
+    session: AsyncSession, user_id: int, limit: int
+) -> List[Tuple[int, int]]:
+    theirs = aliased(UserUser)
+    mutual = func.count().label("mutual")
+    mine = select(UserUser.follow_to_id).where(UserUser.id == user_id)
+    res = await session.execute(
+        select(theirs.follow_to_id, mutual)
+        .select_from(UserUser)
+        .join(theirs, theirs.id == UserUser.follow_to_id)
+        .where(
+            UserUser.id == user_id,
+            theirs.follow_to_id != user_id,
+            theirs.follow_to_id.not_in(mine),
+        )
+        .group_by(theirs.follow_to_id)
+        .order_by(mutual.desc(), theirs.follow_to_id)
+        .limit(limit)
+    )
+    return [tuple(row) for row in res]
+
+
+async def suggest(
+    session: AsyncSession, user_id: int, limit: int
+) -> List[Tuple[int, int]]:
+    """
+    (id, общих знакомых) кандидатов. Индекса нет - запрос к базе
+    (session, можно реплики), а индекс перезагружается в фоне с основной.
+    """
+    if enabled():
+        if graph.loaded:
+            return graph.suggest(
+                user_id,
+                limit,
+                config.FOLLOW_GRAPH_MAX_FANOUT,
+                config.FOLLOW_GRAPH_MAX_SCAN,
+            )
+        reload_in_background()
+    return await _suggest_from_db(session, user_id, limit)
@@ -0,0 +1,255 @@
+"""
+Логи приложения.<br>
+Стандартный logging. Обработчик только кладет запись в ограниченную
+очередь, форматирует и пишет в stdout отдельный поток (QueueListener).
+Очередь полна - запись отбрасывается и считается
+(log_records_dropped_total): цикл событий вывод не ждет никогда.<br>
+Строка - JSON: время, уровень, сообщение, request_id и время от начала
+запроса (elapsed_ms), плюс поля из extra. Запросы помечает
+RequestContextMiddleware (X-Request-ID - клиента или свой), она же пишет
+строку доступа с методом, путем и кодом ответа.<br>
+Записи ниже WARNING можно прореживать (LOG_SAMPLE_RATE) - запросами
+целиком: у выбранного запроса остаются все строки.<br>
+SQL: echo выключен (LOG_SQL_ECHO), в лог - только выражения
+дольше LOG_SLOW_QUERY_MS.
+"""
+
+import copy
+import json
+import logging
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+import zlib
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, TextIO
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import BACK.config as config
+import BACK.metrics as metrics
+
+logger = logging.getLogger("simple_tweeter")
+
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+request_started: ContextVar[Optional[float]] = ContextVar(
+    "request_started", default=None
+)
+
+# Поля LogRecord, которые не попадают в JSON как есть (остальное - extra).
+_STANDARD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+}
+_REQUEST_ID = re.compile(r"[\w.-]{1,64}")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_FIELDS:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def sampled(rid: Optional[str], rate: float) -> bool:
+    """
+    Оставить ли запись запроса rid: решение одно на весь запрос.
+    """
+    if rate >= 1:
+        return True
+    if rate <= 0:
+        return False
+    if rid is None:
+        return random.random() < rate
+    return zlib.crc32(rid.encode()) % 10000 < rate * 10000
+
+
+class ContextQueueHandler(QueueHandler):
+    """
+    Дописывает контекст запроса и кладет запись в очередь не дожидаясь
+    места: полна - запись теряется.
+    """
+
+    def __init__(self, records: queue.Queue, sample_rate: float = 1.0):
+        super().__init__(records)
+        self.sample_rate = sample_rate
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING and not sampled(
+            request_id.get(), self.sample_rate
+        ):
+            return False
+        return super().filter(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Контекст есть только здесь, в потоке и задаче вызвавшего.
+        record = copy.copy(record)
+        record.request_id = request_id.get()
+        started = request_started.get()
+        if started is not None:
+            record.elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.registry.log_dropped.inc()
+
+
+_listener: Optional[QueueListener] = None
+
+
+def configure(stream: Optional[TextIO] = None):
+    """
+    Подключает к logger очередь и поток вывода (stream, по умолчанию stdout).
+    До вызова записи идут в logging по умолчанию (WARNING и выше - в stderr).
+    """
+    global _listener
+    if _listener is not None:
+        return
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+    handler = ContextQueueHandler(
+        queue.Queue(config.LOG_QUEUE_SIZE), config.LOG_SAMPLE_RATE
+    )
+    logger.addHandler(handler)
+    logger.setLevel(config.LOG_LEVEL)
+    logger.propagate = False
+    _listener = QueueListener(handler.queue, output)
+    _listener.start()
+
+
+def shutdown():
+    """
+    Дописывает очередь и отключает вывод.
+    """
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
+    for handler in list(logger.handlers):
+        if isinstance(handler, ContextQueueHandler):
+            logger.removeHandler(handler)
+    logger.propagate = True
+
+
+class RequestContextMiddleware:
+    """
+    ASGI-прослойка: request_id и начало запроса для всех строк лога,
+    X-Request-ID в ответе и строка доступа по окончании.
+    """
+
+    def __init__(self, app, access_log: bool):
+        self.app = app
+        self.access_log = access_log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        rid = self._incoming_id(scope) or uuid.uuid4().hex[:16]
+        rid_token = request_id.set(rid)
+        started_token = request_started.set(time.perf_counter())
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {
+                    **message,
+                    "headers": list(message.get("headers", ()))
+                    + [(b"x-request-id", rid.encode())],
+                }
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            if self.access_log:
+                logger.log(
+                    logging.ERROR if status >= 500 else logging.INFO,
+                    "request",
+                    extra={
+                        "method": scope["method"],
+                        "path": scope["path"],
+                        "status": status,
+                    },
+                )
+            request_started.reset(started_token)
+            request_id.reset(rid_token)
+
+    @staticmethod
+    def _incoming_id(scope) -> Optional[str]:
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                value = value.decode("latin-1")
+                return value if _REQUEST_ID.fullmatch(value) else None
+        return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("logs_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["logs_started"].pop()) * 1000
+    if elapsed_ms >= config.LOG_SLOW_QUERY_MS:
+        # Без параметров: в них бывают ключи и тексты пользователей.
+        logger.warning(
+            "slow query",
+            extra={"duration_ms": round(elapsed_ms, 1), "statement": statement[:1000]},
+        )
+
+
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    started = connection is not None and connection.info.get("logs_started")
+    if started:
+        started.pop()
+
+
+def instrument_engine(engine: AsyncEngine):
+    sync_engine = engine.sync_engine
+    if event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(sync_engine, "handle_error", _handle_error)
+
+
+def setup(app, *engines: AsyncEngine):
+    """
+    Контекст запросов для лога и, если LOG_SLOW_QUERY_MS, медленные SQL.
+    """
+    if config.LOG_SLOW_QUERY_MS > 0:
+        for engine in engines:
+            instrument_engine(engine)
+    app.add_middleware(RequestContextMiddleware, access_log=config.LOG_ACCESS)
@@ -1,57 +1,55 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
-from sqlalchemy.dialects.postgresql import insert
 
-import BACK.models as models
+import BACK.config as config
+import BACK.logs as logs
+import BACK.migrations as migrations
+import BACK.popular as popular
+import BACK.reaper as reaper
+from BACK.process_lock import ProcessLock
 from BACK.app import create_app
-from BACK.database import engine, session
-from BACK.models import logger
+from BACK.database import async_session, engine, replica_engine, replica_session
+from BACK.logs import logger
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await logger.info("---===< DB and its ORM try to init...>===---")
-    async with engine.begin() as conn:
-        await conn.run_sync(models.Base.metadata.create_all)
-    try:
-        # await session.add(models.User(id=0, api_key='None', name='None'))
-        await session.execute(
-            insert(models.User)
-            .values(id=0, api_key="None", name="None")
-            .on_conflict_do_nothing(index_elements=["id"])
+    # В каждом рабочем процессе - свой поток вывода лога.
+    logs.configure()
+    logger.info("---===< DB and its ORM try to init...>===---")
+    # Только сверка версии схемы: миграции и начальные записи -
+    # python -m BACK.commands migrate / seed.
+    await migrations.check(engine)
+
+    # lifespan выполняется в каждом рабочем процессе - фоновую уборку
+    # ведет один из них (держатель блокировки).
+    reaper_lock = ProcessLock("reaper")
+    reaper_task = None
+    if config.REAPER_ENABLED:
+        reaper_task = asyncio.create_task(
+            reaper.run_periodically(async_session, reaper_lock)
         )
-        await session.execute(
-            insert(models.User)
-            .values(id=1, api_key="test", name="Test User")
-            .on_conflict_do_nothing(index_elements=["id"])
+    popular_lock = ProcessLock("popular")
+    popular_task = None
+    if popular.enabled():
+        popular_task = asyncio.create_task(
+            popular.run_periodically(async_session, popular_lock)
         )
-        await session.execute(
-            insert(models.User)
-            .values(id=2, api_key="test2", name="Test User2")
-            .on_conflict_do_nothing(index_elements=["id"])
-        )
-        await session.execute(
-            insert(models.UserUser)
-            .values(id=1, follow_to_id=2)
-            .on_conflict_do_nothing(index_elements=["id", "follow_to_id"])
-        )
-        # await session.add(models.Tweet(id=0, content='None', author_id=0))
-        await session.execute(
-            insert(models.Tweet)
-            .values(id=0, content="None", author_id=0)
-            .on_conflict_do_nothing(index_elements=["id"])
-        )
-
-        await session.commit()
-    except Exception:
-        pass
 
     yield
-    await logger.info("---===< DB and its ORM try to tear down...>===---")
-    await session.rollback()
-    await session.close()
+    logger.info("---===< DB and its ORM try to tear down...>===---")
+    for task in (reaper_task, popular_task):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    reaper_lock.release()
+    popular_lock.release()
     await engine.dispose()
+    if replica_engine is not None:
+        await replica_engine.dispose()
+    logs.shutdown()
 
 
-app = create_app(session, lifespan)
+app = create_app(async_session, lifespan, replica_session)
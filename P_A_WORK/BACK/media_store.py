@@ -0,0 +1,328 @@
+"""
+Хранилище картинок, адресуемое содержимым.<br>
+Файл лежит по пути из sha256 содержимого: IMG/ab/cd/abcd...ef.png,
+одинаковые загрузки - один файл и одна запись media со счетчиком ссылок.
+Путь не меняется никогда, поэтому nginx отдает такие файлы
+с бессрочным кэшем (immutable).<br>
+Загрузка читается из тела запроса потоком (receive_upload), без разбора
+формы Starlette: файл сразу пишется во временный файл (tmp_root, вне
+раздаваемого хранилища) с подсчетом sha256 по ходу.
+"""
+
+import asyncio
+import errno
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+from typing import NamedTuple, Optional, Tuple
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.requests import Request
+
+import BACK.config as config
+from BACK.models import Media
+from BACK.util_func import get_err_JSONRes
+
+_EXT_RE = re.compile(r"^\.[a-z0-9]{1,8}$")
+
+
+class TooLarge(Exception):
+    pass
+
+
+class StoredFile(NamedTuple):
+    content_hash: str
+    file_path: str
+    size: int
+    # Принятый файл до place - во временном файле хранилища.
+    tmp_path: Optional[str] = None
+
+
+def _extension(file_name: Optional[str]) -> str:
+    ext = os.path.splitext(file_name or "")[1].lower()
+    return ext if _EXT_RE.match(ext) else ""
+
+
+def tmp_root() -> str:
+    """
+    Каталог временных файлов загрузок (nginx его не раздает).
+    """
+    return config.MEDIA_TMP_ROOT or config.MEDIA_ROOT.rstrip("/\\") + "_tmp"
+
+
+def media_path(content_hash: str, ext: str) -> str:
+    """
+    Путь файла по хэшу: два уровня каталогов по 2 символа,
+    чтобы в одном каталоге не копились сотни тысяч файлов.
+    """
+    return os.path.join(
+        config.MEDIA_ROOT, content_hash[:2], content_hash[2:4], content_hash + ext
+    )
+
+
+def _place(tmp_path: str, file_path: str):
+    """
+    Переносит временный файл на file_path (атомарно). Если такой
+    файл уже есть - временный удаляется.
+    """
+    if os.path.exists(file_path):
+        os.remove(tmp_path)
+        return
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    try:
+        os.replace(tmp_path, file_path)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        # tmp_root на другой файловой системе: копия рядом, затем rename.
+        fd, part_path = tempfile.mkstemp(
+            dir=os.path.dirname(file_path), prefix=".", suffix=".part"
+        )
+        os.close(fd)
+        try:
+            shutil.copyfile(tmp_path, part_path)
+            os.replace(part_path, file_path)
+        except BaseException:
+            os.remove(part_path)
+            raise
+        os.remove(tmp_path)
+
+
+def _remove_tmp(tmp_path: Optional[str]):
+    if tmp_path is not None and os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+
+class _UploadWriter:
+    """
+    Колбэки парсера multipart: данные файла из поля field копятся
+    в буфере, flush (в потоке) дописывает их во временный файл
+    и в sha256. Остальные поля формы пропускаются.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self.found = False
+        self.file_name: Optional[str] = None
+        self.size = 0
+        self.tmp_path: Optional[str] = None
+        self._digest = hashlib.sha256()
+        self._fd: Optional[int] = None
+        self._buffer = bytearray()
+        self._in_file = False
+        self._headers: dict = {}
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_part_begin(self):
+        self._headers = {}
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(
+            self._headers.get(b"content-disposition", b"")
+        )
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        # Как у Starlette: файл - часть с filename. Берется первый.
+        self._in_file = name == self.field and b"filename" in options and not self.found
+        if self._in_file:
+            self.found = True
+            self.file_name = options[b"filename"].decode("utf-8", "replace")
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if not self._in_file:
+            return
+        self.size += end - start
+        if self.size > config.MEDIA_MAX_BYTES:
+            raise TooLarge(f"File is larger than {config.MEDIA_MAX_BYTES} bytes.")
+        self._buffer += data[start:end]
+
+    def on_part_end(self):
+        self._in_file = False
+
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    def _write(self, chunk: bytes):
+        if self._fd is None:
+            tmp_dir = tmp_root()
+            os.makedirs(tmp_dir, exist_ok=True)
+            self._fd, self.tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        self._digest.update(chunk)
+        os.write(self._fd, chunk)
+
+    async def flush(self):
+        chunk = bytes(self._buffer)
+        self._buffer.clear()
+        await asyncio.to_thread(self._write, chunk)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def content_hash(self) -> str:
+        return self._digest.hexdigest()
+
+
+async def receive_upload(
+    request: Request, field: str = "file"
+) -> Tuple[Optional[StoredFile], Optional[str]]:
+    """
+    Файл из поля field формы (multipart/form-data) - во временный файл
+    хранилища, одним проходом по телу запроса. Возвращает (файл, имя
+    файла у клиента); (None, None) - не форма или файла в ней нет.
+    На место файл кладет place, временный в любом случае убирает discard.<br>
+    TooLarge - превышен MEDIA_MAX_BYTES, на диске при этом ничего
+    не остается.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        return None, None
+    writer = _UploadWriter(field)
+    parser = MultipartParser(
+        boundary,
+        {
+            "on_part_begin": writer.on_part_begin,
+            "on_header_field": writer.on_header_field,
+            "on_header_value": writer.on_header_value,
+            "on_header_end": writer.on_header_end,
+            "on_headers_finished": writer.on_headers_finished,
+            "on_part_data": writer.on_part_data,
+            "on_part_end": writer.on_part_end,
+        },
+    )
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if writer.buffered() >= config.MEDIA_CHUNK_SIZE:
+                await writer.flush()
+        parser.finalize()
+        if not writer.found:
+            return None, None
+        await writer.flush()
+        writer.close()
+    except BaseException:
+        writer.close()
+        await asyncio.to_thread(_remove_tmp, writer.tmp_path)
+        raise
+    content_hash = writer.content_hash()
+    file_path = media_path(content_hash, _extension(writer.file_name))
+    stored = StoredFile(content_hash, file_path, writer.size, writer.tmp_path)
+    return stored, writer.file_name
+
+
+async def place(stored: StoredFile, file_path: str):
+    """
+    Кладет принятый файл на file_path (путь из записи media), если
+    его там еще нет.<br>
+    Звать после add_reference, до commit: уборка удаляет файл до commit
+    удаления записи, а upsert этой записи ждет его - после upsert файл
+    либо уже удален (и кладется заново), либо запись с новой ссылкой
+    уборка не тронет.
+    """
+    await asyncio.to_thread(_place, stored.tmp_path, file_path)
+
+
+async def discard(stored: StoredFile):
+    """
+    Убирает временный файл, если он так и не лег на место.
+    """
+    await asyncio.to_thread(_remove_tmp, stored.tmp_path)
+
+
+async def add_reference(session: AsyncSession, stored: StoredFile) -> Media:
+    """
+    Запись media для файла: новая с ref_count = 1,
+    либо существующая с ref_count + 1. Commit - за вызывающим.
+    """
+    res = await session.execute(
+        insert(Media)
+        .values(
+            content_hash=stored.content_hash,
+            file_path=stored.file_path,
+            size=stored.size,
+            ref_count=1,
+        )
+        .on_conflict_do_update(
+            index_elements=["content_hash"],
+            set_={"ref_count": Media.ref_count + 1},
+        )
+        .returning(Media)
+    )
+    return res.scalar()
+
+
+class MaxBodySizeMiddleware:
+    """
+    ASGI-прослойка: тело запроса на path больше max_bytes отклоняется
+    кодом 413 до разбора формы, т.е. до того, как оно ляжет на диск.<br>
+    Проверяется и Content-Length, и фактически прочитанный объем.
+    """
+
+    def __init__(self, app, path: str, max_bytes: int):
+        self.app = app
+        self.path = path
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].rstrip("/") != self.path:
+            return await self.app(scope, receive, send)
+
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit():
+                if int(value) > self.max_bytes:
+                    return await self._reject(scope, receive, send)
+
+        received = 0
+        too_large = False
+        rejected = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    too_large = True
+                    raise TooLarge(f"Request body is larger than {self.max_bytes}.")
+            return message
+
+        async def guarded_send(message):
+            # Ошибку чтения тела приложение превращает в свой ответ (400),
+            # подменяем его на 413.
+            nonlocal rejected
+            if not too_large:
+                return await send(message)
+            if message["type"] == "http.response.start" and not rejected:
+                rejected = True
+                await self._reject(scope, receive, send)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except TooLarge:
+            if not rejected:
+                await self._reject(scope, receive, send)
+
+    async def _reject(self, scope, receive, send):
+        response = get_err_JSONRes(
+            413,
+            "payload too large",
+            f"Request body is larger than {self.max_bytes} bytes.",
+        )
+        await response(scope, receive, send)
@@ -0,0 +1,329 @@
+"""
+Метрики приложения в текстовом формате Prometheus (/metrics).<br>
+По маршрутам: число запросов, гистограмма времени ответа, запросы в работе,
+время в базе и число SQL-выражений на запрос (события движка SQLAlchemy).
+Плюс ожидание соединения из пула.<br>
+Включается METRICS_ENABLED, выключенные метрики ничего не подключают.
+"""
+
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+# Маршрут для запросов, не нашедших обработчика (404 на произвольный путь) -
+# чтобы не плодить метки.
+UNMATCHED = "unmatched"
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, labels: Tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for labels, value in sorted(self.values.items()):
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+            )
+        return lines
+
+
+class Gauge(Counter):
+    def dec(self, labels: Tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+    def set(self, value: float, labels: Tuple = ()):
+        self.values[labels] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        if not self.values:
+            lines.append(f"{self.name} 0")
+        return lines
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными границами корзин.<br>
+    Внутри - счетчики по корзинам (не накопленные), накапливаются при выводе.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float],
+        labelnames: Sequence[str] = (),
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        # метки -> [корзины..., +Inf, сумма]
+        self.values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, labels: Tuple = ()):
+        row = self.values.get(labels)
+        if row is None:
+            row = self.values[labels] = [0] * (len(self.buckets) + 2)
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        names = self.labelnames + ("le",)
+        for labels, row in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), row):
+                total += count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(names, labels + (bound,))} {total}"
+                )
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {row[-1]}")
+            lines.append(f"{self.name}_count{label_text} {total}")
+        return lines
+
+
+class RequestStats:
+    """
+    Накопитель одного запроса: SQL-выражения и время в базе.
+    """
+
+    __slots__ = ("statements", "db_seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_seconds = 0.0
+
+
+# Статистика текущего запроса. События движка выполняются в том же
+# контексте (greenlet SQLAlchemy наследует contextvars задачи).
+current_request: ContextVar[Optional[RequestStats]] = ContextVar(
+    "current_request", default=None
+)
+
+
+class Registry:
+    def __init__(self):
+        route = ("method", "route")
+        self.requests = Counter(
+            "http_requests_total", "HTTP requests.", route + ("status",)
+        )
+        self.latency = Histogram(
+            "http_request_duration_seconds",
+            "HTTP request latency.",
+            LATENCY_BUCKETS,
+            route,
+        )
+        self.in_flight = Gauge("http_requests_in_flight", "HTTP requests in progress.")
+        self.request_db_time = Histogram(
+            "http_request_db_seconds",
+            "Time spent in SQL statements per request.",
+            LATENCY_BUCKETS,
+            route,
+        )
+        self.request_statements = Histogram(
+            "http_request_db_statements",
+            "SQL statements per request.",
+            STATEMENT_BUCKETS,
+            route,
+        )
+        self.db_statements = Counter(
+            "db_statements_total", "SQL statements, including background tasks."
+        )
+        self.db_time = Counter(
+            "db_seconds_total", "Time spent in SQL statements, including background."
+        )
+        self.shed = Counter(
+            "http_requests_shed_total",
+            "Requests rejected by admission control.",
+            ("reason", "route_class"),
+        )
+        self.broadcast = Counter(
+            "broadcast_messages_total",
+            "Cache coherence messages between worker processes.",
+            ("direction",),
+        )
+        self.reads = Counter(
+            "db_reads_total",
+            "Read requests by database when a replica is configured.",
+            ("target",),
+        )
+        self.stream_subscribers = Gauge(
+            "stream_subscribers", "Open tweet stream (SSE) connections."
+        )
+        self.stream_dropped = Counter(
+            "stream_subscribers_dropped_total",
+            "Tweet stream subscribers dropped for a full queue.",
+        )
+        self.log_dropped = Counter(
+            "log_records_dropped_total", "Log records dropped for a full queue."
+        )
+        self.follow_graph_edges = Gauge(
+            "follow_graph_edges", "Follows in the in-memory follow graph index."
+        )
+        self.pool_wait = Histogram(
+            "db_pool_checkout_wait_seconds",
+            "Time waiting for a pooled connection.",
+            LATENCY_BUCKETS,
+        )
+
+    def all(self) -> list:
+        return [
+            self.requests,
+            self.latency,
+            self.in_flight,
+            self.request_db_time,
+            self.request_statements,
+            self.db_statements,
+            self.db_time,
+            self.pool_wait,
+            self.shed,
+            self.broadcast,
+            self.reads,
+            self.stream_subscribers,
+            self.stream_dropped,
+            self.log_dropped,
+            self.follow_graph_edges,
+        ]
+
+    def render(self) -> str:
+        return (
+            "\n".join(line for metric in self.all() for line in metric.render()) + "\n"
+        )
+
+
+registry = Registry()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Пул, замеряющий ожидание свободного соединения.
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            registry.pool_wait.observe(time.perf_counter() - started)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metrics_started"].pop()
+    registry.db_statements.inc()
+    registry.db_time.inc(amount=elapsed)
+    stats = current_request.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += elapsed
+
+
+def _handle_error(exception_context):
+    started = exception_context.connection and exception_context.connection.info.get(
+        "metrics_started"
+    )
+    if started:
+        started.pop()
+
+
+def instrument_engine(engine: AsyncEngine):
+    sync_engine = engine.sync_engine
+    if event.contains(sync_engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(sync_engine, "handle_error", _handle_error)
+
+
+class MetricsMiddleware:
+    """
+    ASGI-прослойка: время ответа, код и статистика SQL по маршрутам.<br>
+    Маршрут - шаблон пути (/api/tweets/{tweet_id}), а не сам путь.
+    """
+
+    def __init__(self, app, registry: Registry, skip_path: str):
+        self.app = app
+        self.registry = registry
+        self.skip_path = skip_path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == self.skip_path:
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        self.registry.in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.registry.in_flight.dec()
+            current_request.reset(token)
+            route = scope.get("route")
+            labels = (scope["method"], route.path if route is not None else UNMATCHED)
+            self.registry.requests.inc(labels + (status,))
+            self.registry.latency.observe(elapsed, labels)
+            self.registry.request_db_time.observe(stats.db_seconds, labels)
+            self.registry.request_statements.observe(stats.statements, labels)
+
+
+def setup(app: FastAPI, *engines: AsyncEngine, path: str = "/metrics"):
+    """
+    Подключает сбор метрик к приложению и движкам и маршрут path.
+    """
+    for engine in engines:
+        instrument_engine(engine)
+    app.add_middleware(MetricsMiddleware, registry=registry, skip_path=path)
+
+    @app.get(path, include_in_schema=False)
+    async def get_metrics() -> PlainTextResponse:
+        return PlainTextResponse(
+            registry.render(), media_type="text/plain; version=0.0.4"
+        )
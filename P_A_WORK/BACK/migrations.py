@@ -0,0 +1,329 @@
+"""
+Версии схемы базы.<br>
+Номер примененной версии хранится в таблице schema_version. Приложение
+при старте только сверяет его (check), сами миграции выполняет команда:
+python -m BACK.commands migrate<br>
+Миграции идут по порядку и повторяемы: первая создает недостающие таблицы
+по моделям (на пустой базе - сразу всю схему), следующие доводят
+таблицы, созданные старым кодом, и ничего не делают, если все уже есть.
+Новая миграция - в конец MIGRATIONS, с тем же правилом.
+"""
+
+from typing import Awaitable, Callable, List, NamedTuple, Optional
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+    inspect,
+    text,
+    update,
+)
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from sqlalchemy.future import select
+
+import BACK.config as config
+import BACK.models as models
+import BACK.search as search
+from BACK.logs import logger
+
+schema_version = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column(
+        "applied_at", DateTime(timezone=True), server_default=func.now(), nullable=False
+    ),
+)
+
+# Ключ pg_advisory_lock: две одновременные команды migrate не мешают друг другу.
+_LOCK_KEY = 7_310_017
+
+
+class SchemaOutdated(RuntimeError):
+    pass
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[AsyncConnection], Awaitable[None]]
+    # False - вне транзакции (CREATE INDEX CONCURRENTLY в Postgres).
+    transactional: bool = True
+
+
+async def _create_tables(conn: AsyncConnection):
+    await conn.run_sync(models.Base.metadata.create_all)
+
+
+def _timestamp(dialect: str) -> str:
+    # SQLite не добавляет колонку с непостоянным значением по умолчанию.
+    if dialect == "postgresql":
+        return "TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()"
+    return "DATETIME NOT NULL DEFAULT '1970-01-01 00:00:00'"
+
+
+# Колонки, которых нет в таблицах первой версии приложения.
+_COLUMNS = (
+    ("users", "followers_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("users", "following_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("users", "version", "INTEGER NOT NULL DEFAULT 0"),
+    ("tweets", "likes_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("tweets", "created_at", _timestamp),
+    ("pictures", "media_id", "INTEGER REFERENCES media (id)"),
+    ("pictures", "created_at", _timestamp),
+    ("media", "feed_path", "VARCHAR"),
+    ("media", "thumb_path", "VARCHAR"),
+)
+
+
+async def _add_missing_columns(conn: AsyncConnection, columns) -> bool:
+    """
+    ALTER TABLE ADD COLUMN для колонок columns, которых еще нет.
+    True - что-то добавлено.
+    """
+    dialect = conn.dialect.name
+    existing = await conn.run_sync(
+        lambda sync_conn: {
+            table: {column["name"] for column in inspect(sync_conn).get_columns(table)}
+            for table in {table for table, _, _ in columns}
+        }
+    )
+    added = False
+    for table, column, ddl in columns:
+        if column in existing[table]:
+            continue
+        if callable(ddl):
+            ddl = ddl(dialect)
+        await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        added = True
+    return added
+
+
+async def _add_columns(conn: AsyncConnection):
+    if await _add_missing_columns(conn, _COLUMNS):
+        # Счетчики появились только что - заполнить по таблицам связей
+        # (recount_counters нужен только execute - подходит и соединение).
+        await models.recount_counters(conn)
+
+
+# Индексы, на которые опираются лента, лайки, подписки и уборка.
+_INDEXES = (
+    ("ix_tweets_author_id_id", "tweets", "(author_id, id)"),
+    ("ix_users_users_follow_to_id_id", "users_users", "(follow_to_id, id)"),
+    ("ix_likes_tweet_id", "likes", "(tweet_id)"),
+    ("ix_pictures_tweet_id", "pictures", "(tweet_id)"),
+    ("ix_pictures_media_id", "pictures", "(media_id)"),
+    ("ix_timeline_entries_tweet_id", "timeline_entries", "(tweet_id)"),
+    (
+        "ix_timeline_entries_user_id_author_id",
+        "timeline_entries",
+        "(user_id, author_id)",
+    ),
+)
+
+
+async def _create_index(conn: AsyncConnection, name: str, table: str, definition: str):
+    """
+    В Postgres - CONCURRENTLY, без блокировки записи в таблицу.
+    Прерванное построение оставляет невалидный индекс - он пересоздается.
+    """
+    if conn.dialect.name != "postgresql":
+        await conn.execute(
+            text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} {definition}")
+        )
+        return
+    res = await conn.execute(
+        text(
+            "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = indexrelid "
+            "WHERE relname = :name AND NOT indisvalid"
+        ),
+        {"name": name},
+    )
+    if res.first() is not None:
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    await conn.execute(
+        text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {definition}")
+    )
+
+
+async def _create_indexes(conn: AsyncConnection):
+    for name, table, definition in _INDEXES:
+        await _create_index(conn, name, table, definition)
+
+
+# Полнотекстовый поиск (search.py). SQLite: FTS5 поверх tweets (external
+# content) и триггеры, которые ведут его вместе с таблицей.
+_FTS = search.FTS_TABLE
+_SQLITE_SEARCH = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {_FTS} "
+    "USING fts5(content, content='tweets', content_rowid='id')",
+    f"CREATE TRIGGER IF NOT EXISTS {_FTS}_insert AFTER INSERT ON tweets BEGIN "
+    f"INSERT INTO {_FTS} (rowid, content) VALUES (new.id, new.content); END",
+    f"CREATE TRIGGER IF NOT EXISTS {_FTS}_delete AFTER DELETE ON tweets BEGIN "
+    f"INSERT INTO {_FTS} ({_FTS}, rowid, content) "
+    "VALUES ('delete', old.id, old.content); END",
+    f"CREATE TRIGGER IF NOT EXISTS {_FTS}_update AFTER UPDATE OF content ON tweets "
+    f"BEGIN INSERT INTO {_FTS} ({_FTS}, rowid, content) "
+    "VALUES ('delete', old.id, old.content); "
+    f"INSERT INTO {_FTS} (rowid, content) VALUES (new.id, new.content); END",
+    f"INSERT INTO {_FTS} ({_FTS}) VALUES ('rebuild')",
+)
+
+
+async def _create_search_index(conn: AsyncConnection):
+    if conn.dialect.name != "postgresql":
+        for ddl in _SQLITE_SEARCH:
+            await conn.execute(text(ddl))
+        return
+    await _create_index(
+        conn,
+        "ix_tweets_search",
+        "tweets",
+        f"USING GIN (to_tsvector('{search.TS_CONFIG}', content))",
+    )
+
+
+async def _add_popularity(conn: AsyncConnection):
+    # Лайки до миграции получают время 1970 года (SQLite) или время
+    # миграции (Postgres) - в первом случае в оценки они не попадут.
+    await _add_missing_columns(conn, (("likes", "created_at", _timestamp),))
+    await conn.run_sync(models.Base.metadata.create_all)
+    await _create_index(conn, "ix_likes_created_at", "likes", "(created_at)")
+
+
+def _boolean_true(dialect: str) -> str:
+    if dialect == "postgresql":
+        return "BOOLEAN NOT NULL DEFAULT true"
+    return "BOOLEAN NOT NULL DEFAULT 1"
+
+
+async def _add_fanned_out(conn: AsyncConnection):
+    # Прежний код решал "звезда или нет" при чтении - твиты нынешних
+    # "звезд" и не разложены.
+    if await _add_missing_columns(conn, (("tweets", "fanned_out", _boolean_true),)):
+        await conn.execute(
+            update(models.Tweet)
+            .where(
+                select(models.User.followers_count)
+                .where(models.User.id == models.Tweet.author_id)
+                .scalar_subquery()
+                > config.TIMELINE_FANOUT_MAX_FOLLOWERS
+            )
+            .values(fanned_out=False)
+        )
+    await _create_index(
+        conn,
+        "ix_tweets_author_id_id_merged",
+        "tweets",
+        "(author_id, id) WHERE NOT fanned_out",
+    )
+
+
+MIGRATIONS = [
+    Migration(1, "tables", _create_tables),
+    Migration(2, "counters, versions and media columns", _add_columns),
+    Migration(3, "indexes", _create_indexes, transactional=False),
+    Migration(4, "full-text search", _create_search_index, transactional=False),
+    Migration(
+        5, "like times and popularity scores", _add_popularity, transactional=False
+    ),
+    Migration(6, "per-tweet fan-out decision", _add_fanned_out, transactional=False),
+]
+
+HEAD = MIGRATIONS[-1].version
+
+
+async def current_version(engine: AsyncEngine) -> Optional[int]:
+    """
+    Примененная версия схемы, None - база еще не размечена.
+    """
+    async with engine.connect() as conn:
+        if not await conn.run_sync(
+            lambda sync_conn: inspect(sync_conn).has_table(schema_version.name)
+        ):
+            return None
+        res = await conn.execute(select(func.max(schema_version.c.version)))
+        return res.scalar() or 0
+
+
+async def check(engine: AsyncEngine) -> int:
+    """
+    Для старта приложения: схема не старее кода, иначе SchemaOutdated.
+    """
+    version = await current_version(engine)
+    if version is None or version < HEAD:
+        raise SchemaOutdated(
+            f"Database schema version is {version}, the code needs {HEAD}: "
+            "run python -m BACK.commands migrate"
+        )
+    return version
+
+
+async def upgrade(engine: AsyncEngine, target: Optional[int] = None) -> List[int]:
+    """
+    Применяет миграции новее текущей версии (до target включительно).
+    Возвращает номера примененных.
+    """
+    target = HEAD if target is None else target
+    applied = []
+    async with engine.connect() as lock_conn:
+        postgres = engine.dialect.name == "postgresql"
+        if postgres:
+            await lock_conn.execute(
+                text("SELECT pg_advisory_lock(:key)"), {"key": _LOCK_KEY}
+            )
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(schema_version.create, checkfirst=True)
+            current = await current_version(engine)
+            for migration in MIGRATIONS:
+                if not current < migration.version <= target:
+                    continue
+                logger.info(
+                    f"---=== MIGRATION {migration.version}: "
+                    f"{migration.description} ===---"
+                )
+                if migration.transactional:
+                    async with engine.begin() as conn:
+                        await migration.apply(conn)
+                        await _stamp(conn, migration)
+                else:
+                    async with engine.connect() as conn:
+                        conn = await conn.execution_options(
+                            isolation_level="AUTOCOMMIT"
+                        )
+                        await migration.apply(conn)
+                    async with engine.begin() as conn:
+                        await _stamp(conn, migration)
+                applied.append(migration.version)
+        finally:
+            if postgres:
+                await lock_conn.execute(
+                    text("SELECT pg_advisory_unlock(:key)"), {"key": _LOCK_KEY}
+                )
+    return applied
+
+
+async def _stamp(conn: AsyncConnection, migration: Migration):
+    await conn.execute(
+        schema_version.insert().values(
+            version=migration.version, description=migration.description
+        )
+    )
+
+
+async def reset(engine: AsyncEngine):
+    """
+    Удаляет все таблицы вместе с отметками версий - для нагрузочных прогонов.
+    """
+    async with engine.begin() as conn:
+        if conn.dialect.name != "postgresql":
+            await conn.execute(text(f"DROP TABLE IF EXISTS {_FTS}"))
+        await conn.run_sync(models.Base.metadata.drop_all)
+        await conn.run_sync(schema_version.drop, checkfirst=True)
@@ -1,124 +1,201 @@
-from typing import List, Optional
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
 
-from sqlalchemy import ForeignKey, Integer, String
+from sqlalchemy import (
+    Boolean,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    and_,
+    case,
+    delete,
+    event,
+    func,
+    text,
+    true,
+    update,
+)
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.associationproxy import AssociationProxy, association_proxy
 from sqlalchemy.future import select
-from sqlalchemy.orm import (DeclarativeBase, Mapped, Session, mapped_column,
-                            relationship)
-
-session: Session = None
-# from database import session
-
-
-def set_session(some_session: Session):
-    """
-    Привязка моделей к сессии.<br>
-    models.session = some_session
-    """
-    global session
-    session = some_session
-
-
-from aiologger.formatters.json import (FUNCTION_NAME_FIELDNAME,
-                                       LOGGED_AT_FIELDNAME)
-# /\/\/\/\/\/\/\/\/\/\/\/\/\
-from aiologger.loggers.json import JsonLogger
-
-logger = JsonLogger.with_default_handlers(
-    level="DEBUG",
-    serializer_kwargs={"ensure_ascii": False},
-    exclude_fields=[
-        FUNCTION_NAME_FIELDNAME,
-        LOGGED_AT_FIELDNAME,
-        "file_path",
-        "line_number",
-    ],
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    Mapped,
+    Session,
+    mapped_column,
+    relationship,
 )
-# \/\/\/\/\/\/\/\/\/\/\/\/\/
+
+import BACK.broadcast as broadcast
+import BACK.config as config
+from BACK.cache import AuthUser, TTLCache
+from BACK.logs import logger
 
 
 class Base(DeclarativeBase):
     pass
 
 
+def _utcnow() -> datetime:
+    # Время ставит приложение: у колонок, добавленных миграцией в SQLite,
+    # значение по умолчанию в базе - постоянное (1970 год).
+    return datetime.now(timezone.utc)
+
+
+# Связи моделей не подгружаются сами (lazy="raise_on_sql"):
+# нужное - явно через options(selectinload(...)), чтение ленты и профиля -
+# колоночными запросами из projections.py.
+
+
 class User(Base):
     __tablename__ = "users"
     id = mapped_column(Integer, primary_key=True)
     api_key = mapped_column(String, index=True, unique=True, nullable=False)
     name = mapped_column(String, nullable=False)
+    # Денормализованные счетчики, меняются вместе с users_users
+    # (UserUser.follow / unfollow). Починка - recount_counters.
+    followers_count = mapped_column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    following_count = mapped_column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    # Растет при каждом изменении, видном в ленте или профиле: свои твиты,
+    # лайки своих твитов, подписки в обе стороны. Из него - ETag (etags.py).
+    version = mapped_column(Integer, nullable=False, default=0, server_default="0")
 
     tweets: Mapped[List["Tweet"]] = relationship(
-        lazy="selectin", back_populates="author"
+        lazy="raise_on_sql", back_populates="author"
     )
 
-    following: List["User"] = []
-    followers: List["User"] = []
-
-    def as_dict(self):
-        result = {c.name: getattr(self, c.name) for c in self.__table__.columns}
-        result.update({"followers": self.followers, "following": self.following})
-        return result
-
     @classmethod
-    async def get_by_api_key(cls, key: str) -> tuple["User", Optional[dict]]:
+    async def get_by_api_key(
+        cls, session: AsyncSession, key: str
+    ) -> tuple[Optional[AuthUser], Optional[dict]]:
         """
-        Возвращает пользователя по api-key и None.<br>
-        Либо наоборот - None и словарь с описанием ошибки.
+        Возвращает пользователя (id, name) по api-key и None.<br>
+        Либо наоборот - None и словарь с описанием ошибки.<br>
+        Найденные пользователи кэшируются (auth_cache), см. AUTH_CACHE_*.
         """
-        res = await session.execute(select(User).where(User.api_key == key))
-        res = res.scalar()
-        if res is None:
+        if config.AUTH_CACHE_ENABLED:
+            user = auth_cache.get(key)
+            if user is not None:
+                return user, None
+
+        res = await session.execute(
+            select(User.id, User.name).where(User.api_key == key)
+        )
+        row = res.first()
+        if row is None:
             logger.info(f"---===USER DOESN'T EXIST===---")
             return None, {
                 "result": False,
                 "error_type": "record not found",
                 "error_message": f"User with api-key: '{key}' doesn't exist.",
             }
-        return res, None
+        user = AuthUser(*row)
+        if config.AUTH_CACHE_ENABLED:
+            auth_cache.set(key, user, tag=user.id)
+        return user, None
 
-    async def get_up_follows(self):
+    @classmethod
+    async def touch(cls, session: AsyncSession, user_ids):
         """
-        Заполняет списки последователей и за кем следует сам. <br>
-        Применимо к объекту с уже сформированным id.
+        version + 1 пользователям user_ids (список или подзапрос id).<br>
+        Commit - за вызывающим.
         """
-        user_id = self.id
-        res = await session.execute(
-            (
-                select(User)
-                .join(UserUser, User.id == UserUser.id)
-                .filter(user_id == UserUser.follow_to_id)
-            )
+        await session.execute(
+            update(User).where(User.id.in_(user_ids)).values(version=User.version + 1)
         )
-        self.followers = res.scalars().all()
-        res = await session.execute(
-            (
-                select(User)
-                .join(UserUser, User.id == UserUser.follow_to_id)
-                .filter(user_id == UserUser.id)
-            )
-        )
-        self.following = res.scalars().all()
+
+
+#   КЭШ api-key -> пользователь
+#   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+auth_cache = TTLCache(config.AUTH_CACHE_SIZE, config.AUTH_CACHE_TTL)
+
+
+def invalidate_user(user_id: int):
+    """
+    Сбросить закэшированного пользователя (под любым его ключом).
+    """
+    auth_cache.invalidate_tag(user_id)
+
+
+broadcast.hub.register("auth.invalidate_user", invalidate_user)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _on_user_changed(mapper, connection, target: User):
+    # Сбрасываем сразу и ещё раз после commit: между flush и commit
+    # параллельный запрос мог успеть положить в кэш старую запись.
+    invalidate_user(target.id)
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault("changed_user_ids", set()).add(target.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _on_commit(session: Session):
+    # После commit - и в остальных процессах.
+    for user_id in session.info.pop("changed_user_ids", ()):
+        broadcast.hub.publish("auth.invalidate_user", user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _on_rollback(session: Session):
+    session.info.pop("changed_user_ids", None)
 
 
 class Tweet(Base):
     __tablename__ = "tweets"
+    # Лента листается по (author_id, id) - страница это диапазон индекса.
+    # Второй - только нераскладанные твиты "звезд" (timeline._merged_page).
+    __table_args__ = (
+        Index("ix_tweets_author_id_id", "author_id", "id"),
+        Index(
+            "ix_tweets_author_id_id_merged",
+            "author_id",
+            "id",
+            postgresql_where=text("NOT fanned_out"),
+            sqlite_where=text("NOT fanned_out"),
+        ),
+    )
+
     id = mapped_column(Integer, primary_key=True)
     content = mapped_column(String, nullable=False)
     author_id = mapped_column(Integer, ForeignKey("users.id"))
+    created_at = mapped_column(
+        DateTime(timezone=True),
+        default=_utcnow,
+        server_default=func.now(),
+        nullable=False,
+    )
+    # Меняется вместе с likes (Like.add / remove).
+    likes_count = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    # Режим "push": False - твит "звезды", в timeline_entries последователей
+    # его нет, лента подмешивает его при чтении. Решается один раз,
+    # при публикации (timeline.fan_out_tweet).
+    fanned_out = mapped_column(
+        Boolean, nullable=False, default=True, server_default=true()
+    )
 
     author: Mapped["User"] = relationship(
-        lazy="selectin", uselist=False, back_populates="tweets"
+        lazy="raise_on_sql", uselist=False, back_populates="tweets"
     )
 
-    attachments: List[str] = []
-
     pictures: Mapped[List["Picture"]] = relationship(
-        lazy="selectin",
+        lazy="raise_on_sql",
         cascade="all, delete-orphan",
     )
     like_as_user_tweet_ass: Mapped[List["Like"]] = relationship(
         back_populates="tweets",
-        lazy="selectin",
+        lazy="raise_on_sql",
         cascade="all, delete-orphan",
     )
     likes: AssociationProxy[List[User]] = association_proxy(
@@ -127,39 +204,340 @@ class Tweet(Base):
         creator=lambda user_obj: Like(user=user_obj),
     )
 
-    def get_attach_from_pic(self):
-        arr = self.pictures
-        self.attachments = []
-        for pic in arr:
-            self.attachments.append(pic.file_path)
+
+def _authors_of(tweet_ids):
+    # Подзапрос: авторы твитов - их version меняется вместе с лайками.
+    return select(Tweet.author_id).where(Tweet.id.in_(tweet_ids))
 
 
 class Like(Base):
     __tablename__ = "likes"
     user_id = mapped_column(Integer, ForeignKey("users.id"), primary_key=True)
-    tweet_id = mapped_column(Integer, ForeignKey("tweets.id"), primary_key=True)
+    # Ключ (user_id, tweet_id) не помогает искать лайки твита.
+    tweet_id = mapped_column(
+        Integer, ForeignKey("tweets.id"), primary_key=True, index=True
+    )
+    # Веса лайков в оценке популярности (popular.py) зависят от времени.
+    created_at = mapped_column(
+        DateTime(timezone=True),
+        default=_utcnow,
+        server_default=func.now(),
+        nullable=False,
+        index=True,
+    )
 
     tweets: Mapped[Tweet] = relationship(
-        lazy="selectin", back_populates="like_as_user_tweet_ass"
+        lazy="raise_on_sql", back_populates="like_as_user_tweet_ass"
+    )
+    user: Mapped[User] = relationship(lazy="raise_on_sql", uselist=False)
+
+    @classmethod
+    async def add(cls, session: AsyncSession, user_id: int, tweet_id: int):
+        """
+        Лайк и likes_count твита в одной транзакции. Commit - за вызывающим.
+        """
+        session.add(Like(user_id=user_id, tweet_id=tweet_id))
+        await session.flush()
+        await session.execute(
+            update(Tweet)
+            .where(Tweet.id == tweet_id)
+            .values(likes_count=Tweet.likes_count + 1)
+        )
+        await User.touch(session, _authors_of([tweet_id]))
+
+    @classmethod
+    async def remove(
+        cls, session: AsyncSession, user_id: int, tweet_id: int
+    ) -> Optional[datetime]:
+        """
+        Снять лайк. Возвращает время лайка, None - лайка не было.
+        Commit - за вызывающим.
+        """
+        res = await session.execute(
+            delete(Like)
+            .where(and_(Like.user_id == user_id, Like.tweet_id == tweet_id))
+            .returning(Like.created_at)
+        )
+        liked_at = res.scalar()
+        if liked_at is None:
+            return None
+        await session.execute(
+            update(Tweet)
+            .where(Tweet.id == tweet_id)
+            .values(likes_count=Tweet.likes_count - 1)
+        )
+        await User.touch(session, _authors_of([tweet_id]))
+        return liked_at
+
+    @classmethod
+    async def add_many(
+        cls, session: AsyncSession, user_id: int, tweet_ids: List[int]
+    ) -> Tuple[Set[int], Set[int]]:
+        """
+        Лайки сразу на несколько твитов - три запроса на весь список.<br>
+        Возвращает (id существующих твитов, id твитов, где лайк добавлен):
+        уже лайкнутые пропускаются. Commit - за вызывающим.
+        """
+        res = await session.execute(select(Tweet.id).where(Tweet.id.in_(tweet_ids)))
+        found = set(res.scalars())
+        if not found:
+            return found, set()
+        res = await session.execute(
+            insert(Like)
+            .values([{"user_id": user_id, "tweet_id": tweet_id} for tweet_id in found])
+            .on_conflict_do_nothing(index_elements=["user_id", "tweet_id"])
+            .returning(Like.tweet_id)
+        )
+        added = set(res.scalars())
+        if added:
+            await session.execute(
+                update(Tweet)
+                .where(Tweet.id.in_(added))
+                .values(likes_count=Tweet.likes_count + 1)
+            )
+            await User.touch(session, _authors_of(added))
+        return found, added
+
+    @classmethod
+    async def remove_many(
+        cls, session: AsyncSession, user_id: int, tweet_ids: List[int]
+    ) -> Dict[int, datetime]:
+        """
+        Снять лайки с нескольких твитов. Возвращает id твитов,
+        где лайк был и снят, и время лайка. Commit - за вызывающим.
+        """
+        res = await session.execute(
+            delete(Like)
+            .where(and_(Like.user_id == user_id, Like.tweet_id.in_(tweet_ids)))
+            .returning(Like.tweet_id, Like.created_at)
+        )
+        removed = dict(res.all())
+        if removed:
+            await session.execute(
+                update(Tweet)
+                .where(Tweet.id.in_(list(removed)))
+                .values(likes_count=Tweet.likes_count - 1)
+            )
+            await User.touch(session, _authors_of(list(removed)))
+        return removed
+
+
+class TweetScore(Base):
+    """
+    Оценка популярности твита (popular.py): меняется с каждым лайком,
+    периодически пересчитывается целиком.
+    """
+
+    __tablename__ = "tweet_scores"
+    tweet_id = mapped_column(
+        Integer, ForeignKey("tweets.id", ondelete="CASCADE"), primary_key=True
     )
-    user: Mapped[User] = relationship(lazy="selectin", uselist=False)
+    score = mapped_column(Float, nullable=False, index=True)
 
 
 class UserUser(Base):
     __tablename__ = "users_users"
+    # Обратный поиск - последователи пользователя, по возрастанию id.
+    __table_args__ = (Index("ix_users_users_follow_to_id_id", "follow_to_id", "id"),)
     id = mapped_column(Integer, ForeignKey("users.id"), primary_key=True)
     follow_to_id = mapped_column(Integer, ForeignKey("users.id"), primary_key=True)
 
     user: Mapped["User"] = relationship(
-        lazy="selectin", uselist=False, foreign_keys=[id]
+        lazy="raise_on_sql", uselist=False, foreign_keys=[id]
     )
     follow_to_user: Mapped["User"] = relationship(
-        lazy="selectin", uselist=False, foreign_keys=[follow_to_id]
+        lazy="raise_on_sql", uselist=False, foreign_keys=[follow_to_id]
+    )
+
+    @classmethod
+    async def follow(cls, session: AsyncSession, user_id: int, follow_to_id: int):
+        """
+        Подписка и счетчики обоих пользователей в одной транзакции.<br>
+        Commit - за вызывающим.
+        """
+        session.add(UserUser(id=user_id, follow_to_id=follow_to_id))
+        await session.flush()
+        await cls._shift_counters(session, user_id, [follow_to_id], 1)
+
+    @classmethod
+    async def unfollow(
+        cls, session: AsyncSession, user_id: int, follow_to_id: int
+    ) -> bool:
+        """
+        Отписка. False - подписки не было. Commit - за вызывающим.
+        """
+        res = await session.execute(
+            delete(UserUser).where(
+                and_(UserUser.id == user_id, UserUser.follow_to_id == follow_to_id)
+            )
+        )
+        if res.rowcount == 0:
+            return False
+        await cls._shift_counters(session, user_id, [follow_to_id], -1)
+        return True
+
+    @classmethod
+    async def follow_many(
+        cls, session: AsyncSession, user_id: int, follow_to_ids: List[int]
+    ) -> Tuple[Set[int], Set[int]]:
+        """
+        Подписка сразу на несколько пользователей.<br>
+        Возвращает (id существующих пользователей, id новых подписок):
+        уже имеющиеся подписки пропускаются. Commit - за вызывающим.
+        """
+        res = await session.execute(select(User.id).where(User.id.in_(follow_to_ids)))
+        found = set(res.scalars())
+        if not found:
+            return found, set()
+        res = await session.execute(
+            insert(UserUser)
+            .values(
+                [
+                    {"id": user_id, "follow_to_id": follow_to_id}
+                    for follow_to_id in found
+                ]
+            )
+            .on_conflict_do_nothing(index_elements=["id", "follow_to_id"])
+            .returning(UserUser.follow_to_id)
+        )
+        added = set(res.scalars())
+        if added:
+            await cls._shift_counters(session, user_id, list(added), 1)
+        return found, added
+
+    @classmethod
+    async def unfollow_many(
+        cls, session: AsyncSession, user_id: int, follow_to_ids: List[int]
+    ) -> Set[int]:
+        """
+        Отписка от нескольких пользователей. Возвращает id тех,
+        подписка на кого была и снята. Commit - за вызывающим.
+        """
+        res = await session.execute(
+            delete(UserUser)
+            .where(
+                and_(UserUser.id == user_id, UserUser.follow_to_id.in_(follow_to_ids))
+            )
+            .returning(UserUser.follow_to_id)
+        )
+        removed = set(res.scalars())
+        if removed:
+            await cls._shift_counters(session, user_id, list(removed), -1)
+        return removed
+
+    @staticmethod
+    async def _shift_counters(
+        session: AsyncSession, user_id: int, follow_to_ids: List[int], delta: int
+    ):
+        await session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(
+                following_count=User.following_count + delta * len(follow_to_ids),
+                version=User.version + 1,
+            )
+        )
+        await session.execute(
+            update(User)
+            .where(User.id.in_(follow_to_ids))
+            .values(
+                followers_count=User.followers_count + delta, version=User.version + 1
+            )
+        )
+
+
+class Media(Base):
+    """
+    Файл в хранилище (media_store.py), один на одинаковое содержимое.<br>
+    ref_count - сколько записей pictures на него ссылается.
+    """
+
+    __tablename__ = "media"
+    id = mapped_column(Integer, primary_key=True)
+    content_hash = mapped_column(String(64), nullable=False, unique=True)
+    file_path = mapped_column(String, nullable=False)
+    size = mapped_column(Integer, nullable=False)
+    ref_count = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    # Уменьшенные копии (derivatives.py), пусто - еще не готовы.
+    feed_path = mapped_column(String, nullable=True)
+    thumb_path = mapped_column(String, nullable=True)
+    created_at = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
     )
 
+    @classmethod
+    async def release(cls, session: AsyncSession, media_ids: List[Optional[int]]):
+        """
+        Минус ссылка на каждый id из списка (повторы - минус несколько),
+        одним update на все id.<br>
+        Файлы без ссылок удаляет фоновая уборка. Commit - за вызывающим.
+        """
+        counts = Counter(filter(None, media_ids))
+        if not counts:
+            return
+        await session.execute(
+            update(Media)
+            .where(Media.id.in_(list(counts)))
+            .values(ref_count=Media.ref_count - case(counts, value=Media.id))
+        )
+
 
 class Picture(Base):
     __tablename__ = "pictures"
     id = mapped_column(Integer, primary_key=True)
-    tweet_id = mapped_column(Integer, ForeignKey("tweets.id"), nullable=True)
+    tweet_id = mapped_column(
+        Integer, ForeignKey("tweets.id"), nullable=True, index=True
+    )
     file_path = mapped_column(String, nullable=False)
+    # Пусто у картинок, загруженных до хранилища по хэшу.
+    media_id = mapped_column(Integer, ForeignKey("media.id"), nullable=True, index=True)
+    # По нему фоновая уборка находит давно брошенные загрузки (tweet_id = 0).
+    created_at = mapped_column(
+        DateTime(timezone=True),
+        default=_utcnow,
+        server_default=func.now(),
+        nullable=False,
+    )
+
+
+class TimelineEntry(Base):
+    """
+    Материализованная лента: твит tweet_id в ленте пользователя user_id.<br>
+    Заполняется только в режиме TIMELINE_MODE = "push" (см. timeline.py).
+    """
+
+    __tablename__ = "timeline_entries"
+    # Отписка убирает из ленты все твиты автора.
+    __table_args__ = (
+        Index("ix_timeline_entries_user_id_author_id", "user_id", "author_id"),
+    )
+
+    user_id = mapped_column(Integer, ForeignKey("users.id"), primary_key=True)
+    tweet_id = mapped_column(
+        Integer, ForeignKey("tweets.id"), primary_key=True, index=True
+    )
+    author_id = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
+
+
+async def recount_counters(session: AsyncSession):
+    """
+    Пересчет денормализованных счетчиков по самим таблицам связей.<br>
+    Commit - за вызывающим.
+    """
+    await session.execute(
+        update(User).values(
+            followers_count=select(func.count())
+            .where(UserUser.follow_to_id == User.id)
+            .scalar_subquery(),
+            following_count=select(func.count())
+            .where(UserUser.id == User.id)
+            .scalar_subquery(),
+        )
+    )
+    await session.execute(
+        update(Tweet).values(
+            likes_count=select(func.count())
+            .where(Like.tweet_id == Tweet.id)
+            .scalar_subquery()
+        )
+    )
@@ -0,0 +1,265 @@
+"""
+Популярные твиты (GET /api/tweets/popular).<br>
+Оценка твита - сумма весов его лайков: 2 ** ((t - base) / POPULAR_HALF_LIFE),
+t - время лайка. Общий множитель порядка не меняет, поэтому затухание
+старых лайков - это рост веса новых, и оценку можно только дополнять:
+лайк прибавляет свой вес, снятый лайк - вычитает (таблица tweet_scores).<br>
+base сдвигается каждые POPULAR_REBUILD_INTERVAL, тогда же фоновая
+пересборка (rebuild) пересчитывает оценки по лайкам за POPULAR_WINDOW
+от нового base - веса не растут неограниченно. До пересборки лайки
+нового периода считаются от нового base, а прежние оценки - от старого:
+погрешность не больше 2 ** (POPULAR_REBUILD_INTERVAL / POPULAR_HALF_LIFE).<br>
+Пересборка закрывает запись оценок до своего commit - прибавки лайков,
+пришедших во время нее, не теряются (rebuild).<br>
+Чтение - из верхних POPULAR_TOP_K в памяти процесса (board): страница -
+срез отсортированного списка, база только для загрузки после пересборки.
+"""
+
+import asyncio
+import bisect
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import case, delete, insert, text, update
+from sqlalchemy.dialects.postgresql import insert as upsert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.future import select
+
+import BACK.broadcast as broadcast
+import BACK.config as config
+from BACK.logs import logger
+from BACK.models import Like, TweetScore
+from BACK.process_lock import ProcessLock
+
+# Оценка меньше - твит выпадает из популярного (все лайки сняты).
+MIN_SCORE = 1e-12
+
+
+def enabled() -> bool:
+    return config.POPULAR_ENABLED
+
+
+def base_for(now: float) -> float:
+    return now - now % config.POPULAR_REBUILD_INTERVAL
+
+
+def weight(at: float, base: float) -> float:
+    return 2 ** ((at - base) / config.POPULAR_HALF_LIFE)
+
+
+def _timestamp(value: datetime) -> float:
+    # SQLite отдает время без пояса - это UTC (CURRENT_TIMESTAMP).
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+#   ВЕРХ В ПАМЯТИ
+#   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+class PopularBoard:
+    """
+    Лучшие size твитов по оценке. Ключ сортировки (-оценка, -id):
+    выше оценка, при равной - новее.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.loaded = False
+        self._keys: List[Tuple[float, int]] = []
+        self._by_id: Dict[int, Tuple[float, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def load(self, scores: Iterable[Tuple[int, float]]):
+        self._keys = sorted(
+            (-score, -tweet_id) for tweet_id, score in scores if score >= MIN_SCORE
+        )[: self.size]
+        self._by_id = {-key[1]: key for key in self._keys}
+        self.loaded = True
+
+    def offer(self, scores: Iterable[Tuple[int, float]]):
+        """
+        Новые оценки твитов. Пока верх не загружен - не нужны:
+        загрузка возьмет их из базы.
+        """
+        if not self.loaded:
+            return
+        for tweet_id, score in scores:
+            self.discard(tweet_id)
+            if score < MIN_SCORE:
+                continue
+            key = (-score, -tweet_id)
+            if len(self._keys) >= self.size and key >= self._keys[-1]:
+                continue
+            bisect.insort(self._keys, key)
+            self._by_id[tweet_id] = key
+            if len(self._keys) > self.size:
+                del self._by_id[-self._keys.pop()[1]]
+
+    def discard(self, tweet_id: int):
+        key = self._by_id.pop(tweet_id, None)
+        if key is not None:
+            del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def invalidate(self):
+        self.loaded = False
+        self._keys = []
+        self._by_id = {}
+
+    def page(
+        self, limit: int, after: Optional[Tuple[float, int]] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        (id, оценка) одной страницы. after - (оценка, id) последнего
+        твита предыдущей страницы.
+        """
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right(self._keys, (-after[0], -after[1]))
+        return [(-key[1], -key[0]) for key in self._keys[start : start + limit]]
+
+
+board = PopularBoard(config.POPULAR_TOP_K)
+
+broadcast.hub.register("popular.offer", board.offer, coarse="popular.invalidate")
+broadcast.hub.register("popular.discard", board.discard)
+broadcast.hub.register("popular.invalidate", board.invalidate)
+
+
+async def load_page(
+    session: AsyncSession, limit: int, after: Optional[Tuple[float, int]] = None
+) -> List[Tuple[int, float]]:
+    if not board.loaded:
+        res = await session.execute(
+            select(TweetScore.tweet_id, TweetScore.score)
+            .order_by(TweetScore.score.desc(), TweetScore.tweet_id.desc())
+            .limit(board.size)
+        )
+        board.load(res.all())
+    return board.page(limit, after)
+
+
+#   ОЦЕНКИ В БАЗЕ
+#   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+async def record_likes(
+    session: AsyncSession, tweet_ids: List[int]
+) -> List[Tuple[int, float]]:
+    """
+    Новые лайки твитов: + вес текущего времени. Возвращает новые оценки
+    (для board.offer после commit). Commit - за вызывающим.
+    """
+    if not tweet_ids:
+        return []
+    now = time.time()
+    added = weight(now, base_for(now))
+    query = upsert(TweetScore).values(
+        [{"tweet_id": tweet_id, "score": added} for tweet_id in tweet_ids]
+    )
+    res = await session.execute(
+        query.on_conflict_do_update(
+            index_elements=[TweetScore.tweet_id],
+            set_={"score": TweetScore.score + query.excluded.score},
+        ).returning(TweetScore.tweet_id, TweetScore.score)
+    )
+    return [tuple(row) for row in res]
+
+
+async def retract_likes(
+    session: AsyncSession, liked_at: Dict[int, datetime]
+) -> List[Tuple[int, float]]:
+    """
+    Снятые лайки (id твита -> время лайка): - вес времени лайка.
+    Лайки старше POPULAR_WINDOW в оценке уже не учтены.
+    Commit - за вызывающим.
+    """
+    now = time.time()
+    base = base_for(now)
+    cutoff = now - config.POPULAR_WINDOW
+    removed = {
+        tweet_id: weight(_timestamp(at), base)
+        for tweet_id, at in liked_at.items()
+        if _timestamp(at) >= cutoff
+    }
+    if not removed:
+        return []
+    res = await session.execute(
+        update(TweetScore)
+        .where(TweetScore.tweet_id.in_(list(removed)))
+        .values(score=TweetScore.score - case(removed, value=TweetScore.tweet_id))
+        .returning(TweetScore.tweet_id, TweetScore.score)
+    )
+    return [tuple(row) for row in res]
+
+
+async def discard_scores(session: AsyncSession, tweet_ids: List[int]):
+    """
+    Оценки удаляемых твитов. Явно, а не ON DELETE CASCADE: SQLite
+    без PRAGMA foreign_keys каскад не выполняет. Commit - за вызывающим.
+    """
+    await session.execute(delete(TweetScore).where(TweetScore.tweet_id.in_(tweet_ids)))
+
+
+async def rebuild(session: AsyncSession) -> int:
+    """
+    Пересчитывает tweet_scores по лайкам за POPULAR_WINDOW от текущего base.
+    Возвращает число твитов с оценкой.<br>
+    Commit - за вызывающим, верх в памяти после commit нужно сбросить
+    (popular.invalidate).<br>
+    До commit запись в tweet_scores закрыта (Postgres - LOCK TABLE,
+    SQLite - блокировка записи первым delete): иначе прибавка лайка,
+    закоммиченная во время чтения лайков, стерлась бы вместе со старыми
+    оценками. Лайк, чья прибавка ждет блокировку, в чтение не попадает
+    (еще не закоммичен) и прибавляется после.
+    """
+    now = time.time()
+    base = base_for(now)
+    cutoff = datetime.fromtimestamp(now - config.POPULAR_WINDOW, timezone.utc)
+    scores: Dict[int, float] = defaultdict(float)
+    if session.bind.dialect.name == "postgresql":
+        # Чтение оценок не блокируется, record_likes / retract_likes ждут.
+        await session.execute(text("LOCK TABLE tweet_scores IN EXCLUSIVE MODE"))
+    await session.execute(delete(TweetScore))
+    # Поток строк, а не список: лайков за окно может быть много.
+    rows = await session.stream(
+        select(Like.tweet_id, Like.created_at)
+        .where(Like.created_at >= cutoff)
+        .execution_options(yield_per=10000)
+    )
+    async for tweet_id, created_at in rows:
+        scores[tweet_id] += weight(_timestamp(created_at), base)
+    if scores:
+        await session.execute(
+            insert(TweetScore),
+            [
+                {"tweet_id": tweet_id, "score": score}
+                for tweet_id, score in scores.items()
+            ],
+        )
+    return len(scores)
+
+
+async def run_periodically(
+    session_maker: async_sessionmaker[AsyncSession],
+    lock: Optional[ProcessLock] = None,
+):
+    """
+    Пересборка каждые POPULAR_REBUILD_INTERVAL секунд (сразу после сдвига
+    base), до отмены задачи. lock - пересобирает только его держатель.
+    """
+    while True:
+        now = time.time()
+        await asyncio.sleep(base_for(now) + config.POPULAR_REBUILD_INTERVAL - now)
+        if lock is not None and not lock.try_acquire():
+            continue
+        try:
+            async with session_maker() as session:
+                count = await rebuild(session)
+                await session.commit()
+        except Exception:
+            logger.exception("---=== POPULAR REBUILD FAILED ===---")
+            continue
+        broadcast.hub.publish("popular.invalidate")
+        logger.info(f"---=== POPULAR REBUILT: {count} tweets ===---")
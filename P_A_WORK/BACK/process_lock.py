@@ -0,0 +1,47 @@
+"""
+Блокировка "только один процесс" для рабочих процессов одной машины.<br>
+flock на файле RUN_DIR/<name>.lock: держит тот, кто первым открыл,
+до release или своего завершения - тогда ее подхватит следующий
+try_acquire другого процесса.
+"""
+
+import fcntl
+import os
+from typing import Optional
+
+import BACK.config as config
+
+
+class ProcessLock:
+    def __init__(self, name: str, directory: Optional[str] = None):
+        self.path = os.path.join(directory or config.RUN_DIR, f"{name}.lock")
+        self._fd: Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        """
+        Не ждет: True - блокировка у этого процесса (в том числе уже была).
+        """
+        if self._fd is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
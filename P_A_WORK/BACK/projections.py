@@ -0,0 +1,217 @@
+"""
+Путь чтения для ленты и профиля.<br>
+Выбираются только нужные схемам TweetOut / UserModel колонки,
+строки складываются в лёгкие объекты со __slots__ - без ORM и identity map.<br>
+as_dict() - то же, что дала бы схема, для fast_json (ключи в порядке схемы).
+"""
+
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from BACK.models import Like, Media, Picture, Tweet, User, UserUser
+
+
+class ShortUserRow:
+    __slots__ = ("id", "name")
+
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+
+    def as_dict(self) -> dict:
+        return {"id": self.id, "name": self.name}
+
+
+class UserRow(ShortUserRow):
+    __slots__ = ("followers", "following", "followers_count", "following_count")
+
+    def __init__(self, id: int, name: str, followers_count: int, following_count: int):
+        super().__init__(id, name)
+        self.followers: List[ShortUserRow] = []
+        self.following: List[ShortUserRow] = []
+        self.followers_count = followers_count
+        self.following_count = following_count
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "followers": [user.as_dict() for user in self.followers],
+            "following": [user.as_dict() for user in self.following],
+            "followers_count": self.followers_count,
+            "following_count": self.following_count,
+        }
+
+
+class TweetRow:
+    __slots__ = ("id", "content", "author", "attachments", "likes", "likes_count")
+
+    def __init__(self, id: int, content: str, likes_count: int, author: ShortUserRow):
+        self.id = id
+        self.content = content
+        self.author = author
+        self.attachments: List[str] = []
+        self.likes: List[ShortUserRow] = []
+        self.likes_count = likes_count
+
+    def as_dict(self) -> dict:
+        return {
+            "content": self.content,
+            "attachments": self.attachments,
+            "id": self.id,
+            "author": self.author.as_dict(),
+            "likes": [user.as_dict() for user in self.likes],
+            "likes_count": self.likes_count,
+        }
+
+
+def _tweet_columns():
+    return select(Tweet.id, Tweet.content, Tweet.likes_count, User.id, User.name).join(
+        User, User.id == Tweet.author_id
+    )
+
+
+async def _load_tweet_rows(session: AsyncSession, query) -> List[TweetRow]:
+    """
+    Выполняет запрос из _tweet_columns() и дотягивает к твитам
+    вложения и лайкнувших - ещё два плоских запроса на всю страницу.
+    """
+    res = await session.execute(query)
+    authors: Dict[int, ShortUserRow] = {}
+    tweets: Dict[int, TweetRow] = {}
+    for tweet_id, content, likes_count, author_id, author_name in res:
+        author = authors.get(author_id)
+        if author is None:
+            author = authors[author_id] = ShortUserRow(author_id, author_name)
+        tweets[tweet_id] = TweetRow(tweet_id, content, likes_count, author)
+    if not tweets:
+        return []
+
+    # В ленту - уменьшенная копия, если она уже готова.
+    res = await session.execute(
+        select(Picture.tweet_id, func.coalesce(Media.feed_path, Picture.file_path))
+        .outerjoin(Media, Media.id == Picture.media_id)
+        .where(Picture.tweet_id.in_(list(tweets)))
+        .order_by(Picture.id)
+    )
+    for tweet_id, file_path in res:
+        tweets[tweet_id].attachments.append(file_path)
+
+    res = await session.execute(
+        select(Like.tweet_id, User.id, User.name)
+        .join(User, User.id == Like.user_id)
+        .where(Like.tweet_id.in_(list(tweets)))
+    )
+    likers: Dict[int, ShortUserRow] = {}
+    for tweet_id, user_id, user_name in res:
+        liker = likers.get(user_id)
+        if liker is None:
+            liker = likers[user_id] = ShortUserRow(user_id, user_name)
+        tweets[tweet_id].likes.append(liker)
+    return list(tweets.values())
+
+
+async def load_tweets_by_ids(
+    session: AsyncSession, tweet_ids: List[int]
+) -> List[TweetRow]:
+    """
+    Твиты по списку id в том же порядке. Несуществующие id пропускаются.
+    """
+    if not tweet_ids:
+        return []
+    rows = await _load_tweet_rows(
+        session, _tweet_columns().where(Tweet.id.in_(tweet_ids))
+    )
+    by_id = {row.id: row for row in rows}
+    return [by_id[tweet_id] for tweet_id in tweet_ids if tweet_id in by_id]
+
+
+async def load_feed_page(
+    session: AsyncSession,
+    user_id: int,
+    limit: int,
+    before_id: Optional[int] = None,
+) -> List[TweetRow]:
+    """
+    Одна страница ленты пользователя:<br>
+    свои твиты и твиты тех, за кем следит, от новых к старым.<br>
+    before_id - id последнего твита предыдущей страницы.
+    """
+    followed = select(UserUser.follow_to_id).where(UserUser.id == user_id)
+    query = _tweet_columns().where(
+        or_(Tweet.author_id == user_id, Tweet.author_id.in_(followed))
+    )
+    if before_id is not None:
+        query = query.where(Tweet.id < before_id)
+    return await _load_tweet_rows(session, query.order_by(Tweet.id.desc()).limit(limit))
+
+
+async def load_follows_page(
+    session: AsyncSession,
+    user_id: int,
+    followers: bool,
+    limit: int,
+    after_id: Optional[int] = None,
+) -> List[ShortUserRow]:
+    """
+    Страница последователей (followers=True) или подписок пользователя,
+    по возрастанию id. after_id - id последнего с предыдущей страницы.
+    """
+    if followers:
+        own_column, other_column = UserUser.follow_to_id, UserUser.id
+    else:
+        own_column, other_column = UserUser.id, UserUser.follow_to_id
+    query = (
+        select(User.id, User.name)
+        .join(UserUser, User.id == other_column)
+        .where(own_column == user_id)
+    )
+    if after_id is not None:
+        query = query.where(other_column > after_id)
+    res = await session.execute(query.order_by(other_column).limit(limit))
+    return [ShortUserRow(*row) for row in res]
+
+
+async def load_users_by_ids(
+    session: AsyncSession, user_ids: List[int]
+) -> List[UserRow]:
+    """
+    Пользователи (id, имя, счетчики) по списку id в том же порядке,
+    одним запросом. Несуществующие id пропускаются.
+    """
+    if not user_ids:
+        return []
+    res = await session.execute(
+        select(User.id, User.name, User.followers_count, User.following_count).where(
+            User.id.in_(user_ids)
+        )
+    )
+    by_id = {row.id: UserRow(*row) for row in res}
+    return [by_id[user_id] for user_id in user_ids if user_id in by_id]
+
+
+async def load_user_profile(
+    session: AsyncSession, user_id: int, follows_limit: int
+) -> Optional[UserRow]:
+    """
+    Профиль: id, имя, счетчики и первые follows_limit последователей
+    и подписок.<br>
+    None - пользователя нет.
+    """
+    res = await session.execute(
+        select(User.id, User.name, User.followers_count, User.following_count).where(
+            User.id == user_id
+        )
+    )
+    row = res.first()
+    if row is None:
+        return None
+    user = UserRow(*row)
+    if user.followers_count:
+        user.followers = await load_follows_page(session, user_id, True, follows_limit)
+    if user.following_count:
+        user.following = await load_follows_page(session, user_id, False, follows_limit)
+    return user
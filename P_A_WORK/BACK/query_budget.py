@@ -0,0 +1,170 @@
+"""
+Бюджет SQL-выражений на обработчик и поиск N+1.<br>
+Обработчик объявляет бюджет декоратором @budget(n). Прослойка записывает
+выражения запроса (события движка) и после ответа проверяет:
+не больше ли их, чем n, и нет ли одного и того же выражения,
+повторенного QUERY_REPEAT_THRESHOLD и более раз (N+1).<br>
+QUERY_BUDGET_MODE: "off" - ничего не подключается, "log" - запись в лог,
+"raise" - исключение QueryBudgetExceeded (для тестов).<br>
+Для pytest - assert_statements(engine, n).
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+import BACK.config as config
+from BACK.logs import logger
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def budget(statements: int) -> Callable:
+    """
+    Декоратор обработчика: не больше statements SQL-выражений на запрос.
+    """
+
+    def mark(handler: Callable) -> Callable:
+        handler.query_budget = statements
+        return handler
+
+    return mark
+
+
+class QueryRecorder:
+    """
+    Выражения одного запроса (или блока в тесте), по порядку.
+    """
+
+    def __init__(self):
+        self.statements: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.statements)
+
+    def record(self, statement: str):
+        self.statements.append(statement)
+
+    def repeated(self, threshold: int) -> List[str]:
+        """
+        Выражения, выполненные threshold и более раз - признак N+1.
+        """
+        return [
+            statement
+            for statement, count in Counter(self.statements).items()
+            if count >= threshold
+        ]
+
+    def problems(self, limit: Optional[int], threshold: int) -> List[str]:
+        found = []
+        if limit is not None and len(self) > limit:
+            found.append(f"{len(self)} SQL statements, budget is {limit}")
+        for statement in self.repeated(threshold):
+            found.append(
+                f"repeated {self.statements.count(statement)} times: {statement}"
+            )
+        return found
+
+
+current_recorder: ContextVar[Optional[QueryRecorder]] = ContextVar(
+    "current_recorder", default=None
+)
+
+
+def _record_request_statement(conn, cursor, statement, parameters, context, many):
+    recorder = current_recorder.get()
+    if recorder is not None:
+        recorder.record(statement)
+
+
+def instrument_engine(engine: AsyncEngine):
+    sync_engine = engine.sync_engine
+    if not event.contains(
+        sync_engine, "before_cursor_execute", _record_request_statement
+    ):
+        event.listen(sync_engine, "before_cursor_execute", _record_request_statement)
+
+
+class QueryBudgetMiddleware:
+    """
+    ASGI-прослойка: записывает выражения запроса и сверяет
+    с бюджетом обработчика (scope["endpoint"]).
+    """
+
+    def __init__(self, app, mode: str, threshold: int):
+        self.app = app
+        self.mode = mode
+        self.threshold = threshold
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        recorder = QueryRecorder()
+        token = current_recorder.set(recorder)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_recorder.reset(token)
+
+        endpoint = scope.get("endpoint")
+        problems = recorder.problems(
+            getattr(endpoint, "query_budget", None), self.threshold
+        )
+        if not problems:
+            return
+        message = f"{scope['method']} {scope['path']}: " + "; ".join(problems)
+        if self.mode == "raise":
+            raise QueryBudgetExceeded(message)
+        logger.warning(f"---=== QUERY BUDGET: {message} ===---")
+
+
+def setup(app, *engines: AsyncEngine):
+    """
+    Подключает проверку бюджетов, если QUERY_BUDGET_MODE не "off".
+    """
+    if config.QUERY_BUDGET_MODE == "off":
+        return
+    for engine in engines:
+        instrument_engine(engine)
+    app.add_middleware(
+        QueryBudgetMiddleware,
+        mode=config.QUERY_BUDGET_MODE,
+        threshold=config.QUERY_REPEAT_THRESHOLD,
+    )
+
+
+@contextmanager
+def assert_statements(
+    engine: AsyncEngine,
+    limit: Optional[int] = None,
+    threshold: Optional[int] = None,
+) -> Iterator[QueryRecorder]:
+    """
+    Для тестов: все выражения движка внутри блока (в любом потоке)
+    не больше limit и без повторов threshold и более раз.<br>
+    with assert_statements(engine, 3) as recorder: ...
+    """
+    recorder = QueryRecorder()
+
+    def record(conn, cursor, statement, parameters, context, many):
+        recorder.record(statement)
+
+    sync_engine: Engine = engine.sync_engine
+    event.listen(sync_engine, "before_cursor_execute", record)
+    try:
+        yield recorder
+    finally:
+        event.remove(sync_engine, "before_cursor_execute", record)
+    problems = recorder.problems(
+        limit, config.QUERY_REPEAT_THRESHOLD if threshold is None else threshold
+    )
+    if problems:
+        raise QueryBudgetExceeded("; ".join(problems))
@@ -0,0 +1,256 @@
+"""
+Фоновая уборка картинок.<br>
+1. Картинки, так и не привязанные к твиту (tweet_id = 0) дольше
+REAPER_ORPHAN_AGE секунд, - удаляются, их media теряет ссылку.<br>
+2. media без ссылок (ref_count <= 0: брошенные загрузки, удаленные
+твиты) - удаляются вместе с файлом и уменьшенными копиями.<br>
+3. Файлы в хранилище, на которые нет записи media (остатки сбоев),
+и забытые временные файлы - удаляются.<br>
+Всё - порциями по REAPER_BATCH, файлы удаляются вне event loop,
+не больше REAPER_IO_CONCURRENCY одновременно.
+"""
+
+import asyncio
+import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import and_, delete
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.future import select
+
+import BACK.config as config
+import BACK.media_store as media_store
+from BACK.logs import logger
+from BACK.models import Media, Picture
+from BACK.process_lock import ProcessLock
+
+# Имя файла в хранилище: sha256 + расширение или _вариант.webp.
+_STORED_NAME_RE = re.compile(r"^([0-9a-f]{64})(?:_[a-z]+\.webp|\.[a-z0-9]{1,8})?$")
+
+
+class ReapResult(NamedTuple):
+    pictures: int = 0
+    media: int = 0
+    files: int = 0
+    bytes: int = 0
+
+    def __add__(self, other: "ReapResult") -> "ReapResult":
+        return ReapResult(*(a + b for a, b in zip(self, other)))
+
+
+def _remove_file(path: str) -> int:
+    """
+    Удаляет файл, возвращает его размер (0 - файла уже нет).
+    """
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+async def _remove_files(paths: Iterable[str]) -> Tuple[int, int]:
+    """
+    Удаление файлов в потоках, не больше REAPER_IO_CONCURRENCY разом.<br>
+    Возвращает (сколько удалено, сколько байт).
+    """
+    semaphore = asyncio.Semaphore(config.REAPER_IO_CONCURRENCY)
+
+    async def remove(path: str) -> int:
+        async with semaphore:
+            return await asyncio.to_thread(_remove_file, path)
+
+    sizes = await asyncio.gather(*(remove(path) for path in paths))
+    return sum(1 for size in sizes if size), sum(sizes)
+
+
+async def reap_orphan_pictures(session: AsyncSession, cutoff: datetime) -> ReapResult:
+    """
+    Порция непривязанных картинок старше cutoff. Commit - здесь.
+    """
+    res = await session.execute(
+        select(Picture.id)
+        .where(and_(Picture.tweet_id == 0, Picture.created_at < cutoff))
+        .order_by(Picture.id)
+        .limit(config.REAPER_BATCH)
+    )
+    picture_ids = list(res.scalars())
+    if not picture_ids:
+        return ReapResult()
+    # Условия повторяются в delete: картинку, которую между select и
+    # delete привязал add_tweet, не трогаем (и ссылку ее media тоже).
+    res = await session.execute(
+        delete(Picture)
+        .where(
+            and_(
+                Picture.id.in_(picture_ids),
+                Picture.tweet_id == 0,
+                Picture.created_at < cutoff,
+            )
+        )
+        .returning(Picture.media_id)
+    )
+    media_ids = list(res.scalars())
+    await Media.release(session, media_ids)
+    await session.commit()
+    return ReapResult(pictures=len(media_ids))
+
+
+async def reap_unreferenced_media(session: AsyncSession) -> ReapResult:
+    """
+    Порция media без ссылок: записи, затем файлы. Commit - здесь,
+    после удаления файлов: загрузка того же содержимого (upsert записи)
+    ждет этого commit и уже видит, что файла нет (media_store.place).
+    """
+    res = await session.execute(
+        select(Media.id).where(Media.ref_count <= 0).limit(config.REAPER_BATCH)
+    )
+    media_ids = list(res.scalars())
+    if not media_ids:
+        return ReapResult()
+    # Условие повторяется в delete: если между select и delete та же
+    # картинка загружена снова (ref_count + 1), запись остается.
+    res = await session.execute(
+        delete(Media)
+        .where(and_(Media.id.in_(media_ids), Media.ref_count <= 0))
+        .returning(
+            Media.content_hash, Media.file_path, Media.feed_path, Media.thumb_path
+        )
+    )
+    deleted = res.all()
+    if not deleted:
+        await session.commit()
+        return ReapResult()
+    paths = [
+        path
+        for row in deleted
+        for path in (row.file_path, row.feed_path, row.thumb_path)
+        if path
+    ]
+    try:
+        files, size = await _remove_files(paths)
+    finally:
+        await session.commit()
+    return ReapResult(media=len(deleted), files=files, bytes=size)
+
+
+def _scan_tmp(tmp_root: str, older_than: float) -> List[Tuple[str, Optional[str]]]:
+    """
+    Временные файлы загрузок старше older_than: (путь, None).
+    """
+    if not os.path.isdir(tmp_root):
+        return []
+    found = []
+    with os.scandir(tmp_root) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < older_than:
+                    found.append((entry.path, None))
+            except FileNotFoundError:
+                continue
+    return found
+
+
+def _scan_store(media_root: str, older_than: float) -> List[Tuple[str, Optional[str]]]:
+    """
+    Файлы хранилища старше older_than (time.time()):
+    (путь, хэш) - для временных файлов хэш None (каталог tmp внутри
+    хранилища - от прежних версий).
+    Файлы старой раскладки (IMG/<пользователь>/...) не трогаются.
+    """
+    found = []
+    for root, dirs, files in os.walk(media_root):
+        relative = os.path.relpath(root, media_root).split(os.sep)
+        if relative == ["."]:
+            dirs[:] = [name for name in dirs if len(name) == 2 or name == "tmp"]
+            continue
+        is_tmp = relative == ["tmp"]
+        if len(relative) == 1 and not is_tmp:
+            dirs[:] = [name for name in dirs if len(name) == 2]
+            continue
+        dirs[:] = []
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) >= older_than:
+                    continue
+            except FileNotFoundError:
+                continue
+            if is_tmp:
+                found.append((path, None))
+                continue
+            match = _STORED_NAME_RE.match(name)
+            if match:
+                found.append((path, match.group(1)))
+    return found
+
+
+async def reap_stray_files(session: AsyncSession, older_than: float) -> ReapResult:
+    """
+    Файлы хранилища без записи media и старые временные файлы.
+    """
+    found = await asyncio.to_thread(_scan_store, config.MEDIA_ROOT, older_than)
+    found += await asyncio.to_thread(_scan_tmp, media_store.tmp_root(), older_than)
+    result = ReapResult()
+    for start in range(0, len(found), config.REAPER_BATCH):
+        batch = found[start : start + config.REAPER_BATCH]
+        hashes = {content_hash for _, content_hash in batch if content_hash}
+        known = set()
+        if hashes:
+            res = await session.execute(
+                select(Media.content_hash).where(Media.content_hash.in_(hashes))
+            )
+            known = set(res.scalars())
+        files, size = await _remove_files(
+            path for path, content_hash in batch if content_hash not in known
+        )
+        result += ReapResult(files=files, bytes=size)
+    return result
+
+
+async def reap(session_maker: async_sessionmaker[AsyncSession]) -> ReapResult:
+    """
+    Один полный проход уборки. Возвращает, сколько убрано.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=config.REAPER_ORPHAN_AGE)
+    result = ReapResult()
+    async with session_maker() as session:
+        while True:
+            step = await reap_orphan_pictures(session, cutoff)
+            result += step
+            if step.pictures < config.REAPER_BATCH:
+                break
+        while True:
+            step = await reap_unreferenced_media(session)
+            result += step
+            if step.media < config.REAPER_BATCH:
+                break
+        result += await reap_stray_files(
+            session, time.time() - config.REAPER_ORPHAN_AGE
+        )
+    return result
+
+
+async def run_periodically(
+    session_maker: async_sessionmaker[AsyncSession],
+    lock: Optional[ProcessLock] = None,
+):
+    """
+    Уборка каждые REAPER_INTERVAL секунд, до отмены задачи.<br>
+    lock - из нескольких рабочих процессов убирает только его держатель.
+    """
+    while True:
+        await asyncio.sleep(config.REAPER_INTERVAL)
+        if lock is not None and not lock.try_acquire():
+            continue
+        try:
+            result = await reap(session_maker)
+        except Exception:
+            logger.exception("---=== REAPER FAILED ===---")
+            continue
+        if any(result):
+            logger.info(f"---=== REAPER: {result._asdict()} ===---")
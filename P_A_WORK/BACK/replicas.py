@@ -0,0 +1,89 @@
+"""
+Чтение с реплики.<br>
+GET-маршруты /api/ получают сессию реплики (DATABASE_REPLICA_URL),
+все остальные - основной базы. Без реплики все идет в основную.<br>
+Реплика отстает, поэтому после записи клиент REPLICA_STICKY_SECONDS
+читает с основной базы - видит свои же изменения. Клиент - api-key:
+им помечается любой запрос на запись. Отметки рассылаются остальным
+процессам (broadcast.py) - следующий запрос может попасть в другой.<br>
+Кэши в памяти (кольца лент) с реплики не прогреваются: отставшая
+реплика оставила бы в них устаревшую ленту до сброса.
+"""
+
+import hashlib
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+import BACK.broadcast as broadcast
+import BACK.config as config
+import BACK.metrics as metrics
+from BACK.cache import TTLCache
+
+# Метка сессии реплики в session.info.
+_REPLICA = "replica"
+
+
+def client_key(api_key: str) -> str:
+    # Сам api-key не рассылается (NOTIFY видят все клиенты базы).
+    return hashlib.sha1(api_key.encode()).hexdigest()[:20]
+
+
+#   ЧТЕНИЕ СВОИХ ЗАПИСЕЙ
+#   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *   *
+sticky = TTLCache(config.REPLICA_STICKY_MAX_KEYS, config.REPLICA_STICKY_SECONDS)
+
+
+def _stick(key: str):
+    sticky.set(key, True)
+
+
+broadcast.hub.register("replicas.stick", _stick)
+
+
+def mark_write(api_key: Optional[str]):
+    """
+    Клиент пишет - его чтения идут в основную базу (и во всех процессах).
+    """
+    if api_key:
+        broadcast.hub.publish("replicas.stick", client_key(api_key))
+
+
+def is_sticky(api_key: Optional[str]) -> bool:
+    return bool(api_key) and sticky.get(client_key(api_key)) is not None
+
+
+def is_replica(session: AsyncSession) -> bool:
+    return session.info.get(_REPLICA, False)
+
+
+class SessionRouter:
+    """
+    Выбор фабрики сессий: основная база или реплика.
+    """
+
+    def __init__(
+        self,
+        primary: async_sessionmaker[AsyncSession],
+        replica: Optional[async_sessionmaker[AsyncSession]] = None,
+    ):
+        self.primary = primary
+        self.replica = replica
+
+    def engines(self) -> list:
+        makers = (self.primary, self.replica)
+        return [maker.kw["bind"] for maker in makers if maker is not None]
+
+    def for_write(self, api_key: Optional[str]) -> AsyncSession:
+        if self.replica is not None:
+            mark_write(api_key)
+        return self.primary()
+
+    def for_read(self, api_key: Optional[str]) -> AsyncSession:
+        if self.replica is None:
+            return self.primary()
+        if is_sticky(api_key):
+            metrics.registry.reads.inc(("primary",))
+            return self.primary()
+        metrics.registry.reads.inc(("replica",))
+        return self.replica(info={_REPLICA: True})
@@ -31,6 +31,8 @@ class ShortUser(BaseModel):
 class UserModel(ShortUser):
     followers: List[ShortUser]
     following: List[ShortUser]
+    followers_count: int = 0
+    following_count: int = 0
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -39,6 +41,36 @@ class UserResultOut(ResultOut):
     user: UserModel
 
 
+class UserBrief(ShortUser):
+    followers_count: int = 0
+    following_count: int = 0
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class UserBatchResultOut(ResultOut):
+    users: List[UserBrief]
+
+
+class SuggestedUser(UserBrief):
+    # Сколько из тех, за кем следит пользователь, следят и за этим.
+    mutual: int
+
+
+class SuggestionsResultOut(ResultOut):
+    users: List[SuggestedUser]
+
+
+class UserIdsIn(BaseModel):
+    user_ids: List[int]
+
+
+class UserListResultOut(ResultOut):
+    users: List[ShortUser]
+    # Курсор следующей страницы, None - страниц больше нет.
+    next_cursor: Optional[str] = None
+
+
 # TWEETS
 
 
@@ -62,9 +94,30 @@ class TweetOut(BaseModel):  # TweetIn):
     id: int
     author: ShortUser
     likes: Optional[List[ShortUser]] = None
+    likes_count: int = 0
 
     model_config = ConfigDict(from_attributes=True)
 
 
+class TweetIdsIn(BaseModel):
+    tweet_ids: List[int]
+
+
 class TweetResultListOut(ResultOut):
     tweets: List[TweetOut] = None
+    # Курсор следующей страницы, None - страниц больше нет.
+    next_cursor: Optional[str] = None
+
+
+# BATCH
+
+
+class BatchItemOut(BaseModel):
+    id: int
+    result: bool
+    error_type: Optional[str] = None
+    error_message: Optional[str] = None
+
+
+class BatchResultOut(ResultOut):
+    results: List[BatchItemOut]
@@ -0,0 +1,88 @@
+"""
+Полнотекстовый поиск твитов.<br>
+Postgres - GIN-индекс по to_tsvector(content), SQLite - таблица FTS5
+tweets_fts с триггерами на tweets. Индекс ведет сама база: твит попадает
+в поиск и пропадает из него в той же транзакции, что add_tweet / delete_tweet
+(и пакетные вставки). Создается миграцией (migrations.py).<br>
+Все слова запроса обязательны. Порядок - по релевантности, при равной -
+новые выше. Страницы - по курсору (оценка, id) последнего твита
+(util_func.encode_score_cursor, вид "s").
+"""
+
+import re
+from typing import List, Optional, Tuple
+
+from sqlalchemy import Float, Integer, and_, func, literal_column, or_, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from BACK.models import Tweet
+
+# Без стемминга: в твитах вперемешку русский и английский.
+# Поменять - только вместе с индексом (новая миграция).
+TS_CONFIG = "simple"
+FTS_TABLE = "tweets_fts"
+
+_WORD = re.compile(r"\w+")
+
+
+def terms(q: str) -> List[str]:
+    """
+    Слова запроса. Операторы и кавычки не поддерживаются - только слова.
+    """
+    return _WORD.findall(q.lower())
+
+
+async def search_ids(
+    session: AsyncSession,
+    words: List[str],
+    limit: int,
+    after: Optional[Tuple[float, int]] = None,
+) -> List[Tuple[int, float]]:
+    """
+    (id, оценка) найденных твитов, лучшие первыми: меньше оценка - выше.<br>
+    after - (оценка, id) последнего твита предыдущей страницы.
+    """
+    if session.bind.dialect.name == "postgresql":
+        found = _postgres_query(words)
+    else:
+        found = _sqlite_query(words)
+    query = select(found.c.id, found.c.score)
+    if after is not None:
+        score, tweet_id = after
+        query = query.where(
+            or_(
+                found.c.score > score,
+                and_(found.c.score == score, found.c.id < tweet_id),
+            )
+        )
+    res = await session.execute(
+        query.order_by(found.c.score, found.c.id.desc()).limit(limit)
+    )
+    return [tuple(row) for row in res]
+
+
+def _postgres_query(words: List[str]):
+    # Выражение - то же, что в индексе ix_tweets_search, иначе индекс не подойдет.
+    config = literal_column(f"'{TS_CONFIG}'")
+    vector = func.to_tsvector(config, Tweet.content)
+    query = func.plainto_tsquery(config, " ".join(words))
+    return (
+        select(Tweet.id, (-func.ts_rank(vector, query)).label("score"))
+        .where(vector.op("@@")(query), Tweet.id != 0)
+        .subquery()
+    )
+
+
+def _sqlite_query(words: List[str]):
+    # Каждое слово - в кавычках: так FTS5 не примет его за оператор.
+    match = " ".join('"' + word.replace('"', '""') + '"' for word in words)
+    return (
+        text(
+            f"SELECT rowid AS id, bm25({FTS_TABLE}) AS score FROM {FTS_TABLE} "
+            f"WHERE {FTS_TABLE} MATCH :match AND rowid != 0"
+        )
+        .bindparams(match=match)
+        .columns(id=Integer, score=Float)
+        .subquery()
+    )
@@ -0,0 +1,218 @@
+"""
+Поток новых твитов (Server-Sent Events, GET /api/tweets/stream).<br>
+Подписчик - пользователь и набор авторов его ленты (он сам и те, за кем
+он следит). add_tweet после commit рассылает (автор, id твита) через
+broadcast - подписчики во всех процессах получают событие в свою
+очередь. Очередь ограничена: не успевающий ее разбирать подписчик
+отключается, клиент переподключается с Last-Event-ID и дочитывает
+пропущенное из базы.<br>
+Порядок событий - не строго по id: твит с меньшим id может закончить
+commit позже. Поэтому дочитывание берет и окно id до Last-Event-ID -
+часть событий придет повторно, клиент отбрасывает уже виденные id.
+Твит, застрявший до commit дольше окна, при обрыве может потеряться.<br>
+Ожидающий подписчик - корутина и пустая очередь, без соединения с базой;
+база читается только при подключении.
+"""
+
+import asyncio
+import json
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import BACK.broadcast as broadcast
+import BACK.config as config
+import BACK.metrics as metrics
+from BACK.models import Tweet, UserUser
+
+HEARTBEAT = b": ping\n\n"
+
+
+class Subscription:
+    def __init__(self, user_id: int, authors: Set[int], queue_size: int):
+        self.user_id = user_id
+        self.authors = authors
+        # (id твита, автор); None - подписчик отключен.
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+
+
+class StreamHub:
+    """
+    Подписчики по авторам: рассылка твита - только подписчикам его автора.
+    """
+
+    def __init__(self, queue_size: int, max_subscribers: int):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self._by_author: Dict[int, Set[Subscription]] = {}
+        self._by_user: Dict[int, Set[Subscription]] = {}
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def subscribe(self, user_id: int, authors: Iterable[int]) -> Optional[Subscription]:
+        """
+        None - подписчиков уже max_subscribers.
+        """
+        if self._count >= self.max_subscribers:
+            return None
+        sub = Subscription(user_id, set(authors), self.queue_size)
+        for author_id in sub.authors:
+            self._by_author.setdefault(author_id, set()).add(sub)
+        self._by_user.setdefault(user_id, set()).add(sub)
+        self._count += 1
+        metrics.registry.stream_subscribers.inc()
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        subs = self._by_user.get(sub.user_id)
+        if subs is None or sub not in subs:
+            return
+        subs.discard(sub)
+        if not subs:
+            del self._by_user[sub.user_id]
+        for author_id in sub.authors:
+            self._unlink(author_id, sub)
+        self._count -= 1
+        metrics.registry.stream_subscribers.dec()
+
+    def _unlink(self, author_id: int, sub: Subscription):
+        subs = self._by_author.get(author_id)
+        if subs is None:
+            return
+        subs.discard(sub)
+        if not subs:
+            del self._by_author[author_id]
+
+    def tweet(self, author_id: int, tweet_id: int):
+        for sub in list(self._by_author.get(author_id, ())):
+            try:
+                sub.queue.put_nowait((tweet_id, author_id))
+            except asyncio.QueueFull:
+                self._drop(sub)
+
+    def _drop(self, sub: Subscription):
+        """
+        Отключает медленного подписчика: очередь - только метка конца.
+        """
+        self.unsubscribe(sub)
+        while not sub.queue.empty():
+            sub.queue.get_nowait()
+        sub.queue.put_nowait(None)
+        metrics.registry.stream_dropped.inc()
+
+    def follow(self, user_id: int, author_ids: List[int], following: bool):
+        """
+        Подписки пользователя изменились - поправить авторов его потоков.
+        """
+        for sub in self._by_user.get(user_id, ()):
+            for author_id in author_ids:
+                if author_id == user_id:
+                    continue
+                if following:
+                    sub.authors.add(author_id)
+                    self._by_author.setdefault(author_id, set()).add(sub)
+                else:
+                    sub.authors.discard(author_id)
+                    self._unlink(author_id, sub)
+
+
+streams = StreamHub(config.STREAM_QUEUE_SIZE, config.STREAM_MAX_SUBSCRIBERS)
+
+broadcast.hub.register("stream.tweet", streams.tweet)
+broadcast.hub.register("stream.follow", streams.follow)
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[int]:
+    """
+    Last-Event-ID - id последнего полученного твита. Кривой - ValueError.
+    """
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError as err:
+        raise ValueError(f"Invalid Last-Event-ID: '{value}'.") from err
+
+
+async def feed_authors(session: AsyncSession, user_id: int) -> List[int]:
+    res = await session.execute(
+        select(UserUser.follow_to_id).where(UserUser.id == user_id)
+    )
+    return [user_id] + list(res.scalars())
+
+
+async def missed(
+    session: AsyncSession,
+    authors: List[int],
+    after_id: int,
+    limit: int,
+    window: int = 0,
+) -> Optional[List[Tuple[int, int]]]:
+    """
+    (id, автор) твитов авторов новее after_id - window, старые первыми.<br>
+    None - новее after_id больше limit: клиенту проще перечитать ленту.
+    """
+    res = await session.execute(
+        select(Tweet.id, Tweet.author_id)
+        .where(Tweet.author_id.in_(authors), Tweet.id > after_id - window)
+        .order_by(Tweet.id)
+        # В окне - не больше window твитов.
+        .limit(limit + window + 1)
+    )
+    rows = [tuple(row) for row in res]
+    if sum(1 for tweet_id, _ in rows if tweet_id > after_id) > limit:
+        return None
+    return rows
+
+
+def format_event(tweet_id: int, author_id: int) -> bytes:
+    data = json.dumps({"tweet_id": tweet_id, "author_id": author_id})
+    return f"id: {tweet_id}\nevent: tweet\ndata: {data}\n\n".encode()
+
+
+async def events(
+    sub: Subscription,
+    backlog: Optional[List[Tuple[int, int]]],
+    heartbeat: float,
+    max_duration: float,
+) -> AsyncIterator[bytes]:
+    """
+    Тело ответа: пропущенное (backlog), затем новые твиты и heartbeat
+    в тишине. Через max_duration секунд (0 - без предела) поток
+    закрывается - клиент переподключится к любому из процессов.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_duration if max_duration else None
+    try:
+        yield f"retry: {config.STREAM_RETRY_MS}\n\n".encode()
+        if backlog is None:
+            # Пропущено слишком много - клиенту перечитать ленту.
+            yield b"event: reset\ndata: {}\n\n"
+            backlog = []
+        sent = set()
+        for tweet_id, author_id in backlog:
+            sent.add(tweet_id)
+            yield format_event(tweet_id, author_id)
+        while True:
+            timeout = heartbeat
+            if deadline is not None:
+                timeout = min(timeout, deadline - loop.time())
+                if timeout <= 0:
+                    return
+            try:
+                item = await asyncio.wait_for(sub.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                if deadline is None or loop.time() < deadline:
+                    yield HEARTBEAT
+                continue
+            if item is None:
+                return
+            # Твит мог прийти и из базы (backlog), и рассылкой.
+            if item[0] in sent:
+                continue
+            yield format_event(*item)
+    finally:
+        streams.unsubscribe(sub)
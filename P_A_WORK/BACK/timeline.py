@@ -0,0 +1,336 @@
+"""
+Материализованные ленты (fan-out on write), режим TIMELINE_MODE = "push".<br>
+Новый твит сразу раскладывается в timeline_entries каждого последователя,
+лента читается готовым списком id.<br>
+Твиты авторов с числом последователей больше TIMELINE_FANOUT_MAX_FOLLOWERS
+не раскладываются - подмешиваются при чтении. Решение записывается
+в сам твит (Tweet.fanned_out): автор, переставший или ставший "звездой",
+не теряет из лент уже опубликованное.<br>
+Поверх таблицы - ограниченный кольцевой буфер последних id
+для активных (недавно читавших ленту) пользователей.
+"""
+
+from collections import OrderedDict, deque
+from typing import Deque, Iterable, List, Optional
+
+from sqlalchemy import and_, delete, false, func, insert, literal, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import BACK.broadcast as broadcast
+import BACK.config as config
+import BACK.replicas as replicas
+from BACK.models import TimelineEntry, Tweet, User, UserUser
+
+
+def enabled() -> bool:
+    return config.TIMELINE_MODE == "push"
+
+
+class _Ring:
+    __slots__ = ("ids", "complete")
+
+    def __init__(self, ids: Iterable[int], size: int, complete: bool):
+        # Новые слева. Кольцо - всегда начало (самые новые) ленты из таблицы.
+        self.ids: Deque[int] = deque(ids, maxlen=size)
+        # Лента целиком умещается в кольце - таблицу можно не спрашивать.
+        self.complete = complete
+
+
+class TimelineRings:
+    """
+    Последние id твитов лент активных пользователей.<br>
+    Не более max_users колец, вытесняются давно не читавшие (LRU).
+    """
+
+    def __init__(self, ring_size: int, max_users: int):
+        self.ring_size = ring_size
+        self.max_users = max_users
+        self._rings: "OrderedDict[int, _Ring]" = OrderedDict()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._rings
+
+    def load(self, user_id: int, ids: List[int]):
+        self._rings[user_id] = _Ring(
+            ids, self.ring_size, complete=len(ids) < self.ring_size
+        )
+        self._rings.move_to_end(user_id)
+        while len(self._rings) > self.max_users:
+            self._rings.popitem(last=False)
+
+    def page(
+        self, user_id: int, limit: int, before_id: Optional[int]
+    ) -> Optional[List[int]]:
+        """
+        Страница из кольца, либо None - кольца нет или в нём не хватает id.
+        """
+        ring = self._rings.get(user_id)
+        if ring is None:
+            return None
+        self._rings.move_to_end(user_id)
+        result = []
+        for tweet_id in ring.ids:
+            if before_id is not None and tweet_id >= before_id:
+                continue
+            result.append(tweet_id)
+            if len(result) == limit:
+                return result
+        return result if ring.complete else None
+
+    def push(self, user_ids: Iterable[int], tweet_id: int):
+        for user_id in user_ids:
+            ring = self._rings.get(user_id)
+            if ring is None:
+                continue
+            if ring.ids and ring.ids[0] >= tweet_id:
+                # Уже есть (кольцо загружено после commit) или пришел позже
+                # более нового (параллельные commit, другой процесс) -
+                # порядок не восстановить, кольцо перечитается из таблицы.
+                if tweet_id not in ring.ids:
+                    self.invalidate(user_id)
+                continue
+            if len(ring.ids) == ring.ids.maxlen:
+                ring.complete = False
+            ring.ids.appendleft(tweet_id)
+
+    def retract(self, user_ids: Iterable[int], tweet_id: int):
+        for user_id in user_ids:
+            ring = self._rings.get(user_id)
+            if ring is not None and tweet_id in ring.ids:
+                ring.ids.remove(tweet_id)
+
+    def invalidate(self, user_id: int):
+        self._rings.pop(user_id, None)
+
+    def clear(self):
+        self._rings.clear()
+
+
+rings = TimelineRings(config.TIMELINE_RING_SIZE, config.TIMELINE_RING_USERS)
+# Изменения колец - через broadcast.hub.publish, чтобы их получили
+# и кольца остальных процессов.
+broadcast.hub.register("rings.push", rings.push, coarse="rings.clear")
+broadcast.hub.register("rings.retract", rings.retract, coarse="rings.clear")
+broadcast.hub.register("rings.invalidate", rings.invalidate)
+broadcast.hub.register("rings.clear", rings.clear)
+
+
+def _followers_of(author_id_column):
+    """
+    Подзапрос: число последователей автора из колонки author_id_column.
+    """
+    return (
+        select(User.followers_count)
+        .where(User.id == author_id_column)
+        .scalar_subquery()
+    )
+
+
+async def _is_fanned_out(session: AsyncSession, author_id: int) -> bool:
+    res = await session.execute(
+        select(User.followers_count).where(User.id == author_id)
+    )
+    return (res.scalar() or 0) <= config.TIMELINE_FANOUT_MAX_FOLLOWERS
+
+
+async def fan_out_tweet(
+    session: AsyncSession, tweet_id: int, author_id: int
+) -> List[int]:
+    """
+    Кладет новый твит в ленты автора и (если он не "звезда") последователей.<br>
+    Вызывать до commit. Возвращает id лент, куда твит попал -
+    после commit их нужно передать в rings.push.
+    """
+    user_ids = [author_id]
+    if await _is_fanned_out(session, author_id):
+        res = await session.execute(
+            select(UserUser.id).where(UserUser.follow_to_id == author_id)
+        )
+        user_ids.extend(res.scalars())
+    else:
+        await session.execute(
+            update(Tweet).where(Tweet.id == tweet_id).values(fanned_out=False)
+        )
+    await session.execute(
+        insert(TimelineEntry),
+        [
+            {"user_id": user_id, "tweet_id": tweet_id, "author_id": author_id}
+            for user_id in user_ids
+        ],
+    )
+    return user_ids
+
+
+async def retract_tweet(session: AsyncSession, tweet_id: int) -> List[int]:
+    """
+    Убирает твит из всех лент. Вызывать до удаления самого твита.<br>
+    Возвращает id затронутых лент - для rings.retract после commit.
+    """
+    res = await session.execute(
+        select(TimelineEntry.user_id).where(TimelineEntry.tweet_id == tweet_id)
+    )
+    user_ids = list(res.scalars())
+    await session.execute(
+        delete(TimelineEntry).where(TimelineEntry.tweet_id == tweet_id)
+    )
+    return user_ids
+
+
+async def backfill_follow(session: AsyncSession, user_id: int, author_id: int):
+    """
+    После подписки - последние TIMELINE_BACKFILL разложенных твитов
+    автора в ленту (остальные подмешиваются при чтении).<br>
+    Кольцо пользователя после commit нужно сбросить (rings.invalidate).
+    """
+    if author_id == user_id:
+        # Подписка на себя: свои твиты уже в ленте.
+        return
+    recent = (
+        select(literal(user_id), Tweet.id, Tweet.author_id)
+        .where(and_(Tweet.author_id == author_id, Tweet.fanned_out))
+        .order_by(Tweet.id.desc())
+        .limit(config.TIMELINE_BACKFILL)
+    )
+    await session.execute(
+        insert(TimelineEntry).from_select(["user_id", "tweet_id", "author_id"], recent)
+    )
+
+
+async def backfill_follows(session: AsyncSession, user_id: int, author_ids: List[int]):
+    """
+    То же, что backfill_follow, сразу для нескольких авторов - одним
+    insert (последние TIMELINE_BACKFILL твитов каждого через row_number).
+    """
+    author_ids = [author_id for author_id in author_ids if author_id != user_id]
+    if not author_ids:
+        return
+    ranked = (
+        select(
+            Tweet.id.label("tweet_id"),
+            Tweet.author_id.label("author_id"),
+            func.row_number()
+            .over(partition_by=Tweet.author_id, order_by=Tweet.id.desc())
+            .label("rank"),
+        )
+        .where(and_(Tweet.author_id.in_(author_ids), Tweet.fanned_out))
+        .subquery()
+    )
+    recent = select(literal(user_id), ranked.c.tweet_id, ranked.c.author_id).where(
+        ranked.c.rank <= config.TIMELINE_BACKFILL
+    )
+    await session.execute(
+        insert(TimelineEntry).from_select(["user_id", "tweet_id", "author_id"], recent)
+    )
+
+
+async def retract_follow(session: AsyncSession, user_id: int, author_id: int):
+    """
+    После отписки - твиты автора из ленты пользователя.<br>
+    Кольцо пользователя после commit нужно сбросить (rings.invalidate).
+    """
+    await retract_follows(session, user_id, [author_id])
+
+
+async def retract_follows(session: AsyncSession, user_id: int, author_ids: List[int]):
+    # Отписка от себя не убирает из ленты свои твиты.
+    author_ids = [author_id for author_id in author_ids if author_id != user_id]
+    if not author_ids:
+        return
+    await session.execute(
+        delete(TimelineEntry).where(
+            and_(
+                TimelineEntry.user_id == user_id,
+                TimelineEntry.author_id.in_(author_ids),
+            )
+        )
+    )
+
+
+async def _entries_page(
+    session: AsyncSession, user_id: int, limit: int, before_id: Optional[int]
+) -> List[int]:
+    query = select(TimelineEntry.tweet_id).where(TimelineEntry.user_id == user_id)
+    if before_id is not None:
+        query = query.where(TimelineEntry.tweet_id < before_id)
+    res = await session.execute(
+        query.order_by(TimelineEntry.tweet_id.desc()).limit(limit)
+    )
+    return list(res.scalars())
+
+
+async def _merged_page(
+    session: AsyncSession, user_id: int, limit: int, before_id: Optional[int]
+) -> List[int]:
+    """
+    Нераскладанные твиты (Tweet.fanned_out) тех, на кого подписан
+    пользователь, - твиты "звезд".
+    """
+    followed = select(UserUser.follow_to_id).where(UserUser.id == user_id)
+    query = select(Tweet.id).where(
+        and_(Tweet.author_id.in_(followed), Tweet.fanned_out == false())
+    )
+    if before_id is not None:
+        query = query.where(Tweet.id < before_id)
+    res = await session.execute(query.order_by(Tweet.id.desc()).limit(limit))
+    return list(res.scalars())
+
+
+async def load_page_ids(
+    session: AsyncSession, user_id: int, limit: int, before_id: Optional[int]
+) -> List[int]:
+    """
+    id твитов одной страницы материализованной ленты, от новых к старым.
+    """
+    ids = rings.page(user_id, limit, before_id)
+    if ids is None:
+        if before_id is None and not replicas.is_replica(session):
+            # Первая страница - заодно прогреваем кольцо
+            # (не с реплики: она может отставать).
+            ring_ids = await _entries_page(
+                session, user_id, max(limit, rings.ring_size), None
+            )
+            rings.load(user_id, ring_ids[: rings.ring_size])
+            ids = ring_ids[:limit]
+        else:
+            ids = await _entries_page(session, user_id, limit, before_id)
+    merged = await _merged_page(session, user_id, limit, before_id)
+    if merged:
+        ids = sorted(set(ids).union(merged), reverse=True)[:limit]
+    return ids
+
+
+async def rebuild(session: AsyncSession, user_id: Optional[int] = None):
+    """
+    Пересобирает timeline_entries (всех или одного пользователя) по
+    users_users и tweets. Нужна при переходе с "pull" на "push".<br>
+    Полная пересборка заново решает, какие твиты раскладывать
+    (по нынешнему числу последователей авторов), для одного
+    пользователя - берется решение из твитов.<br>
+    Кольца после commit нужно сбросить (rings.clear / rings.invalidate).
+    """
+    if user_id is None:
+        await session.execute(delete(TimelineEntry))
+        await session.execute(
+            update(Tweet).values(
+                fanned_out=_followers_of(Tweet.author_id)
+                <= config.TIMELINE_FANOUT_MAX_FOLLOWERS
+            )
+        )
+    else:
+        await session.execute(
+            delete(TimelineEntry).where(TimelineEntry.user_id == user_id)
+        )
+
+    own = select(Tweet.author_id.label("user_id"), Tweet.id, Tweet.author_id)
+    followed = (
+        select(UserUser.id, Tweet.id, Tweet.author_id)
+        .join(Tweet, Tweet.author_id == UserUser.follow_to_id)
+        .where(Tweet.fanned_out)
+    )
+    if user_id is not None:
+        own = own.where(Tweet.author_id == user_id)
+        followed = followed.where(UserUser.id == user_id)
+    columns = ["user_id", "tweet_id", "author_id"]
+    await session.execute(insert(TimelineEntry).from_select(columns, own))
+    await session.execute(insert(TimelineEntry).from_select(columns, followed))
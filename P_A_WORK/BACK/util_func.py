@@ -1,11 +1,8 @@
-import aiofiles
-from fastapi.responses import JSONResponse
-
+import base64
+import binascii
+from typing import Optional, Tuple
 
-async def save_file(in_file, out_file_path: str):
-    async with aiofiles.open(out_file_path, "wb") as out_file:
-        while content := await in_file.read(1024):  # async read chunk
-            await out_file.write(content)  # async write chunk
+from fastapi.responses import JSONResponse
 
 
 def get_err_dict(error_type: str, error_message: str):
@@ -27,3 +24,56 @@ def get_err_JSONRes(
             "error_message": error_message,
         },
     )
+
+
+def encode_cursor(last_id: int, kind: str = "t") -> str:
+    """
+    Непрозрачный курсор страницы: id последней отданной записи.<br>
+    kind - вид записей ("t" - твиты, "u" - пользователи),
+    чтобы курсор одного списка не приняли в другом.
+    """
+    return base64.urlsafe_b64encode(f"{kind}:{last_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str], kind: str = "t") -> Optional[int]:
+    """
+    Обратное к encode_cursor.<br>
+    None - курсора нет (первая страница). Кривой курсор - ValueError.
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except (binascii.Error, UnicodeDecodeError) as err:
+        raise ValueError(f"Invalid cursor: '{cursor}'.") from err
+    prefix, _, value = raw.partition(":")
+    if prefix != kind or not value.isdigit():
+        raise ValueError(f"Invalid cursor: '{cursor}'.")
+    return int(value)
+
+
+def encode_score_cursor(score: float, last_id: int, kind: str) -> str:
+    """
+    Курсор списка, упорядоченного по оценке (поиск, популярное):
+    оценка и id последней отданной записи.
+    """
+    raw = f"{kind}:{score!r}:{last_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_score_cursor(
+    cursor: Optional[str], kind: str
+) -> Optional[Tuple[float, int]]:
+    """
+    Обратное к encode_score_cursor. None - первая страница, кривой курсор - ValueError.
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        prefix, score, last_id = raw.split(":")
+        if prefix != kind:
+            raise ValueError
+        return float(score), int(last_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as err:
+        raise ValueError(f"Invalid cursor: '{cursor}'.") from err
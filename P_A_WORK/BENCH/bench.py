@@ -0,0 +1,460 @@
+"""
+Нагрузочный прогон всех маршрутов create_app() на синтетическом графе.<br>
+Запуск из папки проекта:<br>
+python -m BENCH.bench --preset small --concurrency 16 --requests 5000<br>
+python -m BENCH.bench --database-url postgresql+asyncpg://... --preset small<br>
+Результат (пропускная способность, p50/p95/p99 по маршрутам) пишется
+в JSON (--output), --compare печатает разницу с прошлым результатом.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from asgi_lifespan import LifespanManager
+from fastapi import FastAPI
+
+import BACK.config as config
+import BACK.migrations as migrations
+import BACK.popular as popular
+from BACK.app import create_app
+from BACK.database import make_engine, make_session_maker
+from BENCH.dataset import PRESETS, WORDS, DatasetSpec, api_key, generate
+
+# id в одном пакетном запросе (GET /api/users/?ids=, POST /api/users/follow/ ...).
+BATCH_SIZE = 10
+# Сколько держится поток событий в прогоне, секунд.
+STREAM_DURATION = 0.05
+
+
+class Scenarios:
+    """
+    По сценарию на маршрут. Пишущие сценарии складывают созданное
+    (твиты, лайки, подписки) в очереди, обратные сценарии берут оттуда -
+    объем данных за прогон почти не растет.
+    """
+
+    def __init__(self, spec: DatasetSpec):
+        self.spec = spec
+        self.tweets: deque = deque()
+        self.likes: deque = deque()
+        self.follows: deque = deque()
+        self.follow_batches: deque = deque()
+        self.like_batches: deque = deque()
+
+    def user(self, rng: random.Random) -> int:
+        return rng.randint(1, self.spec.users)
+
+    def headers(self, user_id: int) -> dict:
+        return {"api-key": api_key(user_id)}
+
+    def batch(self, rng: random.Random, last_id: int) -> List[int]:
+        return rng.sample(range(1, last_id + 1), min(BATCH_SIZE, last_id))
+
+    async def get_user(self, client, rng):
+        return await client.get(f"/api/users/{self.user(rng)}/")
+
+    async def get_users_by_ids(self, client, rng):
+        ids = ",".join(map(str, self.batch(rng, self.spec.users)))
+        return await client.get("/api/users/", params={"ids": ids})
+
+    async def get_me(self, client, rng):
+        return await client.get("/api/users/me/", headers=self.headers(self.user(rng)))
+
+    async def get_followers(self, client, rng):
+        return await client.get(f"/api/users/{self.user(rng)}/followers/")
+
+    async def get_following(self, client, rng):
+        return await client.get(f"/api/users/{self.user(rng)}/following/")
+
+    async def get_suggestions(self, client, rng):
+        return await client.get(f"/api/users/{self.user(rng)}/suggestions/")
+
+    async def follow(self, client, rng):
+        user_id, follow_to_id = self.user(rng), self.user(rng)
+        self.follows.append((user_id, follow_to_id))
+        return await client.post(
+            f"/api/users/{follow_to_id}/follow/", headers=self.headers(user_id)
+        )
+
+    async def unfollow(self, client, rng):
+        if self.follows:
+            user_id, follow_to_id = self.follows.popleft()
+        else:
+            user_id, follow_to_id = self.user(rng), self.user(rng)
+        return await client.delete(
+            f"/api/users/{follow_to_id}/follow/", headers=self.headers(user_id)
+        )
+
+    async def follow_many(self, client, rng):
+        user_id, follow_to_ids = self.user(rng), self.batch(rng, self.spec.users)
+        self.follow_batches.append((user_id, follow_to_ids))
+        return await client.post(
+            "/api/users/follow/",
+            headers=self.headers(user_id),
+            json={"user_ids": follow_to_ids},
+        )
+
+    async def unfollow_many(self, client, rng):
+        if self.follow_batches:
+            user_id, follow_to_ids = self.follow_batches.popleft()
+        else:
+            user_id, follow_to_ids = self.user(rng), self.batch(rng, self.spec.users)
+        return await client.request(
+            "DELETE",
+            "/api/users/follow/",
+            headers=self.headers(user_id),
+            json={"user_ids": follow_to_ids},
+        )
+
+    async def get_feed(self, client, rng):
+        return await client.get("/api/tweets/", headers=self.headers(self.user(rng)))
+
+    async def get_feed_next_page(self, client, rng):
+        headers = self.headers(self.user(rng))
+        response = await client.get("/api/tweets/", headers=headers)
+        cursor = response.json().get("next_cursor")
+        if cursor is None:
+            return response
+        return await client.get(
+            "/api/tweets/", headers=headers, params={"cursor": cursor}
+        )
+
+    async def search(self, client, rng):
+        return await client.get(
+            "/api/tweets/search", params={"q": " ".join(rng.sample(WORDS, 2))}
+        )
+
+    async def popular(self, client, rng):
+        return await client.get("/api/tweets/popular")
+
+    async def post_tweet(self, client, rng):
+        user_id = self.user(rng)
+        response = await client.post(
+            "/api/tweets/",
+            headers=self.headers(user_id),
+            json={"tweet_data": "bench", "tweet_media_ids": []},
+        )
+        tweet_id = response.json().get("tweet_id")
+        if tweet_id is not None:
+            self.tweets.append((user_id, tweet_id))
+        return response
+
+    async def delete_tweet(self, client, rng):
+        if not self.tweets:
+            return await self.post_tweet(client, rng)
+        user_id, tweet_id = self.tweets.popleft()
+        return await client.delete(
+            f"/api/tweets/{tweet_id}", headers=self.headers(user_id)
+        )
+
+    async def like(self, client, rng):
+        user_id, tweet_id = self.user(rng), rng.randint(1, self.spec.tweets)
+        self.likes.append((user_id, tweet_id))
+        return await client.post(
+            f"/api/tweets/{tweet_id}/likes", headers=self.headers(user_id)
+        )
+
+    async def unlike(self, client, rng):
+        if self.likes:
+            user_id, tweet_id = self.likes.popleft()
+        else:
+            user_id, tweet_id = self.user(rng), rng.randint(1, self.spec.tweets)
+        return await client.delete(
+            f"/api/tweets/{tweet_id}/likes", headers=self.headers(user_id)
+        )
+
+    async def like_many(self, client, rng):
+        user_id, tweet_ids = self.user(rng), self.batch(rng, self.spec.tweets)
+        self.like_batches.append((user_id, tweet_ids))
+        return await client.post(
+            "/api/tweets/likes/",
+            headers=self.headers(user_id),
+            json={"tweet_ids": tweet_ids},
+        )
+
+    async def unlike_many(self, client, rng):
+        if self.like_batches:
+            user_id, tweet_ids = self.like_batches.popleft()
+        else:
+            user_id, tweet_ids = self.user(rng), self.batch(rng, self.spec.tweets)
+        return await client.request(
+            "DELETE",
+            "/api/tweets/likes/",
+            headers=self.headers(user_id),
+            json={"tweet_ids": tweet_ids},
+        )
+
+    async def stream(self, client, rng):
+        # Переподключение с Last-Event-ID: подписка, пропущенное из базы
+        # и STREAM_MAX_DURATION прогона (ASGITransport отдает ответ целиком).
+        last_event_id = rng.randint(1, self.spec.tweets)
+        return await client.get(
+            "/api/tweets/stream",
+            headers={
+                **self.headers(self.user(rng)),
+                "Last-Event-ID": str(last_event_id),
+            },
+        )
+
+    async def upload_media(self, client, rng):
+        return await client.post(
+            "/api/medias/",
+            headers=self.headers(self.user(rng)),
+            files={"file": ("bench.png", rng.randbytes(rng.randint(1024, 65536)))},
+        )
+
+
+# Имя в отчете -> (сценарий, вес). Смесь с преобладанием чтения ленты.
+MIX = {
+    "GET /api/tweets/": ("get_feed", 35),
+    "GET /api/tweets/?cursor": ("get_feed_next_page", 5),
+    "GET /api/users/{id}/": ("get_user", 10),
+    "GET /api/users/?ids=": ("get_users_by_ids", 3),
+    "GET /api/users/me/": ("get_me", 5),
+    "GET /api/users/{id}/followers/": ("get_followers", 5),
+    "GET /api/users/{id}/following/": ("get_following", 5),
+    "GET /api/users/{id}/suggestions/": ("get_suggestions", 2),
+    "POST /api/users/{id}/follow/": ("follow", 4),
+    "DELETE /api/users/{id}/follow/": ("unfollow", 3),
+    "POST /api/users/follow/": ("follow_many", 1),
+    "DELETE /api/users/follow/": ("unfollow_many", 1),
+    "GET /api/tweets/search": ("search", 3),
+    "GET /api/tweets/popular": ("popular", 3),
+    "POST /api/tweets/": ("post_tweet", 8),
+    "DELETE /api/tweets/{id}": ("delete_tweet", 4),
+    "POST /api/tweets/{id}/likes": ("like", 8),
+    "DELETE /api/tweets/{id}/likes": ("unlike", 5),
+    "POST /api/tweets/likes/": ("like_many", 1),
+    "DELETE /api/tweets/likes/": ("unlike_many", 1),
+    "GET /api/tweets/stream": ("stream", 1),
+    "POST /api/medias/": ("upload_media", 3),
+}
+
+
+def _percentiles(latencies: List[float]) -> dict:
+    ordered = sorted(latencies)
+    if len(ordered) == 1:
+        p50 = p95 = p99 = ordered[0]
+    else:
+        cuts = statistics.quantiles(ordered, n=100, method="inclusive")
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    return {
+        "p50_ms": round(p50 * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "p99_ms": round(p99 * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+    }
+
+
+async def drive(
+    client: httpx.AsyncClient,
+    scenarios: Scenarios,
+    requests: int,
+    concurrency: int,
+    seed: int,
+) -> Dict[str, dict]:
+    """
+    requests запросов в concurrency параллельных потоков, маршрут
+    выбирается случайно по весам MIX. Возвращает сырые замеры по маршрутам.
+    """
+    names = list(MIX)
+    weights = [MIX[name][1] for name in names]
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    remaining = requests
+
+    async def worker(rng: random.Random):
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            name = rng.choices(names, weights)[0]
+            scenario: Callable[..., Awaitable[httpx.Response]] = getattr(
+                scenarios, MIX[name][0]
+            )
+            started = time.perf_counter()
+            try:
+                response = await scenario(client, rng)
+                failed = response.status_code >= 500
+            except Exception:
+                failed = True
+            latencies[name].append(time.perf_counter() - started)
+            if failed:
+                errors[name] += 1
+
+    await asyncio.gather(
+        *(worker(random.Random(seed + number)) for number in range(concurrency))
+    )
+    return {name: (latencies[name], errors[name]) for name in latencies}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@asynccontextmanager
+async def _no_lifespan(app: FastAPI):
+    yield
+
+
+async def run_benchmark(
+    database_url: str,
+    spec: DatasetSpec,
+    requests: int,
+    concurrency: int,
+    warmup: int = 0,
+    reuse: bool = False,
+) -> dict:
+    """
+    Готовит базу (если не reuse), прогоняет warmup запросов без замеров,
+    затем requests с замерами. Возвращает отчет.
+    """
+    engine = make_engine(database_url, echo=False)
+    session_maker = make_session_maker(engine)
+    rows = None
+    stream_duration = config.STREAM_MAX_DURATION
+    config.STREAM_MAX_DURATION = STREAM_DURATION
+    try:
+        if not reuse:
+            await migrations.reset(engine)
+            await migrations.upgrade(engine)
+            async with session_maker() as session:
+                rows = await generate(session, spec)
+                await popular.rebuild(session)
+                await session.commit()
+            popular.board.invalidate()
+
+        app = create_app(session_maker, _no_lifespan)
+        scenarios = Scenarios(spec)
+        async with LifespanManager(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://bench"
+            ) as client:
+                if warmup:
+                    await drive(client, scenarios, warmup, concurrency, spec.seed - 1)
+                started = time.perf_counter()
+                raw = await drive(client, scenarios, requests, concurrency, spec.seed)
+                duration = time.perf_counter() - started
+    finally:
+        config.STREAM_MAX_DURATION = stream_duration
+        await engine.dispose()
+
+    endpoints = {}
+    for name in MIX:
+        if name not in raw:
+            continue
+        latencies, errors = raw[name]
+        endpoints[name] = {
+            "count": len(latencies),
+            "errors": errors,
+            "rps": round(len(latencies) / duration, 2),
+            **_percentiles(latencies),
+        }
+    return {
+        "commit": _git_commit(),
+        "database": engine.dialect.name,
+        "timeline_mode": config.TIMELINE_MODE,
+        "dataset": spec._asdict(),
+        "rows": rows,
+        "requests": requests,
+        "concurrency": concurrency,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(requests / duration, 2),
+        "endpoints": endpoints,
+    }
+
+
+def compare(old: dict, new: dict) -> List[str]:
+    """
+    Строки "маршрут: p95 было -> стало (изменение %)" для общих маршрутов.
+    """
+    lines = [
+        f"throughput: {old['throughput_rps']} -> {new['throughput_rps']} rps",
+    ]
+    for name, stats in new["endpoints"].items():
+        before = old["endpoints"].get(name)
+        if before is None or not before["p95_ms"]:
+            continue
+        change = (stats["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100
+        lines.append(
+            f"{name}: p95 {before['p95_ms']} -> {stats['p95_ms']} ms ({change:+.1f}%)"
+        )
+    return lines
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m BENCH.bench")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="tiny")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--database-url",
+        default=None,
+        help="по умолчанию - файл SQLite во временной папке",
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument(
+        "--reuse", action="store_true", help="не пересоздавать данные в базе"
+    )
+    parser.add_argument("--output", default="bench_result.json")
+    parser.add_argument("--compare", default=None, help="прошлый JSON-отчет")
+    args = parser.parse_args(argv)
+
+    spec = PRESETS[args.preset]
+    if args.seed is not None:
+        spec = spec._replace(seed=args.seed)
+    database_url = args.database_url or (
+        "sqlite+aiosqlite:///"
+        + os.path.join(tempfile.gettempdir(), f"simple_tweeter_bench_{args.preset}.db")
+    )
+    # Загрузки - во временную папку, уменьшенные копии не делаются.
+    config.MEDIA_ROOT = tempfile.mkdtemp(prefix="simple_tweeter_bench_")
+    config.DERIVATIVES_ENABLED = False
+    # Все запросы прогона - от одного клиента, пределы частоты не к месту.
+    config.ADMISSION_ENABLED = False
+
+    try:
+        report = asyncio.run(
+            run_benchmark(
+                database_url,
+                spec,
+                args.requests,
+                args.concurrency,
+                warmup=args.warmup,
+                reuse=args.reuse,
+            )
+        )
+    finally:
+        shutil.rmtree(config.MEDIA_ROOT, ignore_errors=True)
+    with open(args.output, "w") as out_file:
+        json.dump(report, out_file, indent=2, ensure_ascii=False)
+    print(f"{report['throughput_rps']} rps, report: {args.output}")
+    if args.compare:
+        with open(args.compare) as in_file:
+            print("\n".join(compare(json.load(in_file), report)))
+
+
+if __name__ == "__main__":
+    main()
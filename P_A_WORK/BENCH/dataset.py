@@ -0,0 +1,197 @@
+"""
+Синтетический социальный граф для нагрузочных прогонов.<br>
+Один и тот же seed дает один и тот же набор данных.<br>
+Популярность (сколько у пользователя последователей) и активность
+(сколько он пишет) распределены по степенному закону: немного "звезд",
+длинный хвост почти незаметных пользователей.
+"""
+
+import hashlib
+import itertools
+import random
+from typing import Iterable, Iterator, List, NamedTuple
+
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import BACK.models as models
+import BACK.timeline as timeline
+
+# Строк на один insert.
+BATCH = 5000
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua"
+).split()
+
+
+class DatasetSpec(NamedTuple):
+    users: int
+    tweets: int
+    # Средние значения, сами величины - с тяжелым хвостом.
+    follows_per_user: int
+    likes_per_tweet: float
+    # Доля твитов с картинкой.
+    picture_share: float
+    # Показатель степенного закона популярности/активности.
+    alpha: float = 1.1
+    seed: int = 42
+
+
+PRESETS = {
+    "tiny": DatasetSpec(
+        users=200,
+        tweets=2_000,
+        follows_per_user=10,
+        likes_per_tweet=2,
+        picture_share=0.1,
+    ),
+    "small": DatasetSpec(
+        users=10_000,
+        tweets=100_000,
+        follows_per_user=50,
+        likes_per_tweet=3,
+        picture_share=0.1,
+    ),
+    "large": DatasetSpec(
+        users=100_000,
+        tweets=2_000_000,
+        follows_per_user=100,
+        likes_per_tweet=5,
+        picture_share=0.1,
+    ),
+}
+
+
+def api_key(user_id: int) -> str:
+    return f"bench{user_id}"
+
+
+class _PowerLaw:
+    """
+    Выбор id пользователя 1..n с весом 1 / rank ** alpha,
+    ранги перемешаны, чтобы "звезды" не были просто первыми id.
+    """
+
+    def __init__(self, rng: random.Random, n: int, alpha: float):
+        ranks = list(range(1, n + 1))
+        rng.shuffle(ranks)
+        self.rng = rng
+        self.ids = range(1, n + 1)
+        self.cum_weights = list(itertools.accumulate(1 / rank**alpha for rank in ranks))
+
+    def sample(self, k: int) -> List[int]:
+        return self.rng.choices(self.ids, cum_weights=self.cum_weights, k=k)
+
+
+def _heavy_tail(rng: random.Random, mean: float) -> int:
+    # Среднее paretovariate(1.5) равно 3.
+    return int(rng.paretovariate(1.5) * mean / 3)
+
+
+def _users(spec: DatasetSpec) -> Iterator[dict]:
+    yield {"id": 0, "api_key": "None", "name": "None"}
+    for user_id in range(1, spec.users + 1):
+        yield {"id": user_id, "api_key": api_key(user_id), "name": f"User {user_id}"}
+
+
+def _follows(spec: DatasetSpec, rng: random.Random) -> Iterator[dict]:
+    popular = _PowerLaw(rng, spec.users, spec.alpha)
+    for user_id in range(1, spec.users + 1):
+        k = min(spec.users - 1, _heavy_tail(rng, spec.follows_per_user))
+        targets = set(popular.sample(k)) if k else set()
+        targets.discard(user_id)
+        for follow_to_id in sorted(targets):
+            yield {"id": user_id, "follow_to_id": follow_to_id}
+
+
+def _tweets(spec: DatasetSpec, rng: random.Random) -> Iterator[dict]:
+    yield {"id": 0, "content": "None", "author_id": 0}
+    active = _PowerLaw(rng, spec.users, spec.alpha)
+    for tweet_id in range(1, spec.tweets + 1):
+        yield {
+            "id": tweet_id,
+            "content": " ".join(rng.choices(WORDS, k=rng.randint(3, 20))),
+            "author_id": active.sample(1)[0],
+        }
+
+
+def _likes(spec: DatasetSpec, rng: random.Random) -> Iterator[dict]:
+    for tweet_id in range(1, spec.tweets + 1):
+        k = min(spec.users, _heavy_tail(rng, spec.likes_per_tweet))
+        for user_id in rng.sample(range(1, spec.users + 1), k):
+            yield {"user_id": user_id, "tweet_id": tweet_id}
+
+
+def _media_and_pictures(spec: DatasetSpec, rng: random.Random):
+    media, pictures = [], []
+    for tweet_id in range(1, spec.tweets + 1):
+        if rng.random() >= spec.picture_share:
+            continue
+        media_id = len(media) + 1
+        content_hash = hashlib.sha256(f"{spec.seed}:{media_id}".encode()).hexdigest()
+        file_path = f"./IMG/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.png"
+        media.append(
+            {
+                "id": media_id,
+                "content_hash": content_hash,
+                "file_path": file_path,
+                "size": 0,
+                "ref_count": 1,
+            }
+        )
+        pictures.append(
+            {"tweet_id": tweet_id, "file_path": file_path, "media_id": media_id}
+        )
+    return media, pictures
+
+
+async def _bulk_insert(session: AsyncSession, model, rows: Iterable[dict]) -> int:
+    count = 0
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, BATCH)):
+        await session.execute(insert(model), batch)
+        count += len(batch)
+    return count
+
+
+async def _reset_sequences(session: AsyncSession):
+    """
+    id вставлены явно - в Postgres счетчики serial нужно подвинуть,
+    иначе новые записи получат уже занятые id.
+    """
+    if session.bind.dialect.name != "postgresql":
+        return
+    for table in ("users", "tweets", "media", "pictures"):
+        await session.execute(
+            text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"COALESCE(MAX(id), 0) + 1, false) FROM {table}"
+            )
+        )
+
+
+async def generate(session: AsyncSession, spec: DatasetSpec) -> dict:
+    """
+    Заполняет пустую базу набором spec, пересчитывает счетчики
+    (и ленты, если TIMELINE_MODE = "push"). Возвращает число строк по таблицам.
+    """
+    rng = random.Random(spec.seed)
+    counts = {
+        "users": await _bulk_insert(session, models.User, _users(spec)),
+        "users_users": await _bulk_insert(
+            session, models.UserUser, _follows(spec, rng)
+        ),
+        "tweets": await _bulk_insert(session, models.Tweet, _tweets(spec, rng)),
+        "likes": await _bulk_insert(session, models.Like, _likes(spec, rng)),
+    }
+    media, pictures = _media_and_pictures(spec, rng)
+    counts["media"] = await _bulk_insert(session, models.Media, media)
+    counts["pictures"] = await _bulk_insert(session, models.Picture, pictures)
+    await _reset_sequences(session)
+    await models.recount_counters(session)
+    if timeline.enabled():
+        await timeline.rebuild(session)
+    await session.commit()
+    return counts
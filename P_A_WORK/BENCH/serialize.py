@@ -0,0 +1,110 @@
+"""
+Время сборки JSON страницы ленты: проверка через response_model
+(как делает FastAPI) против fast_json.<br>
+python -m BENCH.serialize --tweets 1000 --repeat 50<br>
+Печатает мс на 1000 твитов для каждого пути.
+"""
+
+import argparse
+import json
+import random
+import time
+from typing import Callable, List, Optional, Union
+
+from pydantic import TypeAdapter
+
+import BACK.fast_json as fast_json
+import BACK.schemas as schemas
+from BACK.projections import ShortUserRow, TweetRow
+from BENCH.dataset import WORDS
+
+
+def make_page(tweets: int, seed: int = 42) -> List[TweetRow]:
+    """
+    Страница ленты как из projections: авторы и лайкнувшие -
+    общие объекты, у части твитов картинки.
+    """
+    rng = random.Random(seed)
+    users = [ShortUserRow(user_id, f"User {user_id}") for user_id in range(1, 201)]
+    page = []
+    for tweet_id in range(tweets, 0, -1):
+        row = TweetRow(
+            tweet_id,
+            " ".join(rng.choices(WORDS, k=rng.randint(3, 20))),
+            0,
+            rng.choice(users),
+        )
+        if rng.random() < 0.1:
+            row.attachments.append(f"./IMG/{tweet_id:064x}.webp")
+        row.likes = rng.sample(users, rng.randint(0, 10))
+        row.likes_count = len(row.likes)
+        page.append(row)
+    return page
+
+
+_FEED_ADAPTER = TypeAdapter(Union[schemas.TweetResultListOut, schemas.ErrResultOut])
+
+
+def validated(page: List[TweetRow]) -> bytes:
+    """
+    Путь FastAPI: проверка по Union из response_model,
+    выгрузка в простые типы и json.dumps в JSONResponse.
+    """
+    content = {"result": True, "tweets": page, "next_cursor": None}
+    value = _FEED_ADAPTER.validate_python(content, from_attributes=True)
+    return json.dumps(
+        _FEED_ADAPTER.dump_python(value, mode="json"),
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def fast(page: List[TweetRow]) -> bytes:
+    return fast_json.dumps(
+        {
+            "result": True,
+            "tweets": [tweet.as_dict() for tweet in page],
+            "next_cursor": None,
+        }
+    )
+
+
+PATHS = {"response_model": validated, "fast_json": fast}
+
+
+def measure(encode: Callable, page: List[TweetRow], repeat: int) -> float:
+    """
+    Лучшее из repeat время одного кодирования, мс на 1000 твитов.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        encode(page)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000 * 1000 / len(page)
+
+
+def run(tweets: int, repeat: int) -> dict:
+    page = make_page(tweets)
+    # Оба пути дают один и тот же документ.
+    assert json.loads(validated(page)) == json.loads(fast(page))
+    return {
+        name: round(measure(encode, page, repeat), 3) for name, encode in PATHS.items()
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m BENCH.serialize")
+    parser.add_argument("--tweets", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    results = run(args.tweets, args.repeat)
+    for name, ms in results.items():
+        print(f"{name}: {ms} ms / 1k tweets")
+    print(f"speedup: {results['response_model'] / results['fast_json']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
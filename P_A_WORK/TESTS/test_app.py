@@ -1,3 +1,7 @@
+import asyncio
+import errno
+import io
+import os
 import pytest
 
 from fastapi.testclient import TestClient
@@ -5,11 +9,19 @@ from fastapi import FastAPI
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy import select, create_engine
 from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
 
 from BACK.app import create_app
+import BACK.commands as commands
+import BACK.config as config
+import BACK.media_store as media_store
+import BACK.migrations as migrations
 import BACK.models as models
+import BACK.query_budget as query_budget
+import BACK.timeline as timeline
 
-from database_t import engine, session, DATABASE_URL
+from database_t import engine, async_session, DATABASE_URL
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 
 
@@ -20,48 +32,19 @@ engine_test = create_async_engine(DATABASE_URL, echo=False)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    async with engine.begin() as conn:
-        await conn.run_sync(models.Base.metadata.create_all)
-    try:
-        # await session.add(models.User(id=0, api_key='None', name='None'))
-        await session.execute(
-            insert(models.User)
-            .values(id=0, api_key="None", name="None")
-            .on_conflict_do_nothing(index_elements=["id"])
-        )
-        await session.execute(
-            insert(models.User)
-            .values(id=1, api_key="test", name="Test User")
-            .on_conflict_do_nothing(index_elements=["id"])
-        )
-        await session.execute(
-            insert(models.User)
-            .values(id=2, api_key="test2", name="Test User2")
-            .on_conflict_do_nothing(index_elements=["id"])
-        )
-        await session.execute(
-            insert(models.UserUser)
-            .values(id=1, follow_to_id=2)
-            .on_conflict_do_nothing(index_elements=["id", "follow_to_id"])
-        )
-        # await session.add(models.Tweet(id=0, content='None', author_id=0))
-        await session.execute(
-            insert(models.Tweet)
-            .values(id=0, content="None", author_id=0)
-            .on_conflict_do_nothing(index_elements=["id"])
-        )
-
-        await session.commit()
-    except Exception:
-        pass
+    await migrations.upgrade(engine)
+    await commands.seed(async_session)
 
     yield
-    await session.rollback()
-    await session.close()
     await engine.dispose()
 
 
-app = create_app(session, lifespan)
+# Обработчик, превысивший свой бюджет SQL или с N+1, валит тест.
+config.QUERY_BUDGET_MODE = "raise"
+# Тесты шлют запросы от одного клиента подряд - без ограничения частоты
+# (его проверяет test_admission на своем приложении).
+config.ADMISSION_ENABLED = False
+app = create_app(async_session, lifespan)
 
 # Запросы на "бэк" (8000)
 
@@ -132,3 +115,1169 @@ def test_post_tweet_delete():
             headers={"api-key": "test"},
         )
     assert response.status_code == 200
+
+
+def test_get_tweets_paginated():
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        for i in range(3):
+            client.post(
+                "tweets", headers={"api-key": "test2"}, json={"tweet_data": f"P{i}"}
+            )
+
+        seen = []
+        cursor = None
+        while True:
+            params = {"limit": 2}
+            if cursor:
+                params["cursor"] = cursor
+            response = client.get("tweets", headers={"api-key": "test"}, params=params)
+            assert response.status_code == 200
+            res_data: dict = response.json()
+            assert len(res_data["tweets"]) <= 2
+            seen.extend(t["id"] for t in res_data["tweets"])
+            cursor = res_data["next_cursor"]
+            if cursor is None:
+                break
+
+        response = client.get(
+            "tweets", headers={"api-key": "test"}, params={"cursor": "%%%"}
+        )
+    # Подписан на test2 - все три его твита в ленте, по убыванию, без повторов.
+    assert seen == sorted(set(seen), reverse=True)
+    assert len(seen) >= 3
+    assert response.status_code == 400
+
+
+def test_timeline_push_mode(monkeypatch):
+    monkeypatch.setattr(config, "TIMELINE_MODE", "push")
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        # Ленты могли наполняться и в режиме "pull" - собираем заново.
+        client.portal.call(commands.rebuild_timelines, async_session)
+
+        response = client.post(
+            "tweets", headers={"api-key": "test2"}, json={"tweet_data": "FAN"}
+        )
+        tweet_id = response.json()["tweet_id"]
+        ids = [
+            t["id"]
+            for t in client.get("tweets", headers={"api-key": "test"}).json()["tweets"]
+        ]
+        assert tweet_id in ids
+
+        # Прочитанная лента уже в кольце - новый твит должен попасть и туда.
+        response = client.post(
+            "tweets", headers={"api-key": "test2"}, json={"tweet_data": "FAN2"}
+        )
+        tweet_id2 = response.json()["tweet_id"]
+        ids = [
+            t["id"]
+            for t in client.get("tweets", headers={"api-key": "test"}).json()["tweets"]
+        ]
+        assert ids[0] == tweet_id2
+
+        client.delete(f"tweets/{tweet_id2}", headers={"api-key": "test2"})
+        ids = [
+            t["id"]
+            for t in client.get("tweets", headers={"api-key": "test"}).json()["tweets"]
+        ]
+        assert tweet_id2 not in ids
+
+        # "Звезда" - твиты подмешиваются при чтении, а не раскладываются.
+        monkeypatch.setattr(config, "TIMELINE_FANOUT_MAX_FOLLOWERS", 0)
+        response = client.post(
+            "tweets", headers={"api-key": "test2"}, json={"tweet_data": "STAR"}
+        )
+        tweet_id3 = response.json()["tweet_id"]
+        ids = [
+            t["id"]
+            for t in client.get("tweets", headers={"api-key": "test"}).json()["tweets"]
+        ]
+        assert ids[0] == tweet_id3
+        monkeypatch.setattr(config, "TIMELINE_FANOUT_MAX_FOLLOWERS", 10000)
+
+        client.delete("users/2/follow", headers={"api-key": "test"})
+        ids = [
+            t["id"]
+            for t in client.get("tweets", headers={"api-key": "test"}).json()["tweets"]
+        ]
+        assert tweet_id not in ids
+
+        client.post("users/2/follow", headers={"api-key": "test"})
+        ids = [
+            t["id"]
+            for t in client.get("tweets", headers={"api-key": "test"}).json()["tweets"]
+        ]
+        assert tweet_id in ids
+
+
+def test_timeline_star_threshold(monkeypatch):
+    monkeypatch.setattr(config, "TIMELINE_MODE", "push")
+
+    def feed(client):
+        return [
+            t["id"]
+            for t in client.get("tweets", headers={"api-key": "test"}).json()["tweets"]
+        ]
+
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        client.portal.call(commands.rebuild_timelines, async_session)
+        # Автор - "звезда": твит не раскладывается, подмешивается при чтении.
+        monkeypatch.setattr(config, "TIMELINE_FANOUT_MAX_FOLLOWERS", 0)
+        star_id = client.post(
+            "tweets", headers={"api-key": "test2"}, json={"tweet_data": "STAR"}
+        ).json()["tweet_id"]
+        assert star_id in feed(client)
+        # Перестал быть "звездой" - прежний твит из ленты не пропадает.
+        monkeypatch.setattr(config, "TIMELINE_FANOUT_MAX_FOLLOWERS", 10000)
+        plain_id = client.post(
+            "tweets", headers={"api-key": "test2"}, json={"tweet_data": "PLAIN"}
+        ).json()["tweet_id"]
+        ids = feed(client)
+        assert star_id in ids and plain_id in ids
+        # И обратно: разложенный твит остается в ленте.
+        monkeypatch.setattr(config, "TIMELINE_FANOUT_MAX_FOLLOWERS", 0)
+        timeline.rings.clear()
+        ids = feed(client)
+        assert star_id in ids and plain_id in ids
+        for tweet_id in (star_id, plain_id):
+            client.delete(f"tweets/{tweet_id}", headers={"api-key": "test2"})
+
+
+def test_timeline_self_follow(monkeypatch):
+    monkeypatch.setattr(config, "TIMELINE_MODE", "push")
+    headers = {"api-key": "test"}
+
+    def feed(client):
+        return [t["id"] for t in client.get("tweets", headers=headers).json()["tweets"]]
+
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        client.portal.call(commands.rebuild_timelines, async_session)
+        own_id = client.post(
+            "tweets", headers=headers, json={"tweet_data": "OWN"}
+        ).json()["tweet_id"]
+        # Свои твиты уже в ленте: подписка на себя их не дублирует,
+        # отписка - не убирает.
+        assert client.post("users/1/follow", headers=headers).json()["result"]
+        try:
+            assert own_id in feed(client)
+        finally:
+            assert client.delete("users/1/follow", headers=headers).json()["result"]
+        assert own_id in feed(client)
+        client.delete(f"tweets/{own_id}", headers=headers)
+
+
+def test_auth_cache_hit_and_invalidation():
+    models.auth_cache.clear()
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        hits = models.auth_cache.hits
+        client.get("users/me", headers={"api-key": "test"})
+        client.get("users/me", headers={"api-key": "test"})
+        assert models.auth_cache.hits == hits + 1
+
+        async def rename():
+            async with async_session() as session:
+                user = await session.get(models.User, 1)
+                user.name = "Renamed"
+                await session.commit()
+                user.name = "Test User"
+                await session.commit()
+
+        client.portal.call(rename)
+    assert len(models.auth_cache) == 0
+
+
+def test_counters_follow_and_like():
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        response = client.post(
+            "tweets", headers={"api-key": "test"}, json={"tweet_data": "CNT"}
+        )
+        tweet_id = response.json()["tweet_id"]
+
+        def counts():
+            user = client.get("users/me", headers={"api-key": "test2"}).json()["user"]
+            tweets = client.get("tweets", headers={"api-key": "test"}).json()["tweets"]
+            likes = next(t["likes_count"] for t in tweets if t["id"] == tweet_id)
+            return user["followers_count"], user["following_count"], likes
+
+        before = counts()
+        client.post("users/1/follow", headers={"api-key": "test2"})
+        client.post(f"tweets/{tweet_id}/likes", headers={"api-key": "test2"})
+        assert counts() == (before[0], before[1] + 1, before[2] + 1)
+
+        client.delete("users/1/follow", headers={"api-key": "test2"})
+        client.delete(f"tweets/{tweet_id}/likes", headers={"api-key": "test2"})
+        assert counts() == before
+
+
+def test_followers_paginated():
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        client.post("users/2/follow", headers={"api-key": "None"})
+
+        seen = []
+        cursor = None
+        while True:
+            params = {"limit": 1}
+            if cursor:
+                params["cursor"] = cursor
+            res_data = client.get("users/2/followers", params=params).json()
+            assert len(res_data["users"]) <= 1
+            seen.extend(u["id"] for u in res_data["users"])
+            cursor = res_data["next_cursor"]
+            if cursor is None:
+                break
+        following = client.get("users/me/following", headers={"api-key": "None"}).json()
+        profile = client.get("users/2").json()["user"]
+
+        client.delete("users/2/follow", headers={"api-key": "None"})
+        bad = [
+            client.get(f"users/x/{route}/").status_code
+            for route in ("followers", "following", "suggestions")
+        ]
+    assert bad == [400, 400, 400]
+    assert seen == [0, 1]
+    assert [u["id"] for u in following["users"]] == [2]
+    assert profile["followers_count"] == 2
+
+
+def test_media_dedup_and_size_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "MEDIA_ROOT", str(tmp_path))
+    monkeypatch.setattr(config, "MEDIA_MAX_BYTES", 1024)
+    monkeypatch.setattr(config, "DERIVATIVES_ENABLED", False)
+    content = b"\x89PNG" + bytes(range(200))
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        ids = []
+        for _ in range(2):
+            # Прочие поля формы пропускаются.
+            response = client.post(
+                "medias",
+                headers={"api-key": "test"},
+                data={"note": "skipped"},
+                files={"file": ("a.png", content)},
+            )
+            ids.append(response.json()["media_id"])
+        response = client.post(
+            "medias", headers={"api-key": "test"}, data={"file": "not a file"}
+        )
+        assert response.json()["error_message"] == "File is None"
+
+        response = client.post(
+            "medias",
+            headers={"api-key": "test"},
+            files={"file": ("b.png", b"0" * 2048)},
+        )
+        assert response.status_code == 413
+
+        async def media_rows():
+            async with async_session() as session:
+                res = await session.execute(select(models.Media))
+                return list(res.scalars())
+
+        media = client.portal.call(media_rows)
+    stored = [p for p in tmp_path.rglob("*.png")]
+    assert ids[0] != ids[1]
+    assert len(stored) == 1
+    assert [m.ref_count for m in media] == [2]
+    assert not list(Path(media_store.tmp_root()).iterdir())
+
+
+def test_media_place_across_filesystems(tmp_path, monkeypatch):
+    # Временный каталог на другой файловой системе: rename не проходит.
+    replace = os.replace
+
+    def cross_device(src, dst):
+        if "upload_tmp" in src:
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        return replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", cross_device)
+    tmp_file = tmp_path / "upload_tmp" / "upload"
+    tmp_file.parent.mkdir()
+    tmp_file.write_bytes(b"moved")
+    target = tmp_path / "ab" / "cd" / "abcd.png"
+    media_store._place(str(tmp_file), str(target))
+    assert target.read_bytes() == b"moved"
+    assert not tmp_file.exists() and os.listdir(target.parent) == ["abcd.png"]
+
+
+def test_media_derivatives(tmp_path, monkeypatch):
+    from PIL import Image
+
+    monkeypatch.setattr(config, "MEDIA_ROOT", str(tmp_path))
+    buffer = io.BytesIO()
+    Image.new("RGB", (2000, 1000), "red").save(buffer, "PNG")
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        response = client.post(
+            "medias",
+            headers={"api-key": "test"},
+            files={"file": ("big.png", buffer.getvalue())},
+        )
+        media_id = response.json()["media_id"]
+        pipeline = app.state.derivatives
+        client.portal.call(pipeline.join)
+        response = client.post(
+            "tweets",
+            headers={"api-key": "test"},
+            json={"tweet_data": "picture", "tweet_media_ids": [media_id]},
+        )
+        tweet_id = response.json()["tweet_id"]
+        tweets = client.get("tweets", headers={"api-key": "test"}).json()["tweets"]
+
+        async def media_paths(reset=False):
+            async with async_session() as session:
+                picture = await session.get(models.Picture, media_id)
+                media = await session.get(models.Media, picture.media_id)
+                paths = (media.feed_path, media.thumb_path)
+                if reset:
+                    media.feed_path = media.thumb_path = None
+                    await session.commit()
+                return paths
+
+        paths = client.portal.call(media_paths, True)
+        assert all(path and os.path.exists(path) for path in paths)
+        # Копии без записи в media подбирает обход, уже стоящее в очереди
+        # второй раз не ставится.
+        assert client.portal.call(pipeline.sweep) >= 1
+        assert client.portal.call(pipeline.sweep) == 0
+        client.portal.call(pipeline.join)
+        assert client.portal.call(media_paths) == paths
+    tweet = next(t for t in tweets if t["id"] == tweet_id)
+    assert tweet["attachments"][0].endswith("_feed.webp")
+    with Image.open(tweet["attachments"][0]) as feed:
+        assert max(feed.size) == config.DERIVATIVE_FEED_MAX_SIDE
+
+
+def test_reaper(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "MEDIA_ROOT", str(tmp_path))
+    monkeypatch.setattr(config, "DERIVATIVES_ENABLED", False)
+    # Всё загруженное считается "давним".
+    monkeypatch.setattr(config, "REAPER_ORPHAN_AGE", -60)
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        ids = []
+        for content in (b"orphan", b"deleted", b"kept"):
+            response = client.post(
+                "medias",
+                headers={"api-key": "test"},
+                files={"file": ("a.png", content)},
+            )
+            ids.append(response.json()["media_id"])
+        tweet_ids = []
+        for media_id in ids[1:]:
+            response = client.post(
+                "tweets",
+                headers={"api-key": "test"},
+                json={"tweet_data": "reaper", "tweet_media_ids": [media_id]},
+            )
+            tweet_ids.append(response.json()["tweet_id"])
+        client.delete(f"tweets/{tweet_ids[0]}", headers={"api-key": "test"})
+        stray = tmp_path / "ab" / "cd" / ("abcd" + "0" * 60 + ".png")
+        stray.parent.mkdir(parents=True)
+        stray.write_bytes(b"stray")
+
+        result = client.portal.call(commands.reap, async_session)
+
+        async def picture_ids():
+            async with async_session() as session:
+                res = await session.execute(select(models.Picture.id))
+                return set(res.scalars())
+
+        pictures = client.portal.call(picture_ids)
+    assert ids[0] not in pictures and ids[2] in pictures
+    assert result.pictures >= 1 and result.media >= 2
+    assert [p.read_bytes() for p in tmp_path.rglob("*.png")] == [b"kept"]
+
+
+def test_reaper_races_upload(tmp_path, monkeypatch):
+    import BACK.reaper as reaper
+
+    monkeypatch.setattr(config, "MEDIA_ROOT", str(tmp_path))
+    monkeypatch.setattr(config, "DERIVATIVES_ENABLED", False)
+    content = b"reaped while uploading"
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        client.post(
+            "medias", headers={"api-key": "test"}, files={"file": ("a.png", content)}
+        )
+
+        async def drop_orphans():
+            cutoff = datetime.now(timezone.utc) + timedelta(hours=1)
+            async with async_session() as session:
+                await reaper.reap_orphan_pictures(session, cutoff)
+
+        client.portal.call(drop_orphans)
+        add_reference = media_store.add_reference
+
+        async def reap_first(session, stored):
+            # Файл уже есть на диске, но запись без ссылок - уборка
+            # проходит между приемом файла и upsert. Ее запросы - не в
+            # бюджете обработчика.
+            token = query_budget.current_recorder.set(None)
+            try:
+                async with async_session() as reaper_session:
+                    result = await reaper.reap_unreferenced_media(reaper_session)
+            finally:
+                query_budget.current_recorder.reset(token)
+            assert result.files >= 1
+            return await add_reference(session, stored)
+
+        monkeypatch.setattr(media_store, "add_reference", reap_first)
+        response = client.post(
+            "medias", headers={"api-key": "test"}, files={"file": ("a.png", content)}
+        )
+        assert response.json()["result"] is True
+
+        async def media_row():
+            async with async_session() as session:
+                res = await session.execute(
+                    select(models.Media)
+                    .join(models.Picture, models.Picture.media_id == models.Media.id)
+                    .where(models.Picture.id == response.json()["media_id"])
+                )
+                return res.scalar_one()
+
+        media = client.portal.call(media_row)
+    assert media.ref_count == 1
+    assert open(media.file_path, "rb").read() == content
+    assert list(Path(media_store.tmp_root()).iterdir()) == []
+
+
+def test_bench_smoke(tmp_path, monkeypatch):
+    from BENCH.bench import MIX, run_benchmark
+    from BENCH.dataset import DatasetSpec
+
+    monkeypatch.setattr(config, "MEDIA_ROOT", str(tmp_path))
+    monkeypatch.setattr(config, "DERIVATIVES_ENABLED", False)
+    spec = DatasetSpec(
+        users=30, tweets=100, follows_per_user=5, likes_per_tweet=1, picture_share=0.2
+    )
+    report = asyncio.run(
+        run_benchmark(
+            f"sqlite+aiosqlite:///{tmp_path / 'bench.db'}",
+            spec,
+            requests=200,
+            concurrency=4,
+        )
+    )
+    assert report["rows"]["users"] == spec.users + 1
+    assert sum(e["count"] for e in report["endpoints"].values()) == 200
+    assert set(report["endpoints"]) <= set(MIX)
+    assert not any(e["errors"] for e in report["endpoints"].values())
+
+
+def test_metrics(monkeypatch):
+    monkeypatch.setattr(config, "METRICS_ENABLED", True)
+    metrics_app = create_app(async_session, lifespan)
+    with TestClient(metrics_app, base_url="http://127.0.0.1:8000/api") as client:
+        client.get("users/1/")
+        client.get("tweets", headers={"api-key": "test"})
+        text = client.get("http://127.0.0.1:8000/metrics").text
+    assert (
+        'http_requests_total{method="GET",route="/api/users/{user_id}/",status="200"}'
+        in text
+    )
+    assert (
+        'http_request_duration_seconds_count{method="GET",route="/api/tweets/"}' in text
+    )
+    statements = [
+        line
+        for line in text.splitlines()
+        if line.startswith("http_request_db_statements_sum")
+        and 'route="/api/users/{user_id}/"' in line
+    ]
+    assert float(statements[0].split()[-1]) >= 1
+    assert "http_requests_in_flight 0" in text
+
+
+def test_query_budget(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "MEDIA_ROOT", str(tmp_path))
+    monkeypatch.setattr(config, "DERIVATIVES_ENABLED", False)
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        # Три картинки - ссылки на media снимаются одним update.
+        media_ids = [
+            client.post(
+                "medias",
+                headers={"api-key": "test"},
+                files={"file": (f"{number}.png", f"budget {number}".encode())},
+            ).json()["media_id"]
+            for number in range(3)
+        ]
+        tweet_id = client.post(
+            "tweets",
+            headers={"api-key": "test"},
+            json={"tweet_data": "budget", "tweet_media_ids": media_ids},
+        ).json()["tweet_id"]
+        with query_budget.assert_statements(engine, 10):
+            response = client.delete(f"tweets/{tweet_id}", headers={"api-key": "test"})
+        assert response.json()["result"] is True
+
+        with pytest.raises(query_budget.QueryBudgetExceeded, match="budget is 1"):
+            with query_budget.assert_statements(engine, 1):
+                client.get("users/1/")
+
+    async def n_plus_one():
+        async with async_session() as session:
+            for user_id in range(3):
+                await session.get(models.User, user_id)
+
+    with pytest.raises(query_budget.QueryBudgetExceeded, match="repeated 3 times"):
+        with query_budget.assert_statements(engine):
+            asyncio.run(n_plus_one())
+
+
+def test_batch_endpoints(monkeypatch):
+    monkeypatch.setattr(config, "TIMELINE_MODE", "push")
+    headers = {"api-key": "None"}
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        client.portal.call(commands.rebuild_timelines, async_session)
+        tweet_ids = [
+            client.post(
+                "tweets",
+                headers={"api-key": "test"},
+                json={"tweet_data": f"batch {number}"},
+            ).json()["tweet_id"]
+            for number in range(2)
+        ]
+
+        response = client.get("users/", params={"ids": "2,999,1,2"})
+        assert [user["id"] for user in response.json()["users"]] == [2, 1]
+        assert client.get("users/", params={"ids": "1,x"}).status_code == 400
+
+        results = client.post(
+            "users/follow/", headers=headers, json={"user_ids": [1, 2, 999]}
+        ).json()["results"]
+        assert [item["result"] for item in results] == [True, True, False]
+        assert results[2]["error_type"] == "not found"
+        results = client.post(
+            "users/follow/", headers=headers, json={"user_ids": [1]}
+        ).json()["results"]
+        assert results[0]["error_type"] == "already exists"
+        feed = client.get("tweets", headers=headers).json()["tweets"]
+        assert set(tweet_ids) <= {tweet["id"] for tweet in feed}
+
+        results = client.post(
+            "tweets/likes/", headers=headers, json={"tweet_ids": tweet_ids + [999]}
+        ).json()["results"]
+        assert [item["result"] for item in results] == [True, True, False]
+        feed = client.get("tweets", headers=headers).json()["tweets"]
+        assert all(t["likes_count"] == 1 for t in feed if t["id"] in tweet_ids)
+        results = client.request(
+            "DELETE", "tweets/likes/", headers=headers, json={"tweet_ids": tweet_ids}
+        ).json()["results"]
+        assert all(item["result"] for item in results)
+
+        results = client.request(
+            "DELETE", "users/follow/", headers=headers, json={"user_ids": [1, 2]}
+        ).json()["results"]
+        assert all(item["result"] for item in results)
+        user = client.get("users/0/").json()["user"]
+        assert user["following_count"] == 0
+        feed = client.get("tweets", headers=headers).json()["tweets"]
+        assert not set(tweet_ids) & {tweet["id"] for tweet in feed}
+        response = client.post("tweets/likes/", headers=headers, json={"tweet_ids": []})
+        assert response.status_code == 400
+
+
+def test_etags():
+    headers = {"api-key": "test"}
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        response = client.get("tweets", headers=headers)
+        etag = response.headers["ETag"]
+        assert response.headers["Cache-Control"] == "private, no-cache"
+        response = client.get("tweets", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        # Другая страница - другой ETag.
+        assert (
+            client.get("tweets", headers=headers, params={"limit": 1}).headers["ETag"]
+            != etag
+        )
+
+        # Новый твит того, за кем следим, и лайк к нему меняют ленту.
+        tweet_id = client.post(
+            "tweets", headers={"api-key": "test2"}, json={"tweet_data": "etag"}
+        ).json()["tweet_id"]
+        response = client.get("tweets", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 200
+        assert tweet_id in {tweet["id"] for tweet in response.json()["tweets"]}
+        etag = response.headers["ETag"]
+        client.post(f"tweets/{tweet_id}/likes", headers={"api-key": "None"})
+        response = client.get("tweets", headers={**headers, "If-None-Match": etag})
+        assert response.status_code == 200
+
+        etag = client.get("users/2/").headers["ETag"]
+        response = client.get(
+            "users/me/", headers={"api-key": "test2", "If-None-Match": etag}
+        )
+        assert response.status_code == 304
+        client.post("users/2/follow/", headers={"api-key": "None"})
+        response = client.get("users/2/", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        client.delete("users/2/follow/", headers={"api-key": "None"})
+        client.delete(f"tweets/{tweet_id}", headers={"api-key": "test2"})
+
+
+def test_fast_json(monkeypatch):
+    from BENCH.serialize import run
+
+    headers = {"api-key": "test"}
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        tweet_id = client.post(
+            "tweets", headers={"api-key": "test2"}, json={"tweet_data": "Привет"}
+        ).json()["tweet_id"]
+        client.post(f"tweets/{tweet_id}/likes", headers=headers)
+        responses = {}
+        for fast in (False, True):
+            monkeypatch.setattr(config, "FAST_JSON", fast)
+            responses[fast] = [
+                client.get("tweets", headers=headers),
+                client.get("users/1/"),
+            ]
+        assert responses[True][0].json()["tweets"]
+        for slow, quick in zip(responses[False], responses[True]):
+            assert quick.headers["content-type"] == "application/json"
+            assert quick.headers["ETag"] == slow.headers["ETag"]
+            assert quick.json() == slow.json()
+        client.delete(f"tweets/{tweet_id}", headers={"api-key": "test2"})
+
+    assert set(run(tweets=50, repeat=1)) == {"response_model", "fast_json"}
+
+
+def test_migrations(tmp_path):
+    from sqlalchemy import inspect, text
+
+    legacy = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'legacy.db'}")
+
+    async def run():
+        with pytest.raises(migrations.SchemaOutdated):
+            await migrations.check(legacy)
+        # Схема первой версии приложения, create_all на старте.
+        async with legacy.begin() as conn:
+            for ddl in (
+                "CREATE TABLE users (id INTEGER PRIMARY KEY, api_key VARCHAR "
+                "NOT NULL UNIQUE, name VARCHAR NOT NULL)",
+                "CREATE TABLE tweets (id INTEGER PRIMARY KEY, content VARCHAR "
+                "NOT NULL, author_id INTEGER REFERENCES users (id))",
+                "CREATE TABLE likes (user_id INTEGER, tweet_id INTEGER, "
+                "PRIMARY KEY (user_id, tweet_id))",
+                "CREATE TABLE users_users (id INTEGER, follow_to_id INTEGER, "
+                "PRIMARY KEY (id, follow_to_id))",
+                "CREATE TABLE pictures (id INTEGER PRIMARY KEY, tweet_id INTEGER, "
+                "file_path VARCHAR NOT NULL)",
+                "INSERT INTO users VALUES (1, 'a', 'A'), (2, 'b', 'B')",
+                "INSERT INTO users_users VALUES (1, 2)",
+                "INSERT INTO tweets VALUES (1, 'old', 2)",
+                "INSERT INTO likes VALUES (1, 1)",
+            ):
+                await conn.execute(text(ddl))
+
+        assert await migrations.upgrade(legacy) == [1, 2, 3, 4, 5, 6]
+        assert await migrations.check(legacy) == migrations.HEAD
+        assert await migrations.upgrade(legacy) == []
+
+        async with legacy.connect() as conn:
+            indexes = await conn.run_sync(
+                lambda sync_conn: {
+                    index["name"]
+                    for table in ("tweets", "likes", "pictures", "users_users")
+                    for index in inspect(sync_conn).get_indexes(table)
+                }
+            )
+            user = (
+                await conn.execute(
+                    select(models.User.followers_count, models.User.version).where(
+                        models.User.id == 2
+                    )
+                )
+            ).first()
+            likes_count = (
+                await conn.execute(select(models.Tweet.likes_count))
+            ).scalar()
+        # Колонки created_at добавлены миграцией - время ставит модель.
+        async with AsyncSession(legacy) as session:
+            tweet = models.Tweet(content="new", author_id=1)
+            session.add(tweet)
+            await session.flush()
+            tweet_id = tweet.id
+            await session.commit()
+            created_at = (
+                await session.execute(
+                    select(models.Tweet.created_at).where(models.Tweet.id == tweet_id)
+                )
+            ).scalar()
+        await legacy.dispose()
+        return indexes, user, likes_count, created_at
+
+    indexes, user, likes_count, created_at = asyncio.run(run())
+    assert {
+        "ix_likes_tweet_id",
+        "ix_likes_created_at",
+        "ix_pictures_tweet_id",
+        "ix_tweets_author_id_id",
+        "ix_tweets_author_id_id_merged",
+    } <= indexes
+    assert tuple(user) == (1, 0)
+    assert likes_count == 1
+    assert created_at.year > 1970
+
+
+def test_commands_warn_local_broadcast(monkeypatch, capsys):
+    # Сброс кэшей из отдельного процесса не дойдет до приложения.
+    monkeypatch.setattr(config, "BROADCAST_BACKEND", "local")
+    assert commands.warn_local_broadcast("rebuild-popular")
+    assert "restart the app" in capsys.readouterr().err
+    monkeypatch.setattr(config, "BROADCAST_BACKEND", "unix")
+    assert not commands.warn_local_broadcast("rebuild-popular")
+
+
+def test_search():
+    headers = {"api-key": "test"}
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        ids = [
+            client.post("tweets", headers=headers, json={"tweet_data": content}).json()[
+                "tweet_id"
+            ]
+            for content in (
+                "Квантовый кот спит",
+                "квантовый КОТ, квантовый кот и снова кот",
+                "Собака не квантовая",
+            )
+        ]
+
+        def found(**params):
+            response = client.get("tweets/search", params=params)
+            assert response.status_code == 200
+            body = response.json()
+            return [tweet["id"] for tweet in body["tweets"]], body["next_cursor"]
+
+        # Все слова обязательны, чаще встречаются - выше.
+        assert found(q="кот квантовый")[0] == [ids[1], ids[0]]
+        assert found(q="собака")[0] == [ids[2]]
+        assert found(q="кот енот")[0] == []
+
+        page, cursor = found(q="кот", limit=1)
+        assert page == [ids[1]] and cursor
+        assert found(q="кот", limit=1, cursor=cursor)[0] == [ids[0]]
+
+        client.delete(f"tweets/{ids[0]}", headers=headers)
+        assert found(q="спит")[0] == []
+        assert client.get("tweets/search", params={"q": "?!"}).status_code == 400
+        assert (
+            client.get("tweets/search", params={"q": "кот", "cursor": "x"}).status_code
+            == 400
+        )
+        for tweet_id in ids[1:]:
+            client.delete(f"tweets/{tweet_id}", headers=headers)
+
+
+def test_admission(monkeypatch):
+    import httpx
+    from BACK import admission, metrics
+
+    now = [0.0]
+    buckets = admission.TokenBuckets(admission.Rate(2, 3), 10, lambda: now[0])
+    assert [buckets.take("a") for _ in range(3)] == [0, 0, 0]
+    assert buckets.take("a") == 0.5
+    assert buckets.take("b") == 0
+    now[0] += 0.5
+    assert buckets.take("a") == 0
+
+    monkeypatch.setattr(config, "ADMISSION_ENABLED", True)
+    monkeypatch.setattr(config, "RATE_WRITE_PER_SEC", 1)
+    monkeypatch.setattr(config, "RATE_WRITE_BURST", 2)
+    limited = create_app(async_session, lifespan)
+    shed_before = metrics.registry.shed.values.get(("too many requests", "write"), 0)
+    # Корзина - по api-key, а не по кэшу пользователей: и без него
+    # два ключа с одного адреса не делят корзину.
+    monkeypatch.setattr(config, "AUTH_CACHE_ENABLED", False)
+    with TestClient(limited, base_url="http://127.0.0.1:8000/api") as client:
+        statuses = [
+            client.delete("tweets/999999", headers={"api-key": "test"}).status_code
+            for _ in range(3)
+        ]
+        assert statuses == [404, 404, 429]
+        response = client.delete("tweets/999999", headers={"api-key": "test"})
+        assert response.json()["error_type"] == "too many requests"
+        assert int(response.headers["Retry-After"]) >= 1
+        # Другой ключ и чтение - свои корзины.
+        assert (
+            client.delete("tweets/999999", headers={"api-key": "test2"}).status_code
+            == 404
+        )
+        assert client.get("users/1/").status_code == 200
+    assert (
+        metrics.registry.shed.values[("too many requests", "write")] == shed_before + 2
+    )
+
+    async def slow_app(scope, receive, send):
+        await asyncio.sleep(0.05)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def burst():
+        guarded = admission.AdmissionMiddleware(
+            slow_app, rates={}, max_keys=10, max_concurrent=2, retry_after=3
+        )
+        transport = httpx.ASGITransport(app=guarded)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://t"
+        ) as client:
+            return await asyncio.gather(*(client.get("/api/tweets/") for _ in range(3)))
+
+    responses = asyncio.run(burst())
+    assert sorted(r.status_code for r in responses) == [200, 200, 503]
+    assert [r.headers["Retry-After"] for r in responses if r.status_code == 503] == [
+        "3"
+    ]
+
+
+def test_multi_worker_coherence(tmp_path, monkeypatch):
+    from BACK import broadcast, timeline
+    from BACK.process_lock import ProcessLock
+
+    monkeypatch.setattr(config, "RUN_DIR", str(tmp_path))
+
+    async def exchange():
+        received = {"a": [], "b": []}
+        hubs = {}
+        # Два процесса - два сокета в RUN_DIR.
+        for name in received:
+            hub = hubs[name] = broadcast.Hub()
+            hub.register("note", received[name].append)
+            await hub.start("unix", name=name)
+        hubs["a"].publish("note", 1)
+        hubs["b"].publish("note", 2)
+        await asyncio.sleep(0.05)
+        for hub in hubs.values():
+            await hub.stop()
+        return received
+
+    assert asyncio.run(exchange()) == {"a": [1, 2], "b": [2, 1]}
+
+    first, second = ProcessLock("job"), ProcessLock("job")
+    assert first.try_acquire() and first.try_acquire()
+    assert not second.try_acquire()
+    first.release()
+    assert second.try_acquire()
+    second.release()
+
+    rings = timeline.TimelineRings(ring_size=5, max_users=10)
+    rings.load(1, [3, 2, 1])
+    rings.push([1], 4)
+    rings.push([1], 4)
+    assert rings.page(1, 10, None) == [4, 3, 2, 1]
+    # Пришел позже более нового - кольцо перечитается.
+    rings.push([1], 2)
+    assert 1 in rings
+    rings.push([1], 0)
+    assert 1 not in rings
+
+
+def test_read_replica(tmp_path, monkeypatch):
+    from sqlalchemy import text
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+    from BACK import metrics, replicas
+
+    monkeypatch.setattr(config, "MEDIA_ROOT", str(tmp_path))
+    # Два файла SQLite: основная база и "реплика" с другим именем test.
+    engines = {
+        name: create_async_engine(f"sqlite+aiosqlite:///{tmp_path / name}.db")
+        for name in ("primary", "replica")
+    }
+    makers = {
+        name: async_sessionmaker(engine, expire_on_commit=False)
+        for name, engine in engines.items()
+    }
+
+    @asynccontextmanager
+    async def two_databases(app: FastAPI):
+        for name, engine in engines.items():
+            await migrations.upgrade(engine)
+            await commands.seed(makers[name])
+        async with engines["replica"].begin() as conn:
+            await conn.execute(text("UPDATE users SET name = 'replica' WHERE id = 1"))
+        yield
+        for engine in engines.values():
+            await engine.dispose()
+
+    routed = create_app(makers["primary"], two_databases, makers["replica"])
+    replica_reads = metrics.registry.reads.values.get(("replica",), 0)
+    with TestClient(routed, base_url="http://127.0.0.1:8000/api") as client:
+
+        def name_seen_by(api_key):
+            return client.get("users/1/", headers={"api-key": api_key}).json()["user"][
+                "name"
+            ]
+
+        assert name_seen_by("test") == "replica"
+        assert metrics.registry.reads.values[("replica",)] == replica_reads + 1
+        response = client.post(
+            "tweets", headers={"api-key": "test"}, json={"tweet_data": "primary"}
+        )
+        assert response.json()["result"] is True
+        # Писавший клиент читает свои записи с основной базы, остальные - с реплики.
+        assert name_seen_by("test") != "replica"
+        assert name_seen_by("test2") == "replica"
+        # Реплика не получает записей - твита на ней нет.
+        assert (
+            client.get("tweets/search", params={"q": "primary"}).json()["tweets"] == []
+        )
+        replicas.sticky.clear()
+        assert name_seen_by("test") == "replica"
+
+
+def test_tweet_stream(monkeypatch):
+    from BACK import stream
+
+    # Очередь на 2 события: третье отключает подписчика.
+    hub = stream.StreamHub(queue_size=2, max_subscribers=1)
+    slow = hub.subscribe(1, [1, 2])
+    assert hub.subscribe(3, [1]) is None
+    hub.tweet(3, 10)
+    assert slow.queue.empty()
+    for tweet_id in (11, 12, 13):
+        hub.tweet(2, tweet_id)
+    assert len(hub) == 0 and slow.queue.get_nowait() is None
+
+    async def live():
+        sub = stream.streams.subscribe(1, [1, 2])
+        body = stream.events(sub, [(20, 2)], heartbeat=0.01, max_duration=0)
+        chunks = [await body.__anext__() for _ in range(2)]
+        stream.streams.tweet(2, 20)  # уже отдан из backlog
+        stream.streams.tweet(2, 21)
+        chunks.append(await body.__anext__())
+        chunks.append(await body.__anext__())
+        await body.aclose()
+        return chunks, len(stream.streams)
+
+    chunks, subscribers = asyncio.run(live())
+    assert chunks[0].startswith(b"retry: ")
+    assert chunks[1].startswith(b"id: 20\nevent: tweet\n")
+    assert chunks[2].startswith(b"id: 21\n")
+    assert chunks[3] == stream.HEARTBEAT
+    assert subscribers == 0
+
+    monkeypatch.setattr(config, "STREAM_HEARTBEAT", 0.05)
+    monkeypatch.setattr(config, "STREAM_MAX_DURATION", 0.2)
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        tweet_id = client.post(
+            "tweets", headers={"api-key": "test"}, json={"tweet_data": "streamed"}
+        ).json()["tweet_id"]
+        response = client.get(
+            "tweets/stream",
+            headers={"api-key": "test", "Last-Event-ID": str(tweet_id - 1)},
+        )
+        assert response.headers["content-type"].startswith("text/event-stream")
+        assert f"id: {tweet_id}\n" in response.text
+        assert ": ping" in response.text
+
+        # Твит с меньшим id мог закончить commit после отданного - он
+        # дочитывается из окна перед Last-Event-ID.
+        late_id = client.post(
+            "tweets", headers={"api-key": "test"}, json={"tweet_data": "late"}
+        ).json()["tweet_id"]
+        response = client.get(
+            "tweets/stream",
+            headers={"api-key": "test", "Last-Event-ID": str(late_id + 1)},
+        )
+        assert f"id: {late_id}\n" in response.text
+        monkeypatch.setattr(config, "STREAM_RESUME_WINDOW", 0)
+        response = client.get(
+            "tweets/stream",
+            headers={"api-key": "test", "Last-Event-ID": str(late_id + 1)},
+        )
+        assert f"id: {late_id}\n" not in response.text
+
+        monkeypatch.setattr(config, "STREAM_RESUME_LIMIT", 0)
+        response = client.get(
+            "tweets/stream", headers={"api-key": "test", "Last-Event-ID": "0"}
+        )
+        assert "event: reset" in response.text
+        assert (
+            client.get(
+                "tweets/stream", headers={"api-key": "test", "Last-Event-ID": "x"}
+            ).status_code
+            == 400
+        )
+    assert len(stream.streams) == 0
+
+
+def test_logging(monkeypatch):
+    import io
+    import json
+    import logging
+    import queue
+    from BACK import logs, metrics
+
+    # Полная очередь - запись теряется и считается, вызвавший не ждет.
+    handler = logs.ContextQueueHandler(queue.Queue(1))
+    dropped = metrics.registry.log_dropped.values.get((), 0)
+    for number in range(3):
+        handler.handle(logging.LogRecord("t", logging.INFO, "", 0, "x", (), None))
+    assert handler.dropped == 2
+    assert metrics.registry.log_dropped.values[()] == dropped + 2
+
+    # Прореживание - запросами целиком.
+    assert logs.sampled("abc", 0.5) == logs.sampled("abc", 0.5)
+    assert logs.sampled("abc", 1) and not logs.sampled("abc", 0)
+
+    output = io.StringIO()
+    monkeypatch.setattr(config, "LOG_SLOW_QUERY_MS", 0)
+    logs.configure(output)
+    try:
+        with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+            response = client.get("users/1/", headers={"X-Request-ID": "req-1"})
+            generated = client.get("users/1/").headers["X-Request-ID"]
+    finally:
+        logs.shutdown()
+    assert response.headers["X-Request-ID"] == "req-1" and generated != "req-1"
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    access = [line for line in lines if line["message"] == "request"]
+    assert access[0]["request_id"] == "req-1"
+    assert access[0]["status"] == 200 and access[0]["path"] == "/api/users/1/"
+    assert access[0]["elapsed_ms"] >= 0
+    assert access[1]["request_id"] == generated
+    # Порог 0 - каждое выражение "медленное", со своим запросом.
+    slow = [line for line in lines if line["message"] == "slow query"]
+    assert {"req-1", generated} <= {line["request_id"] for line in slow}
+
+
+def test_popular():
+    from BACK import popular
+
+    # Лайк через период полураспада весит вдвое больше.
+    assert popular.weight(3600.0 + config.POPULAR_HALF_LIFE, 3600.0) == 2.0
+    board = popular.PopularBoard(2)
+    board.offer([(1, 5.0)])
+    assert len(board) == 0  # не загружен - ждет загрузки из базы
+    board.load([(1, 1.0), (2, 3.0), (3, 2.0)])
+    assert board.page(10) == [(2, 3.0), (3, 2.0)]
+    board.offer([(1, 4.0), (3, 0.0)])
+    assert board.page(10) == [(1, 4.0), (2, 3.0)]
+    assert board.page(10, after=(4.0, 1)) == [(2, 3.0)]
+
+    def positions(client, ids):
+        tweets = client.get(
+            "tweets/popular", params={"limit": config.FEED_MAX_LIMIT}
+        ).json()["tweets"]
+        order = [tweet["id"] for tweet in tweets]
+        return [
+            order.index(tweet_id) if tweet_id in order else None for tweet_id in ids
+        ]
+
+    async def db_scores(ids):
+        async with async_session() as session:
+            res = await session.execute(
+                select(models.TweetScore.tweet_id, models.TweetScore.score).where(
+                    models.TweetScore.tweet_id.in_(ids)
+                )
+            )
+            return dict(res.all())
+
+    async def rebuild():
+        async with async_session() as session:
+            await popular.rebuild(session)
+            await session.commit()
+        popular.board.invalidate()
+
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        popular.board.invalidate()
+        first, second = [
+            client.post(
+                "tweets", headers={"api-key": "test"}, json={"tweet_data": "popular"}
+            ).json()["tweet_id"]
+            for _ in range(2)
+        ]
+        for api_key in ("test", "test2"):
+            client.post(f"tweets/{first}/likes", headers={"api-key": api_key})
+        client.post(
+            "tweets/likes/", headers={"api-key": "test"}, json={"tweet_ids": [second]}
+        )
+        # Верх в памяти обновляется лайками без перезагрузки.
+        assert client.get("tweets/popular").status_code == 200
+        assert popular.board.loaded
+        client.post(f"tweets/{second}/likes", headers={"api-key": "test2"})
+        client.delete(f"tweets/{first}/likes", headers={"api-key": "test2"})
+        before, after = positions(client, [first, second])
+        assert after < before
+
+        incremental = asyncio.run(db_scores([first, second]))
+        asyncio.run(rebuild())
+        rebuilt = asyncio.run(db_scores([first, second]))
+        for tweet_id in (first, second):
+            assert rebuilt[tweet_id] == pytest.approx(incremental[tweet_id], rel=0.01)
+        before, after = positions(client, [first, second])
+        assert after < before
+
+        client.delete(f"tweets/{second}", headers={"api-key": "test"})
+        assert positions(client, [second]) == [None]
+        assert asyncio.run(db_scores([second])) == {}
+        assert client.get("tweets/popular", params={"cursor": "bad"}).status_code == 400
+
+
+def test_follow_graph_suggestions(monkeypatch):
+    from array import array
+
+    from BACK import follow_graph
+
+    graph = follow_graph.FollowGraph(max_edges=7, max_delta=2)
+    graph.begin_load()
+    graph.follow(1, [4], True)  # пришло во время загрузки
+    # 1 -> 2, 3; 2 -> 3, 4; 3 -> 4; строки - только у подписанных.
+    graph.install(
+        {1: 0, 2: 1, 3: 2}, array("q", [0, 2, 4, 5]), array("i", [2, 3, 3, 4, 4])
+    )
+    assert list(graph.following(1)) == [2, 3, 4]
+    graph.follow(1, [4], False)
+    assert graph.suggest(1, 10, max_fanout=10, max_scan=100) == [(4, 2)]
+    graph.follow(5, [1, 2], True)  # новый пользователь, перенос в массивы
+    assert list(graph.following(5)) == [1, 2] and len(graph) == 7
+    assert graph.suggest(5, 10, max_fanout=10, max_scan=100) == [(3, 2), (4, 1)]
+    graph.follow(3, [1, 2, 5], True)  # перенос: больше max_edges - индекса нет
+    assert not graph.loaded and graph.too_large
+    # Массивы растут с числом подписок, а не с наибольшим id.
+    sparse = follow_graph.FollowGraph(max_edges=7, max_delta=0)
+    sparse.install({}, array("q", [0]), array("i"))
+    sparse.follow(2**31 - 1, [1], True)
+    assert list(sparse.following(2**31 - 1)) == [1] and len(sparse._offsets) == 2
+
+    async def from_db(user_id):
+        async with async_session() as session:
+            return await follow_graph._suggest_from_db(session, user_id, 10)
+
+    headers = {"api-key": "None"}
+    with TestClient(app, base_url="http://127.0.0.1:8000/api") as client:
+        assert follow_graph.graph.loaded  # загружен при запуске
+        client.post("users/1/follow", headers=headers)
+        try:
+            res_data = client.get("users/me/suggestions/", headers=headers).json()
+            assert res_data["users"][0]["id"] == 2
+            assert res_data["users"][0]["mutual"] == 1
+            # Индекс, дописанный подпиской, совпадает с запросом к базе.
+            assert follow_graph.graph.suggest(0, 10, 1000, 1000) == asyncio.run(
+                from_db(0)
+            )
+            assert client.get("users/999/suggestions/").status_code == 404
+
+            # Сброшенный индекс: ответ - запросом к базе, не дожидаясь
+            # загрузки в фоне.
+            gate = asyncio.Event()
+            load = follow_graph.load
+
+            async def held_load(session):
+                await gate.wait()
+                return await load(session)
+
+            monkeypatch.setattr(follow_graph, "load", held_load)
+            follow_graph.graph.invalidate()
+            res_data = client.get("users/me/suggestions/", headers=headers).json()
+            assert res_data["users"][0]["id"] == 2
+            assert not follow_graph.graph.loaded
+
+            async def reloaded():
+                gate.set()
+                await follow_graph._reload_task
+                return follow_graph.graph.loaded
+
+            assert client.portal.call(reloaded)
+        finally:
+            client.delete("users/1/follow", headers=headers)
+        assert client.get("users/0/suggestions/").json()["users"] == []